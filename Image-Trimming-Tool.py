@@ -1,8 +1,18 @@
 import wx
 import os
-import io
 import datetime
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image, ImageDraw, ImageOps, ImageGrab  # ImageGrabでクリップボードからの取得を有効にする
+from trim_core import TrimSession, BackgroundSaver, display_rect_to_box, box_to_display_rect, encode_clipboard_data
+from trim_auto import AutoTrimError
+from trim_encode import TargetSizeError
+from trim_display import DisplayPyramid, FrameStats
+from trim_geometry import Rect, SelectionGeometry
+from trim_loader import ImageQueue
+from trim_batch import recipe_from_session, save_recipe
+from trim_lossless import find_jpegtran
+from trim_export import prepare_export, load_profiles, ProfileError, DEFAULT_EXPORT_PROFILES
 # アプリケーションウィンドウの定数
 APP_WINDOW_SIZE = (1120, 680)   # デフォルトサイズ
 WINDOW_RESIZE_STEP = 0.2        # マウスホイール1ノッチあたりの拡大縮小率（デフォルト比）
@@ -11,7 +21,12 @@ DEFAULT_CROP_ASPECT = "1:1"
 DEFAULT_IMAGE_SIZE = 1024
 DEFAULT_JPEG_QUALITY = 70
 LINES = 20
+DRAG_FRAME_RATE = 60    # ドラッグ中にトリミング範囲を更新・再描画する最大回数(回/秒)
 BACK_GROUND_COLOR = wx.Colour(100, 100, 100)
+CLIPBOARD_USE_BITMAP = True    # クリップボードに無圧縮ビットマップ形式も載せる
+LOSSLESS_JPEG_SAVE = False  # JPG無劣化保存のチェックボックスの初期値
+EXPORT_PROFILES_FILE = r""  # 書き出しボタンで使うプロファイル(JSON)。空のままならtrim_export.DEFAULT_EXPORT_PROFILESを使用
+PAINT_STATS_ENABLED = False     # 起動時から描画時間を計測する。F3でHUDの表示と計測を切り替え、F4で統計をファイルに書き出す
 CLIPBOARD_SAVE_DIR = r""  # クリップボード保存先の上書き用。空のままならWindowsではPictures\\Image-Cropperを使用
 
 def resolve_clipboard_save_dir():
@@ -36,22 +51,24 @@ class ImagePanel(wx.Panel):
         self.SetBackgroundColour(BACK_GROUND_COLOR)
         self.SetDoubleBuffered(True)
         self.Bind(wx.EVT_ERASE_BACKGROUND, self.OnEraseBackground)
-        # スケーリングしたビットマップ描画用のキャッシュ
+        # スケーリングした画像にグリッドを焼き込んだビットマップのキャッシュ
         self._cached_bitmap = None
         self._cached_size = (0, 0)
-        self._cached_image_id = None
-        self.original_image = None
-        self.current_image = None
-        self.file_name = ""
-        # 現在の画像がクリップボードから取得された場合はTrue
-        self.from_clipboard = False
-        # トリミング矩形の状態と履歴を初期化
+        # idは解放後に再利用されうるので、キャッシュ元の画像そのものを参照で保持する
+        self._cached_image = None
+        # 表示サイズ変更のたびに元画像から縮小しないよう、縮小画像のピラミッドを保持
+        self._pyramid = None
+        # 画像処理と履歴はwxに依存しないTrimSessionが持つ
+        self.session = TrimSession()
+        # 複数ファイルをドロップしたときの(何枚目, 全体の枚数)。1枚だけのときはNone
+        self.queue_position = None
+        # 保存はワーカースレッドで受け付けた順に行い、完了はUIスレッドで受け取る
+        self.saver = BackgroundSaver(on_done=lambda future: wx.CallAfter(self._on_save_done, future))
+        # トリミング矩形の状態を初期化
         self.crop_rect = None
-        self.crop_history = []
-        self.max_crop_history = 10
         self.mode = "idle"
         self.drag_handle = None
-        self.drag_start = wx.Point()
+        self.drag_start = (0, 0)
         self.original_rect = None
         self.display_offset_x = 0
         self.display_offset_y = 0
@@ -60,6 +77,21 @@ class ImagePanel(wx.Panel):
         self.old_display_width = 0
         self.old_display_height = 0
         self.fixed_aspect = True
+        # トリミング範囲の計算はwxに依存しないSelectionGeometryで行い、wx.Rectは描画時にだけ作る
+        self.geometry = SelectionGeometry(min_size=self.MIN_CROP_SIZE, handle_size=self.HANDLE_SIZE)
+        # オーバーレイ描画用のペンとブラシは毎フレーム作らない
+        self._overlay_brush = wx.Brush(wx.Colour(0, 0, 0, 100), wx.BRUSHSTYLE_SOLID)     # 100 = overlay alpha
+        self._frame_pen = wx.Pen(wx.Colour(255, 0, 0), 1, wx.PENSTYLE_SOLID)
+        self._handle_brush = wx.Brush(wx.Colour(255, 255, 255))
+        # ドラッグ中のマウス移動はまとめて、タイマーでDRAG_FRAME_RATEごとに最新の位置だけを反映する
+        self._pending_drag_point = None
+        self._drag_moved = False
+        self._drag_timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.OnDragTimer, self._drag_timer)
+        # 描画の段階別の所要時間。計測しないときはNone
+        self.paint_stats = FrameStats() if PAINT_STATS_ENABLED else None
+        self.show_paint_hud = False
+        self._hud_rect = None
         self.Bind(wx.EVT_PAINT, self.OnPaint)
         self.Bind(wx.EVT_LEFT_DOWN, self.OnLeftDown)
         self.Bind(wx.EVT_LEFT_UP, self.OnLeftUp)
@@ -67,6 +99,22 @@ class ImagePanel(wx.Panel):
         self.Bind(wx.EVT_LEAVE_WINDOW, self.OnMouseLeave)
         self.Bind(wx.EVT_SIZE, self.OnResize)
 
+    @property
+    def current_image(self):
+        return self.session.current_image
+
+    @property
+    def file_name(self):
+        return self.session.file_name
+
+    @property
+    def from_clipboard(self):
+        return self.session.from_clipboard
+
+    @from_clipboard.setter
+    def from_clipboard(self, value):
+        self.session.from_clipboard = value
+
     def OnEraseBackground(self, event):
         pass
 
@@ -83,110 +131,51 @@ class ImagePanel(wx.Panel):
         # 直前の表示サイズが取得できない場合は処理しない
         if not self.crop_rect or self.old_display_width == 0 or self.old_display_height == 0:
             return
-        old_x, old_y, old_w, old_h = self.crop_rect
-        cx_old = old_x + old_w/2
-        cy_old = old_y + old_h/2
-        scale_x = 1.0
-        scale_y = 1.0
-        if self.old_display_width != 0:
-            scale_x = self.display_width / self.old_display_width
-        if self.old_display_height != 0:
-            scale_y = self.display_height / self.old_display_height
-        new_w = old_w * scale_x
-        new_h = old_h * scale_y
-        cx_new = cx_old * scale_x
-        cy_new = cy_old * scale_y
-        new_x = cx_new - new_w/2
-        new_y = cy_new - new_h/2
-        new_x, new_y, new_w, new_h = self.ClipRect(new_x, new_y, new_w, new_h)
-        rect = self._ensure_min_size(wx.Rect(int(round(new_x)), int(round(new_y)), int(round(new_w)), int(round(new_h))))
-        self.crop_rect = (rect.x, rect.y, rect.width, rect.height)
-
-    def ClipRect(self, x, y, w, h):
-        # 矩形を表示エリア内に収める
-        if w < 0:
-            w = 0
-        if h < 0:
-            h = 0
-        if x < 0:
-            x = 0
-        if x + w > self.display_width:
-            x = self.display_width - w
-        if y < 0:
-            y = 0
-        if y + h > self.display_height:
-            y = self.display_height - h
-        return (x, y, w, h)
+        rect = self.geometry.rescale(self.crop_rect, self.old_display_width, self.old_display_height)
+        self.crop_rect = rect.as_tuple()
 
     def UpdateDisplayGeometry(self):
-        if not self.current_image:
+        if not self.session.has_image:
             self.display_offset_x = 0
             self.display_offset_y = 0
             self.display_width = 0
             self.display_height = 0
+            self.geometry.set_display_size(0, 0)
             return
         panel_w, panel_h = self.GetClientSize()
-        img_w, img_h = self.current_image.size
+        # 表示寸法は常に原寸サイズから求め、プレビュー表示中でも画像座標と正確に対応させる
+        img_w, img_h = self.session.size
         scale = min(panel_w / img_w, panel_h / img_h)
         new_w = int(img_w * scale)
         new_h = int(img_h * scale)
         self.display_width, self.display_height = new_w, new_h
         self.display_offset_x = (panel_w - new_w) // 2
         self.display_offset_y = (panel_h - new_h) // 2
+        self.geometry.set_display_size(new_w, new_h)
         # 表示サイズが変わったときはキャッシュをリセット
         self._cached_bitmap = None
 
     def _event_to_display_point(self, event):
         x, y = event.GetPosition()
-        return wx.Point(x - self.display_offset_x, y - self.display_offset_y)
+        return (x - self.display_offset_x, y - self.display_offset_y)
 
     def _clamp_display_point(self, point):
-        return wx.Point(
-            max(0, min(point.x, self.display_width)),
-            max(0, min(point.y, self.display_height))
-        )
+        return self.geometry.clamp_point(point)
 
     def _point_in_display(self, point):
-        return 0 <= point.x <= self.display_width and 0 <= point.y <= self.display_height
+        return self.geometry.point_in_display(point)
 
     def _rect_contains_point(self, rect_tuple, point):
-        x, y, w, h = rect_tuple
-        return x <= point.x <= x + w and y <= point.y <= y + h
-
-    def _iter_handle_rects_display(self):
-        if not self.crop_rect:
-            return []
-        half = self.HANDLE_SIZE // 2
-        x, y, w, h = self.crop_rect
-        left = x
-        top = y
-        right = x + w
-        bottom = y + h
-        center_x = x + w / 2
-        center_y = y + h / 2
-        points = {
-            "top_left": (left, top),
-            "top": (center_x, top),
-            "top_right": (right, top),
-            "right": (right, center_y),
-            "bottom_right": (right, bottom),
-            "bottom": (center_x, bottom),
-            "bottom_left": (left, bottom),
-            "left": (left, center_y),
-        }
-        for name, (px, py) in points.items():
-            yield name, wx.Rect(int(round(px)) - half, int(round(py)) - half, self.HANDLE_SIZE, self.HANDLE_SIZE)
+        return self.geometry.crop_contains(rect_tuple, point)
 
     def _iter_handle_rects_panel(self):
-        for name, rect in self._iter_handle_rects_display():
-            rect.Offset(self.display_offset_x, self.display_offset_y)
-            yield name, rect
+        """描画用に、パネル座標のハンドルのwx.Rectを返す。"""
+        size = self.HANDLE_SIZE
+        for name, left, top, _, _ in self.geometry.handle_boxes(self.crop_rect):
+            yield name, wx.Rect(left + self.display_offset_x, top + self.display_offset_y, size, size)
 
     def _hit_test_handle(self, point):
-        for name, rect in self._iter_handle_rects_display():
-            if rect.Contains(point):
-                return name
-        return None
+        return self.geometry.hit_test_handle(self.crop_rect, point)
 
     def _get_aspect_ratio(self):
         if not self.fixed_aspect:
@@ -200,235 +189,27 @@ class ImagePanel(wx.Panel):
         except Exception:
             return None
 
-    def _ensure_within_display(self, rect):
-        if rect is None:
-            return wx.Rect()
-        rect = wx.Rect(rect)
-        if self.display_width <= 0 or self.display_height <= 0:
-            return wx.Rect()
-        if rect.width > self.display_width:
-            rect.width = self.display_width
-        if rect.height > self.display_height:
-            rect.height = self.display_height
-        if rect.x < 0:
-            rect.x = 0
-        if rect.y < 0:
-            rect.y = 0
-        if rect.Right > self.display_width:
-            rect.x = self.display_width - rect.width
-        if rect.Bottom > self.display_height:
-            rect.y = self.display_height - rect.height
-        rect.width = max(self.MIN_CROP_SIZE, rect.width)
-        rect.height = max(self.MIN_CROP_SIZE, rect.height)
-        rect.x = max(0, min(rect.x, self.display_width - rect.width))
-        rect.y = max(0, min(rect.y, self.display_height - rect.height))
-        return rect
-
-    def _ensure_min_size(self, rect):
-        rect = self._ensure_within_display(rect)
-        if rect.width < self.MIN_CROP_SIZE:
-            rect.width = self.MIN_CROP_SIZE
-        if rect.height < self.MIN_CROP_SIZE:
-            rect.height = self.MIN_CROP_SIZE
-        return self._ensure_within_display(rect)
-
-    def _create_rect_with_ratio(self, anchor, current, ratio):
-        dx = current.x - anchor.x
-        dy = current.y - anchor.y
-        abs_dx = abs(dx)
-        abs_dy = abs(dy)
-        if abs_dx == 0 and abs_dy == 0:
-            return wx.Rect(anchor.x, anchor.y, 0, 0)
-        if abs_dy == 0:
-            abs_dy = int(round(abs_dx / ratio))
-        if abs_dx == 0:
-            abs_dx = int(round(abs_dy * ratio))
-        current_ratio = abs_dx / abs_dy if abs_dy else ratio
-        if current_ratio > ratio:
-            abs_dx = int(round(abs_dy * ratio))
-        else:
-            abs_dy = int(round(abs_dx / ratio))
-        x2 = anchor.x + (abs_dx if dx >= 0 else -abs_dx)
-        y2 = anchor.y + (abs_dy if dy >= 0 else -abs_dy)
-        left = min(anchor.x, x2)
-        top = min(anchor.y, y2)
-        rect = wx.Rect(left, top, abs(x2 - anchor.x), abs(y2 - anchor.y))
-        return self._ensure_within_display(rect)
-
-    def _create_rect(self, anchor, current):
-        anchor = self._clamp_display_point(anchor)
-        current = self._clamp_display_point(current)
-        ratio = self._get_aspect_ratio()
-        if ratio:
-            rect = self._create_rect_with_ratio(anchor, current, ratio)
-        else:
-            left = min(anchor.x, current.x)
-            top = min(anchor.y, current.y)
-            width = abs(current.x - anchor.x)
-            height = abs(current.y - anchor.y)
-            rect = wx.Rect(left, top, width, height)
-        return self._ensure_min_size(rect)
-
     def _rect_from_crop(self):
         if not self.crop_rect:
             return None
-        x, y, w, h = self.crop_rect
-        return wx.Rect(int(round(x)), int(round(y)), int(round(w)), int(round(h)))
+        return Rect.from_tuple(self.crop_rect)
 
     def _update_selection_creation(self, anchor, current):
-        rect = self._create_rect(anchor, current)
-        self.crop_rect = (rect.x, rect.y, rect.width, rect.height)
+        rect = self.geometry.create(anchor, current, self._get_aspect_ratio())
+        self.crop_rect = rect.as_tuple()
 
     def _update_selection_move(self, dx, dy):
         if not self.original_rect:
             return
-        rect = wx.Rect(self.original_rect)
-        rect.x += dx
-        rect.y += dy
-        rect = self._ensure_min_size(rect)
-        self.crop_rect = (rect.x, rect.y, rect.width, rect.height)
-
-    def _rect_from_horizontal_anchor(self, anchor_x, width, origin, to_left, ratio):
-        width = max(self.MIN_CROP_SIZE, min(width, self.display_width))
-        height = max(self.MIN_CROP_SIZE, int(round(width / ratio)))
-        if height > self.display_height:
-            height = self.display_height
-            width = max(self.MIN_CROP_SIZE, int(round(height * ratio)))
-        center_y = origin.y + origin.height / 2
-        top = int(round(center_y - height / 2))
-        top = max(0, min(top, self.display_height - height))
-        bottom = top + height
-        if to_left:
-            right = min(anchor_x, self.display_width)
-            left = max(0, right - width)
-        else:
-            left = max(0, anchor_x)
-            right = min(self.display_width, left + width)
-            left = right - width
-        return wx.Rect(int(left), int(top), int(right - left), int(bottom - top))
-
-    def _rect_from_vertical_anchor(self, anchor_y, height, origin, to_top, ratio):
-        height = max(self.MIN_CROP_SIZE, min(height, self.display_height))
-        width = max(self.MIN_CROP_SIZE, int(round(height * ratio)))
-        if width > self.display_width:
-            width = self.display_width
-            height = max(self.MIN_CROP_SIZE, int(round(width / ratio)))
-        center_x = origin.x + origin.width / 2
-        left = int(round(center_x - width / 2))
-        left = max(0, min(left, self.display_width - width))
-        right = left + width
-        if to_top:
-            bottom = min(anchor_y, self.display_height)
-            top = max(0, bottom - height)
-        else:
-            top = max(0, anchor_y)
-            bottom = min(self.display_height, top + height)
-            top = bottom - height
-        return wx.Rect(int(left), int(top), int(right - left), int(bottom - top))
-
-    def _resize_corner_with_ratio(self, point, handle, origin, ratio):
-        if handle == "top_left":
-            anchor = wx.Point(origin.Right, origin.Bottom)
-            horizontal = -1
-            vertical = -1
-        elif handle == "top_right":
-            anchor = wx.Point(origin.x, origin.Bottom)
-            horizontal = 1
-            vertical = -1
-        elif handle == "bottom_left":
-            anchor = wx.Point(origin.Right, origin.y)
-            horizontal = -1
-            vertical = 1
-        else:
-            anchor = wx.Point(origin.x, origin.y)
-            horizontal = 1
-            vertical = 1
-        dx = (point.x - anchor.x) * horizontal
-        dy = (point.y - anchor.y) * vertical
-        dx = max(self.MIN_CROP_SIZE, min(abs(dx), self.display_width))
-        dy = max(self.MIN_CROP_SIZE, min(abs(dy), self.display_height))
-        if dy == 0:
-            dy = int(round(dx / ratio))
-        if dx == 0:
-            dx = int(round(dy * ratio))
-        width = dx
-        height = int(round(width / ratio))
-        if height > dy:
-            height = dy
-            width = int(round(height * ratio))
-        height = max(self.MIN_CROP_SIZE, height)
-        width = max(self.MIN_CROP_SIZE, width)
-        if horizontal < 0:
-            left = anchor.x - width
-            right = anchor.x
-        else:
-            left = anchor.x
-            right = anchor.x + width
-        if vertical < 0:
-            top = anchor.y - height
-            bottom = anchor.y
-        else:
-            top = anchor.y
-            bottom = anchor.y + height
-        rect = wx.Rect(int(left), int(top), int(right - left), int(bottom - top))
-        return self._ensure_min_size(rect)
-
-    def _resize_with_ratio(self, point, handle, ratio):
-        if not self.original_rect:
-            return wx.Rect()
-        origin = wx.Rect(self.original_rect)
-        if handle == "left":
-            anchor_x = origin.Right
-            width = max(self.MIN_CROP_SIZE, min(anchor_x - point.x, anchor_x))
-            rect = self._rect_from_horizontal_anchor(anchor_x, width, origin, to_left=True, ratio=ratio)
-        elif handle == "right":
-            anchor_x = origin.x
-            width = max(self.MIN_CROP_SIZE, min(point.x - anchor_x, self.display_width - anchor_x))
-            rect = self._rect_from_horizontal_anchor(anchor_x, width, origin, to_left=False, ratio=ratio)
-        elif handle == "top":
-            anchor_y = origin.Bottom
-            height = max(self.MIN_CROP_SIZE, min(anchor_y - point.y, anchor_y))
-            rect = self._rect_from_vertical_anchor(anchor_y, height, origin, to_top=True, ratio=ratio)
-        elif handle == "bottom":
-            anchor_y = origin.y
-            height = max(self.MIN_CROP_SIZE, min(point.y - anchor_y, self.display_height - anchor_y))
-            rect = self._rect_from_vertical_anchor(anchor_y, height, origin, to_top=False, ratio=ratio)
-        else:
-            rect = self._resize_corner_with_ratio(point, handle, origin, ratio)
-        return self._ensure_min_size(rect)
-
-    def _resize_free(self, point, handle):
-        rect = wx.Rect(self.original_rect)
-        left = rect.x
-        top = rect.y
-        right = rect.Right
-        bottom = rect.Bottom
-        if "left" in handle:
-            left = min(point.x, right - self.MIN_CROP_SIZE)
-        if "right" in handle:
-            right = max(point.x, left + self.MIN_CROP_SIZE)
-        if "top" in handle:
-            top = min(point.y, bottom - self.MIN_CROP_SIZE)
-        if "bottom" in handle:
-            bottom = max(point.y, top + self.MIN_CROP_SIZE)
-        left = max(0, min(left, self.display_width))
-        right = max(0, min(right, self.display_width))
-        top = max(0, min(top, self.display_height))
-        bottom = max(0, min(bottom, self.display_height))
-        width = max(self.MIN_CROP_SIZE, right - left)
-        height = max(self.MIN_CROP_SIZE, bottom - top)
-        return wx.Rect(int(left), int(top), int(width), int(height))
+        rect = self.geometry.move(self.original_rect, dx, dy)
+        self.crop_rect = rect.as_tuple()
 
     def _update_selection_resize(self, point):
         if not self.original_rect or not self.drag_handle:
             return
         ratio = self._get_aspect_ratio() if self.fixed_aspect else None
-        if ratio:
-            rect = self._resize_with_ratio(point, self.drag_handle, ratio)
-        else:
-            rect = self._resize_free(point, self.drag_handle)
-        rect = self._ensure_min_size(rect)
-        self.crop_rect = (rect.x, rect.y, rect.width, rect.height)
+        rect = self.geometry.resize(self.original_rect, point, self.drag_handle, ratio)
+        self.crop_rect = rect.as_tuple()
 
     def _update_cursor(self, display_point):
         handle = self._hit_test_handle(display_point)
@@ -455,46 +236,26 @@ class ImagePanel(wx.Panel):
         ratio = self._get_aspect_ratio()
         if not ratio:
             return
-        x, y, w, h = self.crop_rect
-        center_x = x + w / 2
-        center_y = y + h / 2
-        width = w
-        height = h
-        desired_height = int(round(width / ratio))
-        desired_width = int(round(height * ratio))
-        if desired_height <= self.display_height:
-            height = desired_height
-        if height <= 0:
-            height = self.MIN_CROP_SIZE
-        width = int(round(height * ratio))
-        if width > self.display_width:
-            width = self.display_width
-            height = int(round(width / ratio))
-        if height > self.display_height:
-            height = self.display_height
-            width = int(round(height * ratio))
-        width = max(self.MIN_CROP_SIZE, width)
-        height = max(self.MIN_CROP_SIZE, height)
-        left = int(round(center_x - width / 2))
-        top = int(round(center_y - height / 2))
-        rect = self._ensure_min_size(wx.Rect(left, top, width, height))
-        self.crop_rect = (rect.x, rect.y, rect.width, rect.height)
+        rect = self.geometry.apply_aspect(self.crop_rect, ratio)
+        self.crop_rect = rect.as_tuple()
 
     def SetImage(self, pil_image, file_name=""):
         # ディスクから読み込むときはクリップボードフラグをリセット
-        self.from_clipboard = False
-        self.original_image = pil_image.copy()
-        self.current_image = pil_image.copy()
-        self.crop_history = [self.current_image.copy()]
+        self.session.set_image(pil_image, file_name=file_name)
+        self.queue_position = None
+        self._reset_for_new_image()
+
+    def SetSource(self, source, queue_position=None):
+        """trim_loader.ImageSourceを表示する。原寸のデコードはトリミングや保存まで遅らせる。"""
+        self.session.set_source(source)
+        self.queue_position = queue_position
+        self._reset_for_new_image()
+
+    def _reset_for_new_image(self):
         self.mode = "idle"
         self.drag_handle = None
         self.original_rect = None
-        self.drag_start = wx.Point()
-        # 新しい画像を読み込んだあとに回転の基準をリセット
-        self.rotation_base_image = self.current_image.copy()
-        self.rotation_angle_total = 0.0
-        self.file_name = os.path.basename(file_name)
-        self.file_dir = os.path.dirname(file_name)
+        self.drag_start = (0, 0)
         self.UpdateDisplayGeometry()
         self.InitCropRect()
         self.UpdateTitle()
@@ -502,47 +263,117 @@ class ImagePanel(wx.Panel):
         self.Refresh()
 
     def UpdateTitle(self):
-        if self.file_name and self.current_image:
-            w, h = self.current_image.size
+        if self.file_name and self.session.has_image:
+            w, h = self.session.size
             title = f"{self.file_name} ({w}x{h})"
+            if self.queue_position:
+                title += " [%d/%d]" % self.queue_position
             top_frame = self.GetTopLevelParent()
             if top_frame:
                 top_frame.SetTitle(title)
 
+    def _paint_stage(self, name):
+        """計測中なら描画の段階nameの所要時間を記録するコンテキストを返す。"""
+        if self.paint_stats is None:
+            return nullcontext()
+        return self.paint_stats.stage(name)
+
+    def _content_scale(self):
+        """ウィンドウの論理ピクセルあたりの物理ピクセル数。ビットマップに倍率を設定できない環境では1。"""
+        scale = self.GetContentScaleFactor()
+        if scale <= 1 or not hasattr(wx.Bitmap, "SetScaleFactor"):
+            return 1.0
+        return scale
+
+    def _build_layer_bitmap(self, display_image, scale=1.0):
+        """
+        表示サイズに縮小した画像にグリッドを焼き込んだビットマップを作る。
+        高DPIの画面では物理ピクセルの大きさで作り、ビットマップに倍率を設定して論理サイズで描画させる。
+        """
+        width = max(1, int(round(self.display_width * scale)))
+        height = max(1, int(round(self.display_height * scale)))
+        with self._paint_stage("scale"):
+            if self._pyramid is None or self._pyramid.image is not display_image:
+                self._pyramid = DisplayPyramid(display_image)
+            # インタラクティブな再描画にはバイリニア補間を使用し、表示サイズに近い段から縮小する
+            # RGBはそのまま、透明度のある画像は市松模様に重ねた不透明なRGBAで受け取る
+            img_tmp = self._pyramid.get_display((width, height), Image.BILINEAR)
+        with self._paint_stage("tobytes"):
+            buf = img_tmp.tobytes()
+        with self._paint_stage("from_buffer"):
+            if img_tmp.mode == "RGBA":
+                image_bitmap = wx.Bitmap.FromBufferRGBA(width, height, buf)
+            else:
+                image_bitmap = wx.Bitmap.FromBuffer(width, height, buf)
+            del buf
+            # 右端・下端のグリッド線は画像の1画素外側に引くので、1画素大きく作る
+            layer = wx.Bitmap(width + 1, height + 1)
+            mdc = wx.MemoryDC(layer)
+            mdc.SetBackground(wx.Brush(BACK_GROUND_COLOR))
+            mdc.Clear()
+            mdc.DrawBitmap(image_bitmap, 0, 0)
+        # ガイドラインのグリッドを描画(物理ピクセルの座標で描き、線幅も倍率に合わせる)
+        with self._paint_stage("grid"):
+            gc = wx.GraphicsContext.Create(mdc)
+            if gc:
+                pen = wx.Pen(wx.Colour(255,255,255), width=max(1, int(round(scale))), style=wx.PENSTYLE_DOT)
+                gc.SetPen(pen)
+                for i in range(LINES+1):
+                    yy = int(height * i / LINES)
+                    gc.StrokeLine(0, yy, width, yy)
+                    xx = int(width * i / LINES)
+                    gc.StrokeLine(xx, 0, xx, height)
+                # MemoryDCより先にGraphicsContextを破棄して描画を確定させる
+                del gc
+            mdc.SelectObject(wx.NullBitmap)
+        if scale != 1:
+            layer.SetScaleFactor(scale)
+        return layer
+
     def OnPaint(self, event):
         dc = wx.BufferedPaintDC(self)
+        # 再描画が必要な範囲だけを描く
+        update_box = self.GetUpdateRegion().GetBox()
+        if not update_box.IsEmpty():
+            dc.SetClippingRegion(update_box)
         dc.Clear()
-        if self.current_image:
-            pos_x = self.display_offset_x
-            pos_y = self.display_offset_y
-            # 画像やサイズが変わったときにキャッシュを作り直す
-            if (self._cached_bitmap is None or
-                self._cached_size != (self.display_width, self.display_height) or
-                self._cached_image_id != id(self.current_image)):
-                # インタラクティブな再描画にはバイリニア補間を使用
-                img_tmp = self.current_image.resize((self.display_width, self.display_height), Image.BILINEAR)
-                buf = img_tmp.convert("RGB").tobytes()
-                self._cached_bitmap = wx.Bitmap.FromBuffer(self.display_width, self.display_height, buf)
-                self._cached_size = (self.display_width, self.display_height)
-                self._cached_image_id = id(self.current_image)
+        if self.paint_stats is not None:
+            self.paint_stats.begin_frame()
+        if self.session.has_image:
+            self._paint_image(dc, update_box)
+        if self.paint_stats is not None:
+            # HUDの描画は計測に含めない
+            self.paint_stats.end_frame()
+            if self.show_paint_hud:
+                self._draw_paint_hud(dc)
+
+    def _paint_image(self, dc, update_box):
+        pos_x = self.display_offset_x
+        pos_y = self.display_offset_y
+        # 原寸をまだデコードしていない場合は縮小プレビューを表示
+        display_image = self.session.display_image
+        # 画像やサイズ、画面の倍率が変わったときだけ画像とグリッドのビットマップを作り直す
+        scale = self._content_scale()
+        cache_size = (self.display_width, self.display_height, scale)
+        if (self._cached_bitmap is None or
+            self._cached_size != cache_size or
+            self._cached_image is not display_image):
+            self._cached_bitmap = self._build_layer_bitmap(display_image, scale)
+            self._cached_size = cache_size
+            self._cached_image = display_image
+        with self._paint_stage("blit"):
             dc.DrawBitmap(self._cached_bitmap, pos_x, pos_y)
-            # ガイドラインのグリッドを描画
-            gc = wx.GraphicsContext.Create(dc)
-            if gc:
-                pen = wx.Pen(wx.Colour(255,255,255), width=1, style=wx.PENSTYLE_DOT)
-                gc.SetPen(pen)
-                for i in range(LINES+1):
-                    yy = pos_y + int(self.display_height * i / LINES)
-                    gc.StrokeLine(pos_x, yy, pos_x + self.display_width, yy)
-                    xx = pos_x + int(self.display_width * i / LINES)
-                    gc.StrokeLine(xx, pos_y, xx, pos_y + self.display_height)
-            # トリミング範囲のオーバーレイを描画
-            if self.crop_rect:
-                crop_x = self.crop_rect[0] + pos_x
-                crop_y = self.crop_rect[1] + pos_y
-                crop_w = self.crop_rect[2]
-                crop_h = self.crop_rect[3]
+        # トリミング範囲のオーバーレイを描画
+        if self.crop_rect:
+            crop_x = self.crop_rect[0] + pos_x
+            crop_y = self.crop_rect[1] + pos_y
+            crop_w = self.crop_rect[2]
+            crop_h = self.crop_rect[3]
+            with self._paint_stage("overlay"):
+                gc = wx.GraphicsContext.Create(dc)
                 if gc:
+                    if not update_box.IsEmpty():
+                        gc.Clip(update_box.x, update_box.y, update_box.width, update_box.height)
                     overlay_path = gc.CreatePath()
                     panel_w, panel_h = self.GetClientSize()
                     overlay_path.AddRectangle(0, 0, panel_w, panel_h)
@@ -550,59 +381,147 @@ class ImagePanel(wx.Panel):
                     rect_path.AddRectangle(crop_x, crop_y, crop_w, crop_h)
                     overlay_path.AddPath(rect_path)
                     overlay_path.CloseSubpath()
-                    gc.SetBrush(wx.Brush(wx.Colour(0, 0, 0, 100), wx.BRUSHSTYLE_SOLID))     # 100 = overlay alpha
+                    gc.SetBrush(self._overlay_brush)
                     gc.FillPath(overlay_path, wx.ODDEVEN_RULE)
-                    gc.SetPen(wx.Pen(wx.Colour(255, 0, 0), 1, wx.PENSTYLE_SOLID))
+                    gc.SetPen(self._frame_pen)
                     gc.StrokePath(rect_path)
+                    del gc
+            with self._paint_stage("handles"):
                 try:
                     target_dc = wx.GCDC(dc)
                 except Exception:
                     target_dc = dc
-                target_dc.SetPen(wx.Pen(wx.Colour(255, 0, 0), 1))
-                target_dc.SetBrush(wx.Brush(wx.Colour(255, 255, 255)))
+                target_dc.SetPen(self._frame_pen)
+                target_dc.SetBrush(self._handle_brush)
                 for _, handle_rect in self._iter_handle_rects_panel():
                     target_dc.DrawRectangle(handle_rect)
+                del target_dc
+
+    def _draw_paint_hud(self, dc):
+        """描画時間の統計をパネル左上に表示する。"""
+        lines = self.paint_stats.format_lines() or ["(no frames)"]
+        dc.DestroyClippingRegion()
+        dc.SetFont(wx.Font(9, wx.FONTFAMILY_TELETYPE, wx.FONTSTYLE_NORMAL, wx.FONTWEIGHT_NORMAL))
+        line_w, line_h = 0, 0
+        for line in lines:
+            w, h = dc.GetTextExtent(line)
+            line_w = max(line_w, w)
+            line_h = max(line_h, h)
+        padding = 4
+        self._hud_rect = wx.Rect(0, 0, line_w + 2 * padding, line_h * len(lines) + 2 * padding)
+        dc.SetPen(wx.TRANSPARENT_PEN)
+        dc.SetBrush(wx.Brush(wx.Colour(0, 0, 0)))
+        dc.DrawRectangle(self._hud_rect)
+        dc.SetTextForeground(wx.Colour(0, 255, 0))
+        for i, line in enumerate(lines):
+            dc.DrawText(line, padding, padding + i * line_h)
+
+    def TogglePaintStats(self):
+        """描画時間のHUDの表示を切り替える。計測していなければ計測も始める。"""
+        if self.paint_stats is None:
+            self.paint_stats = FrameStats()
+        self.show_paint_hud = not self.show_paint_hud
+        self._hud_rect = None
+        self.Refresh(False)
+
+    def DumpPaintStats(self, directory):
+        """描画時間の統計をdirectoryにJSONで書き出し、そのパスを返す。計測していなければNone。"""
+        if self.paint_stats is None:
+            return None
+        os.makedirs(directory, exist_ok=True)
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        return self.paint_stats.dump(os.path.join(directory, f"paint_stats_{timestamp}.json"))
+
+    def _crop_rect_panel_bounds(self, rect_tuple):
+        """トリミング枠とハンドルが描かれるパネル座標の範囲。"""
+        if not rect_tuple:
+            return None
+        margin = self.HANDLE_SIZE // 2 + 2
+        x, y, w, h = rect_tuple
+        return wx.Rect(int(x) + self.display_offset_x - margin, int(y) + self.display_offset_y - margin,
+                       int(w) + 2 * margin + 1, int(h) + 2 * margin + 1)
+
+    def _refresh_crop_change(self, old_rect):
+        """
+        トリミング範囲の変更前後を合わせた範囲だけを再描画する。
+        暗くするオーバーレイが変わるのは変更前後の枠の内側だけなので、それ以外は描き直さなくてよい。
+        """
+        old_bounds = self._crop_rect_panel_bounds(old_rect)
+        new_bounds = self._crop_rect_panel_bounds(self.crop_rect)
+        if old_bounds is None or new_bounds is None:
+            self.Refresh(False)
+            return
+        self.RefreshRect(old_bounds.Union(new_bounds), eraseBackground=False)
+        if self.show_paint_hud and self._hud_rect is not None:
+            # 部分再描画のたびにHUDの数値も更新する
+            self.RefreshRect(self._hud_rect, eraseBackground=False)
 
     def OnLeftUp(self, event):
         previous_mode = self.mode
         if self.HasCapture():
             self.ReleaseMouse()
+        self._drag_timer.Stop()
+        self._pending_drag_point = None
+        if previous_mode != "idle" and self._drag_moved:
+            # まとめて間引いた移動があっても、離した位置は正確に反映する
+            self._apply_drag_point(self._clamp_display_point(self._event_to_display_point(event)))
+        self._drag_moved = False
         self.mode = "idle"
         self.drag_handle = None
         self.original_rect = None
-        self.drag_start = wx.Point()
+        self.drag_start = (0, 0)
         if previous_mode == "creating" and self.crop_rect:
-            rect = self._ensure_min_size(self._rect_from_crop())
-            self.crop_rect = (rect.x, rect.y, rect.width, rect.height)
+            old_rect = self.crop_rect
+            rect = self.geometry.ensure_min_size(self._rect_from_crop())
+            self.crop_rect = rect.as_tuple()
+            self._refresh_crop_change(old_rect)
         self._update_cursor(self._event_to_display_point(event))
         event.Skip()
 
     def OnMouseMove(self, event):
-        if not self.current_image:
+        if not self.session.has_image:
             return
         display_point = self._event_to_display_point(event)
         if event.Dragging() and event.LeftIsDown() and self.mode != "idle":
-            point = self._clamp_display_point(display_point)
-            if self.mode == "creating":
-                self._update_selection_creation(self.drag_start, point)
-            elif self.mode == "moving" and self.original_rect:
-                dx = point.x - self.drag_start.x
-                dy = point.y - self.drag_start.y
-                self._update_selection_move(dx, dy)
-            elif self.mode == "resizing" and self.original_rect:
-                self._update_selection_resize(point)
-            self.Refresh(False)
+            # ここでは位置を覚えるだけにして、反映と再描画はOnDragTimerで行う
+            self._pending_drag_point = self._clamp_display_point(display_point)
+            self._drag_moved = True
+            if not self._drag_timer.IsRunning():
+                self._drag_timer.Start(max(1, int(1000 / DRAG_FRAME_RATE)))
             return
         self._update_cursor(display_point)
 
+    def OnDragTimer(self, event):
+        point = self._pending_drag_point
+        if point is None:
+            # 動きがなければ次の移動まで止める
+            self._drag_timer.Stop()
+            return
+        self._pending_drag_point = None
+        self._apply_drag_point(point)
+
+    def _apply_drag_point(self, point):
+        """ドラッグ中の位置をトリミング範囲に反映し、変わった範囲だけを再描画する。"""
+        old_rect = self.crop_rect
+        if self.mode == "creating":
+            self._update_selection_creation(self.drag_start, point)
+        elif self.mode == "moving" and self.original_rect:
+            dx = point[0] - self.drag_start[0]
+            dy = point[1] - self.drag_start[1]
+            self._update_selection_move(dx, dy)
+        elif self.mode == "resizing" and self.original_rect:
+            self._update_selection_resize(point)
+        self._refresh_crop_change(old_rect)
+
     def OnMouseLeave(self, event):
         if self.mode == "idle":
             self.SetCursor(wx.Cursor(wx.CURSOR_ARROW))
 
     def OnLeftDown(self, event):
-        if not self.current_image:
+        if not self.session.has_image:
             return
         display_point = self._event_to_display_point(event)
+        old_rect = self.crop_rect
         handle = self._hit_test_handle(display_point)
         if handle and self.crop_rect:
             self.mode = "resizing"
@@ -620,7 +539,7 @@ class ImagePanel(wx.Panel):
             anchor = self._clamp_display_point(display_point)
             self.drag_start = anchor
             self.original_rect = None
-            self.crop_rect = (anchor.x, anchor.y, 0, 0)
+            self.crop_rect = (anchor[0], anchor[1], 0, 0)
         else:
             self.mode = "idle"
             self.drag_handle = None
@@ -628,108 +547,90 @@ class ImagePanel(wx.Panel):
             return
         if not self.HasCapture():
             self.CaptureMouse()
-        self.Refresh(False)
+        self._refresh_crop_change(old_rect)
 
     def RotateImage(self, delta):
-        if self.rotation_base_image:
-            # 累積回転角を0〜360度の範囲に保つ
-            self.rotation_angle_total = (self.rotation_angle_total + delta) % 360
-            rotated = self.rotation_base_image.rotate(self.rotation_angle_total, expand=True, resample=Image.BICUBIC)
-            self.current_image = rotated
-            if len(self.crop_history) >= self.max_crop_history:
-                self.crop_history.pop(0)
-            self.crop_history.append(self.current_image.copy())
+        if self.session.rotate(delta):
             self.UpdateDisplayGeometry()
             self.UpdateTitle()
             self.Refresh()
 
-    def CropImage(self):
-        if self.crop_rect and self.current_image:
-            pos_x = self.display_offset_x
-            pos_y = self.display_offset_y
-            disp_w = self.display_width
-            disp_h = self.display_height
-            img_w, img_h = self.current_image.size
-            crop_x = max(0, self.crop_rect[0])
-            crop_y = max(0, self.crop_rect[1])
-            if disp_w == 0 or disp_h == 0:
-                return
-            scale_x = img_w / disp_w
-            scale_y = img_h / disp_h
-            rect_w = self.crop_rect[2]
-            rect_h = self.crop_rect[3]
-            # 表示座標をround()を使って画像座標へ変換
-            x = round(crop_x * scale_x)
-            y = round(crop_y * scale_y)
-            w = round(rect_w * scale_x)
-            h = round(rect_h * scale_y)
-            if w == 0 or h == 0:
-                return
-            cropped = self.current_image.crop((x, y, x + w, y + h))
-            if len(self.crop_history) >= self.max_crop_history:
-                self.crop_history.pop(0)
-            self.current_image = cropped
-            self.crop_history.append(self.current_image.copy())
+    def StraightenImage(self):
+        """傾きを自動で補正し、回転角を返す。求められなければNoneを返す。"""
+        angle = self.session.straighten()
+        if angle is not None:
             self.UpdateDisplayGeometry()
-            self.InitCropRect()
             self.UpdateTitle()
             self.Refresh()
-            # トリミング後に回転の基準をリセット
-            self.rotation_base_image = self.current_image.copy()
-            self.rotation_angle_total = 0.0
+        return angle
+
+    def CropImage(self):
+        if self.crop_rect and self.session.has_image:
+            # 原寸サイズを基準に変換するので、プレビュー表示中でも原寸の座標に正確に戻る
+            box = display_rect_to_box(self.crop_rect, (self.display_width, self.display_height), self.session.size)
+            if box is None:
+                return
+            # トリミング後の回転の基準はTrimSession側でリセットされる
+            self.session.crop(box)
+            self._after_image_changed()
+
+    def AutoTrimSelection(self):
+        """背景色の余白を除いた内容の範囲をトリミング範囲にする。範囲が見つからなければFalseを返す。"""
+        if not self.session.has_image:
+            return False
+        box = self.session.content_box()
+        if box is None:
+            return False
+        old_rect = self.crop_rect
+        rect = box_to_display_rect(box, (self.display_width, self.display_height), self.session.size)
+        self.crop_rect = self.geometry.ensure_min_size(Rect(*rect)).as_tuple()
+        self._refresh_crop_change(old_rect)
+        return True
+
+    def CropResizeImage(self, target_size):
+        """トリミングと長辺target_sizeへの縮小を1回で行う。"""
+        if self.crop_rect and self.session.has_image:
+            box = display_rect_to_box(self.crop_rect, (self.display_width, self.display_height), self.session.size)
+            if box is None:
+                return
+            self.session.crop_resize(box, target_size)
+            self._after_image_changed()
 
     def RevertCrop(self):
-        if len(self.crop_history) > 1:
-            self.crop_history.pop()
-            self.current_image = self.crop_history[-1].copy()
-            self.UpdateDisplayGeometry()
-            # 現在のファイル名とサイズでタイトルを更新
-            self.InitCropRect()
-            self.UpdateTitle()
-            self.Refresh()
-            # 更新された表示サイズを反映させるために再描画
-            self.rotation_base_image = self.current_image.copy()
-            self.rotation_angle_total = 0.0
+        if self.session.revert():
+            self._after_image_changed()
 
     def ResizeImage(self, target_size):
-        if self.current_image:
-            w, h = self.current_image.size
-            long_side = max(w, h)
-            if long_side > target_size:
-                ratio = target_size / long_side
-                new_w = int(w * ratio)
-                new_h = int(h * ratio)
-                resized = self.current_image.resize((new_w, new_h), Image.LANCZOS)
-                if len(self.crop_history) >= self.max_crop_history:
-                    self.crop_history.pop(0)
-                self.current_image = resized
-                self.crop_history.append(self.current_image.copy())
-                self.UpdateDisplayGeometry()
-                self.InitCropRect()
-                self.UpdateTitle()
-                self.Refresh()
-                # 画像サイズ変更後に回転の基準をリセット
-                self.rotation_base_image = self.current_image.copy()
-                self.rotation_angle_total = 0.0
-
-    def SaveImage(self, jpeg_quality):
-        if self.current_image:
-            if self.from_clipboard:
-                # クリップボードからの画像はPNGでタイムスタンプ付き保存
-                timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-                file_name = f"clipboard_{timestamp}.png"
-                save_dir = resolve_clipboard_save_dir()
-                os.makedirs(save_dir, exist_ok=True)
-                save_path = os.path.join(save_dir, file_name)
-                self.current_image.save(save_path, "PNG")
-            elif self.file_name:
-                name, ext = os.path.splitext(self.file_name)
-                new_name = name + "_trm" + ext
-                save_path = os.path.join(self.file_dir, new_name)
-                params = {}
-                if ext.lower() in [".jpg", ".jpeg"]:
-                    params["quality"] = jpeg_quality
-                self.current_image.save(save_path, **params)
+        if self.session.resize(target_size):
+            self._after_image_changed()
+
+    def _after_image_changed(self):
+        # 画像が変わったら表示寸法・トリミング範囲・タイトルを更新して再描画
+        self.UpdateDisplayGeometry()
+        self.InitCropRect()
+        self.UpdateTitle()
+        self.Refresh()
+
+    def SaveImage(self, jpeg_quality, lossless=False, max_bytes=None):
+        # エンコードと書き込みはワーカースレッドで行い、UIを止めない
+        job = self.session.prepare_save(jpeg_quality, clipboard_dir=resolve_clipboard_save_dir(), lossless=lossless,
+                                        max_bytes=max_bytes)
+        if job is None:
+            return None
+        return self.saver.submit(job)
+
+    def ExportImages(self, profiles):
+        # 縮小とエンコードは保存と同じワーカースレッドから行い、UIを止めない
+        job = prepare_export(self.session, profiles, clipboard_dir=resolve_clipboard_save_dir())
+        if job is None:
+            return None
+        return self.saver.submit(job)
+
+    def _on_save_done(self, future):
+        if isinstance(future.exception(), TargetSizeError):
+            wx.MessageBox("最も低い品質でも目標サイズに収まりません。", "エラー", wx.OK | wx.ICON_ERROR)
+        elif future.exception() is not None:
+            wx.MessageBox("画像の保存に失敗しました。", "エラー", wx.OK | wx.ICON_ERROR)
 
     def InitCropRect(self):
         disp_w = self.display_width
@@ -756,14 +657,14 @@ class ImagePanel(wx.Panel):
         center_y = disp_h / 2
         new_x = center_x - rect_w / 2
         new_y = center_y - rect_h / 2
-        rect = wx.Rect(int(round(new_x)), int(round(new_y)), int(round(rect_w)), int(round(rect_h)))
-        rect = self._ensure_min_size(rect)
-        self.crop_rect = (rect.x, rect.y, rect.width, rect.height)
+        rect = Rect(int(round(new_x)), int(round(new_y)), int(round(rect_w)), int(round(rect_h)))
+        rect = self.geometry.ensure_min_size(rect)
+        self.crop_rect = rect.as_tuple()
         self.ApplyAspectRatioToSelection()
         self.mode = "idle"
         self.drag_handle = None
         self.original_rect = None
-        self.drag_start = wx.Point()
+        self.drag_start = (0, 0)
 
 class ControlPanel(wx.Panel):
     def __init__(self, parent, image_panel):
@@ -795,6 +696,10 @@ class ControlPanel(wx.Panel):
         hbox_rot_btn.Add(btn_rot_left, proportion=1, flag=wx.RIGHT, border=5)
         hbox_rot_btn.Add(btn_rot_right, proportion=1)
         vbox.Add(hbox_rot_btn, flag=wx.EXPAND | wx.ALL, border=5)
+        btn_straighten = wx.Button(self, label="傾き自動補正", size=(100,45))
+        btn_straighten.SetFont(font)
+        btn_straighten.Bind(wx.EVT_BUTTON, self.OnStraighten)
+        vbox.Add(btn_straighten, flag=wx.EXPAND | wx.ALL, border=5)
         vbox.Add((0, 50), 0, wx.EXPAND)
         # 縦横比
         hbox_crop = wx.BoxSizer(wx.HORIZONTAL)
@@ -810,6 +715,10 @@ class ControlPanel(wx.Panel):
         self.tc_crop.Bind(wx.EVT_TEXT_ENTER, self.OnAspectEnter)
         hbox_crop.Add(self.tc_crop, proportion=1)
         vbox.Add(hbox_crop, flag=wx.EXPAND | wx.ALL, border=5)
+        btn_auto_trim = wx.Button(self, label="余白を自動選択", size=(100,45))
+        btn_auto_trim.SetFont(font)
+        btn_auto_trim.Bind(wx.EVT_BUTTON, self.OnAutoTrim)
+        vbox.Add(btn_auto_trim, flag=wx.EXPAND | wx.ALL, border=5)
         btn_crop = wx.Button(self, label="トリミング", size=(100,45))
         btn_crop.SetFont(font)
         btn_crop.Bind(wx.EVT_BUTTON, self.OnCrop)
@@ -832,6 +741,10 @@ class ControlPanel(wx.Panel):
         btn_resize.SetFont(font)
         btn_resize.Bind(wx.EVT_BUTTON, self.OnResizeImage)
         vbox.Add(btn_resize, flag=wx.EXPAND | wx.ALL, border=5)
+        btn_crop_resize = wx.Button(self, label="トリミング+サイズ変更", size=(100,45))
+        btn_crop_resize.SetFont(font)
+        btn_crop_resize.Bind(wx.EVT_BUTTON, self.OnCropResize)
+        vbox.Add(btn_crop_resize, flag=wx.EXPAND | wx.ALL, border=5)
         vbox.Add((0, 50), 0, wx.EXPAND)
         # 保存
         hbox_quality = wx.BoxSizer(wx.HORIZONTAL)
@@ -842,10 +755,43 @@ class ControlPanel(wx.Panel):
         hbox_quality.Add(st_quality, flag=wx.RIGHT, border=5)
         hbox_quality.Add(self.tc_quality, proportion=1)
         vbox.Add(hbox_quality, flag=wx.EXPAND | wx.ALL, border=5)
+        # 目標サイズを入れるとJPG品質の代わりに、そのサイズに収まる最も高い品質で保存する(空欄で無効)
+        hbox_target = wx.BoxSizer(wx.HORIZONTAL)
+        st_target = wx.StaticText(self, label="目標KB")
+        st_target.SetFont(font)
+        self.tc_target_kb = wx.TextCtrl(self, value="", style=wx.TE_CENTER, size=(100,35))
+        self.tc_target_kb.SetFont(font)
+        hbox_target.Add(st_target, flag=wx.RIGHT, border=5)
+        hbox_target.Add(self.tc_target_kb, proportion=1)
+        vbox.Add(hbox_target, flag=wx.EXPAND | wx.ALL, border=5)
+        # トリミングと90度単位の回転だけならjpegtranで再エンコードせずに保存する(左上はMCUの境界に合わせる)
+        self.cb_lossless = wx.CheckBox(self, label="JPG無劣化保存")
+        self.cb_lossless.SetFont(font)
+        self.cb_lossless.SetValue(LOSSLESS_JPEG_SAVE)
+        if find_jpegtran() is None:
+            self.cb_lossless.SetValue(False)
+            self.cb_lossless.Disable()
+            self.cb_lossless.SetToolTip("jpegtranが見つかりません")
+        vbox.Add(self.cb_lossless, flag=wx.EXPAND | wx.ALL, border=5)
         btn_save = wx.Button(self, label="保存", size=(100,45))
         btn_save.SetFont(font)
         btn_save.Bind(wx.EVT_BUTTON, self.OnSave)
         vbox.Add(btn_save, flag=wx.EXPAND | wx.ALL, border=5)
+        # 書き出しプロファイルごとに形式・サイズの違うファイルをまとめて保存
+        btn_export = wx.Button(self, label="プロファイル書き出し", size=(100,45))
+        btn_export.SetFont(font)
+        btn_export.Bind(wx.EVT_BUTTON, self.OnExport)
+        vbox.Add(btn_export, flag=wx.EXPAND | wx.ALL, border=5)
+        # 保存中の表示
+        self.gauge_save = wx.Gauge(self, range=100, size=(-1, 10))
+        vbox.Add(self.gauge_save, flag=wx.EXPAND | wx.LEFT | wx.RIGHT, border=5)
+        self.save_timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.OnSaveTimer, self.save_timer)
+        # 編集手順をtrim_batch.pyで一括適用するレシピとして保存
+        btn_recipe = wx.Button(self, label="レシピ保存", size=(100,45))
+        btn_recipe.SetFont(font)
+        btn_recipe.Bind(wx.EVT_BUTTON, self.OnSaveRecipe)
+        vbox.Add(btn_recipe, flag=wx.EXPAND | wx.ALL, border=5)
         self.SetSizer(vbox)
 
     def OnRotateLeft(self, event):
@@ -862,6 +808,15 @@ class ControlPanel(wx.Panel):
         except ValueError:
             wx.MessageBox("回転角度に数値を入力してください。", "エラー", wx.OK | wx.ICON_ERROR)
 
+    def OnStraighten(self, event):
+        try:
+            angle = self.image_panel.StraightenImage()
+        except AutoTrimError:
+            wx.MessageBox("傾きの自動補正にはnumpyが必要です。", "エラー", wx.OK | wx.ICON_ERROR)
+            return
+        if angle is None:
+            wx.MessageBox("傾きを求められませんでした。", "エラー", wx.OK | wx.ICON_ERROR)
+
     def OnAspectEnter(self, event):
         ratio_str = self.tc_crop.GetValue()
         try:
@@ -888,10 +843,42 @@ class ControlPanel(wx.Panel):
                 self.image_panel.InitCropRect()
         self.image_panel.Refresh()
 
+    def OnAutoTrim(self, event):
+        """余白を除いた範囲をトリミング範囲にする。トリミングは「トリミング」ボタンで行う。"""
+        try:
+            found = self.image_panel.AutoTrimSelection()
+        except AutoTrimError:
+            wx.MessageBox("余白の自動選択にはnumpyが必要です。", "エラー", wx.OK | wx.ICON_ERROR)
+            return
+        if not found:
+            wx.MessageBox("余白以外の内容が見つかりませんでした。", "エラー", wx.OK | wx.ICON_ERROR)
+            return
+        # 内容の範囲そのものを切り出すよう、縦横比の固定を外す
+        self.cb_aspect.SetValue(False)
+        self.image_panel.fixed_aspect = False
+
     def OnCrop(self, event):
         """トリミングボタン押下時の処理。"""
-        if not self.image_panel.crop_rect:
+        if not self._apply_aspect_before_crop():
             return
+        # 現在のトリミング範囲を画像に反映
+        self.image_panel.CropImage()
+
+    def OnCropResize(self, event):
+        """トリミング+サイズ変更ボタン押下時の処理。"""
+        try:
+            target_size = int(self.tc_resize.GetValue())
+        except ValueError:
+            wx.MessageBox("画像サイズに数値を入力してください。", "エラー", wx.OK | wx.ICON_ERROR)
+            return
+        if not self._apply_aspect_before_crop():
+            return
+        self.image_panel.CropResizeImage(target_size)
+
+    def _apply_aspect_before_crop(self):
+        """縦横比固定ならトリミング範囲を指定の縦横比に合わせる。トリミングを続けられなければFalseを返す。"""
+        if not self.image_panel.crop_rect:
+            return False
         if self.cb_aspect.GetValue():
             ratio_str = self.tc_crop.GetValue()
             try:
@@ -907,9 +894,8 @@ class ControlPanel(wx.Panel):
                 self.image_panel.Refresh()
             except Exception:
                 wx.MessageBox("縦横比の入力形式が不正です。例: 1:1", "エラー", wx.OK | wx.ICON_ERROR)
-                return
-        # 現在のトリミング範囲を画像に反映
-        self.image_panel.CropImage()
+                return False
+        return True
 
     def OnRevert(self, event):
         self.image_panel.RevertCrop()
@@ -924,9 +910,85 @@ class ControlPanel(wx.Panel):
     def OnSave(self, event):
         try:
             quality = int(self.tc_quality.GetValue())
-            self.image_panel.SaveImage(quality)
         except ValueError:
             wx.MessageBox("圧縮率に数値を入力してください。", "エラー", wx.OK | wx.ICON_ERROR)
+            return
+        max_bytes = self._target_bytes()
+        if max_bytes is False:
+            return
+        self.image_panel.SaveImage(quality, lossless=self.cb_lossless.GetValue(), max_bytes=max_bytes)
+        if not self.save_timer.IsRunning():
+            self.save_timer.Start(100)
+
+    def OnExport(self, event):
+        try:
+            profiles = load_profiles(EXPORT_PROFILES_FILE) if EXPORT_PROFILES_FILE else DEFAULT_EXPORT_PROFILES
+        except (OSError, ValueError):
+            wx.MessageBox("書き出しプロファイルを読み込めませんでした。", "エラー", wx.OK | wx.ICON_ERROR)
+            return
+        try:
+            self.image_panel.ExportImages(profiles)
+        except ProfileError:
+            wx.MessageBox("書き出しプロファイルの内容が不正です。", "エラー", wx.OK | wx.ICON_ERROR)
+            return
+        if not self.save_timer.IsRunning():
+            self.save_timer.Start(100)
+
+    def _target_bytes(self):
+        """目標サイズ(バイト)。空欄ならNone、入力が不正ならメッセージを出してFalseを返す。"""
+        text = self.tc_target_kb.GetValue().strip()
+        if not text:
+            return None
+        try:
+            target_kb = float(text)
+            if target_kb <= 0:
+                raise ValueError
+        except ValueError:
+            wx.MessageBox("目標サイズにはKB単位の正の数値を入力してください。", "エラー", wx.OK | wx.ICON_ERROR)
+            return False
+        return int(target_kb * 1024)
+
+    def OnSaveRecipe(self, event):
+        """現在の画像までの回転・トリミング・リサイズと保存品質をレシピ(JSON)として保存する。"""
+        session = self.image_panel.session
+        if not session.has_image or not session.operations():
+            wx.MessageBox("保存する編集手順がありません。", "エラー", wx.OK | wx.ICON_ERROR)
+            return
+        try:
+            quality = int(self.tc_quality.GetValue())
+        except ValueError:
+            wx.MessageBox("圧縮率に数値を入力してください。", "エラー", wx.OK | wx.ICON_ERROR)
+            return
+        aspect = None
+        if self.cb_aspect.GetValue():
+            try:
+                aspect = tuple(map(float, self.tc_crop.GetValue().split(":")))
+                if len(aspect) != 2 or aspect[0] <= 0 or aspect[1] <= 0:
+                    raise ValueError
+            except ValueError:
+                wx.MessageBox("縦横比の入力形式が不正です。例: 1:1", "エラー", wx.OK | wx.ICON_ERROR)
+                return
+        max_bytes = self._target_bytes()
+        if max_bytes is False:
+            return
+        with wx.FileDialog(self, "レシピを保存", wildcard="レシピ (*.json)|*.json",
+                           style=wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT) as dialog:
+            if dialog.ShowModal() != wx.ID_OK:
+                return
+            path = dialog.GetPath()
+        try:
+            recipe = recipe_from_session(session, quality, aspect, self.cb_lossless.GetValue(), max_bytes)
+            save_recipe(recipe, path)
+        except OSError:
+            wx.MessageBox("レシピの保存に失敗しました。", "エラー", wx.OK | wx.ICON_ERROR)
+
+    def OnSaveTimer(self, event):
+        # 保存待ちがある間はゲージを動かし続ける
+        if self.image_panel.saver.pending:
+            self.gauge_save.Pulse()
+        else:
+            self.gauge_save.SetValue(0)
+            self.save_timer.Stop()
 
 class FileDropTarget(wx.FileDropTarget):
     def __init__(self, window):
@@ -935,11 +997,9 @@ class FileDropTarget(wx.FileDropTarget):
 
     def OnDropFiles(self, x, y, filenames):
         if filenames:
-            try:
-                img = Image.open(filenames[0])
-                self.window.image_panel.SetImage(img, file_name=filenames[0])
-            except Exception:
-                wx.MessageBox("画像ファイルの読み込みに失敗しました。", "エラー", wx.OK | wx.ICON_ERROR)
+            # ドロップされたファイルはすべてキューに入れ、PageUp/PageDownで切り替える
+            self.window.image_queue.set_paths(filenames)
+            self.window.ShowQueueImage(0)
         return True
 
 class ImageEditorFrame(wx.Frame):
@@ -956,6 +1016,19 @@ class ImageEditorFrame(wx.Frame):
         self.Bind(wx.EVT_CHAR_HOOK, self.OnKeyDown)
         # ウィンドウサイズをマウスホイールで変更
         self.Bind(wx.EVT_MOUSEWHEEL, self.OnMouseWheelResize)
+        self.Bind(wx.EVT_CLOSE, self.OnClose)
+        # ドロップされたファイルの一覧。大きなJPEGは画面サイズ程度に縮小デコードして先に表示する
+        self.image_queue = ImageQueue(preview_size=tuple(wx.GetDisplaySize()))
+        # クリップボード用のエンコードはワーカースレッドで行う
+        self._clipboard_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="clipboard")
+        self._clipboard_future = None
+
+    def OnClose(self, event):
+        # 保存待ちの画像を書き終えてから終了する
+        self.image_panel.saver.shutdown(wait=True)
+        self._clipboard_executor.shutdown(wait=False)
+        self.image_queue.shutdown()
+        event.Skip()
 
     def InitUI(self):
         panel = wx.Panel(self)
@@ -974,9 +1047,48 @@ class ImageEditorFrame(wx.Frame):
             self.PasteImageFromClipboard()
         elif event.ControlDown() and keycode == ord('C'):
             self.CopyImageToClipboard()
+        elif keycode == wx.WXK_PAGEDOWN and self.image_queue.has_next:
+            self.ShowQueueImage(self.image_queue.index + 1)
+        elif keycode == wx.WXK_PAGEUP and self.image_queue.has_previous:
+            self.ShowQueueImage(self.image_queue.index - 1, step=-1)
+        elif keycode == wx.WXK_F3:
+            self.image_panel.TogglePaintStats()
+        elif keycode == wx.WXK_F4:
+            self.DumpPaintStats()
         else:
             event.Skip()
 
+    def ShowQueueImage(self, index, step=1):
+        """
+        キューのindex番目の画像を表示する。次の画像はバックグラウンドで先読みされる。
+        読み込めないファイルは飛ばし、stepの向きに次のファイルを試す。
+        """
+        failed = []
+        while 0 <= index < len(self.image_queue):
+            try:
+                source = self.image_queue.load(index)
+            except Exception:
+                failed.append(os.path.basename(self.image_queue.paths[index]))
+                index += step
+                continue
+            position = (index + 1, len(self.image_queue)) if len(self.image_queue) > 1 else None
+            self.image_panel.SetSource(source, queue_position=position)
+            break
+        if failed:
+            wx.MessageBox("画像ファイルの読み込みに失敗しました。\n" + "\n".join(failed), "エラー",
+                          wx.OK | wx.ICON_ERROR)
+
+    def DumpPaintStats(self):
+        try:
+            path = self.image_panel.DumpPaintStats(resolve_clipboard_save_dir())
+        except OSError:
+            wx.MessageBox("描画時間の統計の書き出しに失敗しました。", "エラー", wx.OK | wx.ICON_ERROR)
+            return
+        if path is None:
+            wx.MessageBox("描画時間を計測していません。F3で計測を開始してください。", "情報", wx.OK | wx.ICON_INFORMATION)
+        else:
+            wx.MessageBox(f"描画時間の統計を書き出しました:\n{path}", "情報", wx.OK | wx.ICON_INFORMATION)
+
     def _get_display_client_area(self):
         display_idx = wx.Display.GetFromWindow(self)
         if display_idx == -1:
@@ -1018,19 +1130,36 @@ class ImageEditorFrame(wx.Frame):
         event.Skip(False)
 
     def CopyImageToClipboard(self):
-        current_image = self.image_panel.current_image
-        if not current_image:
+        if not self.image_panel.session.has_image:
             wx.MessageBox("画像が読み込まれていません。", "情報", wx.OK | wx.ICON_INFORMATION)
             return
-        if self.image_panel.file_name.lower().endswith((".jpg", ".jpeg")):
-            wx.MessageBox("容量が増えるためJpeg画像はクリップボードにコピーできません\n挿入から画像を取り込んでください", "コピーを中止しました", wx.OK | wx.ICON_INFORMATION)
+        if self._clipboard_future and not self._clipboard_future.done():
+            # エンコード中の連打は無視する
             return
+        # 原寸のデコードや回転もエンコードと一緒にワーカースレッドで行う
+        snapshot = self.image_panel.session.snapshot()
+        # Jpeg画像はPNGにすると容量が増えるため、ビットマップ形式だけを載せる
+        is_jpeg = self.image_panel.file_name.lower().endswith((".jpg", ".jpeg"))
+        with_png = not (is_jpeg and CLIPBOARD_USE_BITMAP)
+        self._clipboard_future = self._clipboard_executor.submit(
+            encode_clipboard_data, snapshot, with_png=with_png, with_bitmap=CLIPBOARD_USE_BITMAP)
+        self._clipboard_future.add_done_callback(lambda future: wx.CallAfter(self._on_clipboard_encoded, future))
+
+    def _on_clipboard_encoded(self, future):
         try:
-            buffer = io.BytesIO()
-            current_image.save(buffer, format="PNG")
-            png_bytes = buffer.getvalue()
-            data = wx.CustomDataObject(wx.DataFormat("PNG"))
-            data.SetData(png_bytes)
+            encoded = future.result()
+            data = wx.DataObjectComposite()
+            if encoded["bitmap"]:
+                mode, (width, height), buf = encoded["bitmap"]
+                if mode == "RGBA":
+                    bitmap = wx.Bitmap.FromBufferRGBA(width, height, buf)
+                else:
+                    bitmap = wx.Bitmap.FromBuffer(width, height, buf)
+                data.Add(wx.BitmapDataObject(bitmap), preferred=encoded["png"] is None)
+            if encoded["png"]:
+                png_data = wx.CustomDataObject(wx.DataFormat("PNG"))
+                png_data.SetData(encoded["png"])
+                data.Add(png_data, preferred=True)
             if wx.TheClipboard.Open():
                 wx.TheClipboard.SetData(data)
                 wx.TheClipboard.Flush()
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+from trim_auto import estimate_skew, find_content_box
+
+BOX = (40, 30, 250, 170)
+
+
+def _bordered(size=(300, 200), box=BOX, background=(255, 255, 255), scale=1):
+    image = Image.new("RGB", (size[0] * scale, size[1] * scale), background)
+    rng = np.random.default_rng(0)
+    left, top, right, bottom = (value * scale for value in box)
+    content = rng.integers(0, 128, (bottom - top, right - left, 3), dtype=np.uint8)
+    image.paste(Image.fromarray(content), (left, top))
+    return image
+
+
+def test_known_border():
+    assert find_content_box(_bordered()) == BOX
+
+
+def test_known_border_through_the_proxy():
+    # 縮小画像で大まかに求め、原寸では四辺の近くだけを調べる経路
+    image = _bordered(scale=10)
+    assert find_content_box(image, proxy_size=256) == tuple(value * 10 for value in BOX)
+
+
+def test_colored_background_and_grayscale():
+    assert find_content_box(_bordered(background=(0, 90, 30))) == BOX
+    assert find_content_box(_bordered().convert("L")) == BOX
+
+
+def test_transparent_border_ignores_the_hidden_color():
+    image = _bordered().convert("RGBA")
+    pixels = np.array(image)
+    outside = np.ones(pixels.shape[:2], dtype=bool)
+    outside[BOX[1]:BOX[3], BOX[0]:BOX[2]] = False
+    rng = np.random.default_rng(1)
+    # 透明な部分の色はばらばらでも背景とみなす
+    pixels[outside, :3] = rng.integers(0, 256, (int(outside.sum()), 3), dtype=np.uint8)
+    pixels[outside, 3] = 0
+    assert find_content_box(Image.fromarray(pixels, "RGBA")) == BOX
+
+
+def test_palette_image():
+    image = _bordered().quantize(16)
+    assert image.mode == "P"
+    assert find_content_box(image) == BOX
+
+
+def test_palette_image_with_transparency():
+    image = Image.new("P", (300, 200), 0)
+    image.putpalette([255, 0, 0, 0, 0, 255] + [0] * 762)
+    image.info["transparency"] = 0
+    ImageDraw.Draw(image).rectangle((BOX[0], BOX[1], BOX[2] - 1, BOX[3] - 1), fill=1)
+    assert find_content_box(image) == BOX
+
+
+def test_blank_image_has_no_content():
+    assert find_content_box(Image.new("RGB", (300, 200), (255, 255, 255))) is None
+
+
+def _document(angle):
+    image = Image.new("L", (800, 600), 255)
+    draw = ImageDraw.Draw(image)
+    rng = np.random.default_rng(0)
+    for y in range(80, 520, 30):
+        x = 80
+        while x < 700:
+            width = int(rng.integers(20, 60))
+            draw.rectangle((x, y, x + width, y + 12), fill=0)
+            x += width + int(rng.integers(8, 16))
+    return image.rotate(angle, resample=Image.BICUBIC, fillcolor=255)
+
+
+@pytest.mark.parametrize("angle", [0.0, 3.0, -4.5])
+def test_known_skew(angle):
+    # 傾きを打ち消すために回す角度を返す
+    assert estimate_skew(_document(angle)) == pytest.approx(-angle, abs=0.15)
+
+
+def test_skew_of_a_blank_image_is_unknown():
+    assert estimate_skew(Image.new("L", (200, 100), 255)) is None
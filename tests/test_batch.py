@@ -0,0 +1,128 @@
+import json
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from trim_batch import (RECIPE_VERSION, RecipeError, apply_recipe, load_recipe, main, recipe_from_session, run_batch,
+                        save_recipe)
+from trim_core import TrimSession, fit_long_side
+
+
+def _session(image):
+    session = TrimSession()
+    session.set_image(image, file_name="in.png")
+    return session
+
+
+@pytest.fixture
+def image():
+    rng = np.random.default_rng(0)
+    return Image.fromarray(rng.integers(0, 256, (777, 1001, 3), dtype=np.uint8))
+
+
+def _edit_resize(session):
+    session.rotate(3.7)
+    session.crop((13, 29, 990, 700))
+    session.resize(555)
+
+
+def _edit_crop_resize(session):
+    session.rotate(90)
+    session.crop_resize((41, 7, 700, 913), 333)
+
+
+def _edit_revert_rotate(session):
+    # もどるで回転の項目に戻ってから回転すると、回転が2つ続けて記録される
+    session.rotate(10)
+    session.crop((50, 50, 400, 400))
+    session.revert()
+    session.rotate(3)
+    session.crop((20, 20, 200, 200))
+
+
+@pytest.mark.parametrize("edit", [_edit_resize, _edit_crop_resize, _edit_revert_rotate])
+def test_recipe_replays_to_the_same_image(image, edit):
+    recorded = _session(image)
+    edit(recorded)
+    recipe = recipe_from_session(recorded)
+    replayed = _session(image)
+    apply_recipe(replayed, recipe)
+    assert replayed.size == recorded.size
+    assert np.array_equal(np.asarray(replayed.current_image), np.asarray(recorded.current_image))
+
+
+def test_recipe_keeps_the_requested_long_side(image):
+    # 長辺300を110にする縮小は、比率を掛けて切り捨てると109になる
+    session = _session(image)
+    session.crop_resize((41, 7, 341, 207), 110)
+    session.resize(97)
+    recipe = recipe_from_session(session)
+    assert [step["long_side"] for step in recipe["steps"]] == [110, 97]
+    assert session.size == (97, 64)
+
+
+def test_fit_long_side_is_exact():
+    assert fit_long_side((2999, 1000), 1000) == (1000, 333)
+    assert fit_long_side((1000, 2999), 1000) == (333, 1000)
+    assert fit_long_side((4000, 3), 100) == (100, 1)
+    assert fit_long_side((100, 50), 100) is None
+
+
+@pytest.mark.parametrize("save", [
+    {"jpeg_quality": 0}, {"jpeg_quality": "90"}, {"suffix": ""}, {"suffix": "../x"},
+    {"lossless": "yes"}, {"max_bytes": 0}, {"max_bytes": 1.5},
+])
+def test_invalid_save_settings_are_rejected(tmp_path, save):
+    path = tmp_path / "recipe.json"
+    path.write_text(json.dumps({"version": RECIPE_VERSION, "steps": [], "save": save}))
+    with pytest.raises(RecipeError):
+        load_recipe(str(path))
+
+
+@pytest.mark.parametrize("step", [{"op": "resize"}, {"op": "resize", "long_side": 0}, {"op": "crop", "box": [0, 0, 1]},
+                                  {"op": "flip"}])
+def test_invalid_steps_are_rejected(tmp_path, step):
+    path = tmp_path / "recipe.json"
+    path.write_text(json.dumps({"version": RECIPE_VERSION, "steps": [step], "save": {}}))
+    with pytest.raises(RecipeError):
+        load_recipe(str(path))
+
+
+def test_command_line_save_settings_are_validated(tmp_path, image):
+    path = tmp_path / "recipe.json"
+    session = _session(image)
+    session.resize(500)
+    save_recipe(recipe_from_session(session), str(path))
+    with pytest.raises(SystemExit):
+        main([str(path), str(tmp_path), str(tmp_path / "out"), "--target-kb", "-5"])
+    assert not (tmp_path / "out").exists()
+
+
+def test_resume_skips_only_files_done_with_the_same_recipe(tmp_path, image):
+    input_dir = tmp_path / "in"
+    input_dir.mkdir()
+    for name in ("a.png", "b.png"):
+        image.save(input_dir / name)
+    paths = [str(input_dir / "a.png"), str(input_dir / "b.png")]
+    output_dir = tmp_path / "out"
+    done_log = str(output_dir / "done.txt")
+    session = _session(image)
+    session.resize(500)
+    recipe = recipe_from_session(session)
+
+    def run(recipe):
+        logs = []
+        assert run_batch(recipe, paths, str(input_dir), str(output_dir), 1, done_log, log=logs.append) == []
+        return logs
+
+    assert len(run(recipe)) == 2
+    # 同じレシピでの再実行は処理済みのファイルを飛ばす
+    assert run(recipe) == ["skip 2 files already done"]
+    # 保存の設定を変えたレシピでは処理し直す
+    changed = json.loads(json.dumps(recipe))
+    changed["save"]["jpeg_quality"] = 50
+    assert len(run(changed)) == 2
+    assert run(changed) == ["skip 2 files already done"]
+    with Image.open(output_dir / "a_trm.png") as saved:
+        assert saved.size == (500, 388)
@@ -0,0 +1,98 @@
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from trim_encode import (TARGET_PROXY_MIN_PIXELS, TargetSizeError, encode_to_bytes, encode_to_size,
+                         encoder_view, search_quality)
+
+
+def _noise_image(size):
+    rng = np.random.default_rng(0)
+    # 滑らかな部分と雑音を混ぜ、品質でサイズが大きく変わる画像にする
+    x = np.linspace(0, 255, size[0])[None, :, None]
+    y = np.linspace(0, 255, size[1])[:, None, None]
+    base = (x + y) / 2 + rng.normal(0, 24, (size[1], size[0], 3))
+    return Image.fromarray(np.clip(base, 0, 255).astype(np.uint8))
+
+
+def _linear_scan(encode, max_bytes, low, high):
+    fits = [q for q in range(low, high + 1) if len(encode(q)) <= max_bytes]
+    return max(fits) if fits else None
+
+
+@pytest.mark.parametrize("ways", [1, 2, 4])
+def test_search_matches_a_linear_scan(ways):
+    # 品質に対して単調に増えるサイズを返すエンコードで、すべての上限を試す
+    sizes = {q: 1000 + q * q for q in range(5, 96)}
+    encode = lambda q: b"x" * sizes[q]
+    with ThreadPoolExecutor(max_workers=ways) as executor:
+        for max_bytes in list(range(900, 10300, 97)) + [sizes[5], sizes[95]]:
+            quality, data = search_quality(encode, max_bytes, 5, 95, ways, executor)
+            expected = _linear_scan(encode, max_bytes, 5, 95)
+            assert quality == expected
+            if expected is None:
+                assert data == encode(5)
+            else:
+                assert data == encode(expected)
+
+
+@pytest.mark.parametrize("format", ["JPEG", "WEBP"])
+def test_encode_to_size_matches_a_linear_scan(format):
+    image = _noise_image((160, 120))
+    encode = lambda q: encode_to_bytes(image, format, q)
+    for max_bytes in (len(encode(30)), len(encode(70)) + 1, len(encode(95)) * 2):
+        quality, data = encode_to_size(image, format, max_bytes)
+        assert quality == _linear_scan(encode, max_bytes, 5, 95)
+        assert data == encode(quality)
+        assert len(data) <= max_bytes
+
+
+def test_target_that_cannot_be_met_raises():
+    image = _noise_image((160, 120))
+    with pytest.raises(TargetSizeError):
+        encode_to_size(image, "JPEG", len(encode_to_bytes(image, "JPEG", 5)) - 1)
+
+
+def test_unsupported_format_is_rejected():
+    with pytest.raises(ValueError):
+        encode_to_size(Image.new("RGB", (8, 8)), "PNG", 1000)
+
+
+def test_proxy_estimate_still_finds_the_best_quality():
+    # 縮小画像での見積もりを使う大きさの画像でも、原寸で上限に収まる最も高い品質を選ぶ
+    width = int((TARGET_PROXY_MIN_PIXELS * 4 / 3) ** 0.5) + 1
+    image = _noise_image((width, width * 3 // 4))
+    max_bytes = len(encode_to_bytes(image, "JPEG", 60)) + 1
+    quality, data = encode_to_size(image, "JPEG", max_bytes)
+    assert len(data) <= max_bytes
+    assert len(encode_to_bytes(image, "JPEG", quality + 1)) > max_bytes
+
+
+@pytest.mark.parametrize("mode", ["RGB", "L", "CMYK", "RGBA"])
+def test_encoder_view_encodes_like_the_image(mode):
+    image = _noise_image((64, 48)).convert(mode)
+    image.info["icc_profile"] = b"profile"
+    view = encoder_view(image)
+    assert view is not image
+    assert view.mode == image.mode and view.size == image.size and view.info == image.info
+    format = "PNG" if mode == "RGBA" else "JPEG"
+    expected = io.BytesIO()
+    image.copy().save(expected, format=format, quality=80)
+    actual = io.BytesIO()
+    view.save(actual, format=format, quality=80)
+    assert actual.getvalue() == expected.getvalue()
+    # 保存時の引数はもとの画像に書き込まれない
+    assert not hasattr(image, "encoderinfo")
+
+
+
+def test_concurrent_encodes_of_one_image_match_serial_encodes():
+    image = _noise_image((320, 240))
+    qualities = [10, 95] * 8
+    serial = {q: encode_to_bytes(image.copy(), "JPEG", q) for q in set(qualities)}
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda q: encode_to_bytes(image, "JPEG", q), qualities))
+    assert results == [serial[q] for q in qualities]
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from trim_export import ExportJob, ProfileError, validate_profiles
+
+
+def _noise_image(size=(640, 480)):
+    rng = np.random.default_rng(0)
+    return Image.fromarray(rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8))
+
+
+def test_same_size_profiles_keep_their_own_quality(tmp_path):
+    # 同じ長辺のプロファイルは同じ縮小画像を同時に保存するので、品質の指定が混ざらないこと
+    image = _noise_image()
+    profiles = validate_profiles([
+        {"suffix": "_high", "format": "JPEG", "long_side": 320, "quality": 95},
+        {"suffix": "_low", "format": "JPEG", "long_side": 320, "quality": 10},
+    ])
+    for _ in range(5):
+        base = str(tmp_path / "out")
+        high_path, low_path = ExportJob(image, base, profiles).run()
+        with Image.open(high_path) as high, Image.open(low_path) as low:
+            assert high.size == low.size == (320, 240)
+            high_pixels = np.asarray(high.convert("RGB"), dtype=np.int16)
+            low_pixels = np.asarray(low.convert("RGB"), dtype=np.int16)
+        reference = image.resize((320, 240), Image.LANCZOS)
+        reference_pixels = np.asarray(reference, dtype=np.int16)
+        # 高品質の出力のほうが縮小画像に近い
+        assert np.abs(high_pixels - reference_pixels).mean() < np.abs(low_pixels - reference_pixels).mean()
+        assert (tmp_path / "out_high.jpg").stat().st_size > (tmp_path / "out_low.jpg").stat().st_size * 2
+
+
+@pytest.mark.parametrize("key, value", [
+    ("max_bytes", 0), ("max_bytes", -1), ("max_bytes", 1.5), ("max_bytes", "100000"), ("max_bytes", True),
+    ("long_side", 0), ("long_side", 640.0), ("long_side", True), ("long_side", False),
+    ("quality", 0), ("quality", 101), ("quality", "80"), ("quality", True), ("quality", False),
+])
+def test_invalid_numbers_are_rejected(key, value):
+    with pytest.raises(ProfileError):
+        validate_profiles([{"suffix": "_web", "format": "JPEG", key: value}])
@@ -0,0 +1,106 @@
+import pytest
+
+from trim_geometry import HANDLE_NAMES, Rect, SelectionGeometry
+
+
+@pytest.fixture
+def geometry():
+    return SelectionGeometry(400, 300, min_size=4, handle_size=10)
+
+
+def _inside(geometry, rect):
+    return (rect.x >= 0 and rect.y >= 0 and rect.x + rect.width <= geometry.display_width and
+            rect.y + rect.height <= geometry.display_height)
+
+
+def test_rect_edges_include_the_last_pixel():
+    rect = Rect.from_tuple((10.4, 19.6, 30.5, 40))
+    assert rect == Rect(10, 20, 30, 40)  # 偶数への丸め(30.5 -> 30)
+    assert (rect.right, rect.bottom) == (39, 59)
+
+
+def test_create_from_any_drag_direction(geometry):
+    assert geometry.create((50, 60), (150, 120)) == Rect(50, 60, 100, 60)
+    assert geometry.create((150, 120), (50, 60)) == Rect(50, 60, 100, 60)
+    # 表示エリアの外へのドラッグは端で止まる
+    assert geometry.create((350, 250), (999, -50)) == Rect(350, 0, 50, 250)
+    # クリックだけでも最小サイズの範囲になる
+    assert geometry.create((100, 100), (100, 100)) == Rect(100, 100, 4, 4)
+
+
+def test_create_with_ratio_fits_inside_the_drag(geometry):
+    rect = geometry.create((0, 0), (200, 50), ratio=16 / 9)
+    assert rect == Rect(0, 0, 89, 50)
+    rect = geometry.create((200, 200), (100, 0), ratio=1.0)
+    assert rect == Rect(100, 100, 100, 100)
+
+
+def test_move_stays_inside_the_display(geometry):
+    origin = Rect(100, 100, 80, 60)
+    assert geometry.move(origin, 20, -30) == Rect(120, 70, 80, 60)
+    assert geometry.move(origin, 1000, 1000) == Rect(320, 240, 80, 60)
+    assert geometry.move(origin, -1000, -1000) == Rect(0, 0, 80, 60)
+
+
+def test_free_resize_keeps_the_opposite_edges(geometry):
+    origin = Rect(100, 100, 80, 60)
+    assert geometry.resize(origin, (150, 200), "bottom_right") == Rect(100, 100, 50, 100)
+    assert geometry.resize(origin, (50, 0), "top_left") == Rect(50, 0, 129, 159)
+    # 反対側を越えても最小サイズで止まる
+    rect = geometry.resize(origin, (500, 130), "left")
+    assert (rect.x, rect.y, rect.width) == (175, 100, 4)
+    rect = geometry.resize(origin, (130, -100), "bottom")
+    assert (rect.x, rect.y, rect.height) == (100, 100, 4)
+
+
+@pytest.mark.parametrize("handle", HANDLE_NAMES)
+@pytest.mark.parametrize("point", [(0, 0), (399, 299), (-500, 800), (210, 150)])
+def test_resize_with_ratio_keeps_the_ratio_inside_the_display(geometry, handle, point):
+    origin = Rect(100, 100, 160, 90)
+    rect = geometry.resize(origin, point, handle, ratio=16 / 9)
+    assert _inside(geometry, rect)
+    assert rect.width >= 4 and rect.height >= 4
+    if min(rect.width, rect.height) > geometry.min_size:
+        # 反対側を越えて最小サイズまで縮めた場合は縦横比を保てない
+        assert rect.width / rect.height == pytest.approx(16 / 9, abs=0.2)
+
+
+def test_apply_aspect_keeps_the_center(geometry):
+    rect = geometry.apply_aspect((100, 100, 200, 100), 1.0)
+    assert rect == Rect(100, 50, 200, 200)
+    # 表示エリアに収まらない高さは表示エリアの高さにする
+    rect = geometry.apply_aspect((0, 0, 400, 300), 1 / 2)
+    assert (rect.width, rect.height) == (150, 300)
+    assert _inside(geometry, rect)
+
+
+def test_ensure_within_clamps_and_enforces_min_size(geometry):
+    assert geometry.ensure_within(Rect(-20, 280, 50, 50)) == Rect(0, 250, 50, 50)
+    assert geometry.ensure_within(Rect(10, 10, 1, 0)) == Rect(10, 10, 4, 4)
+    assert geometry.ensure_within(Rect(0, 0, 1000, 1000)) == Rect(0, 0, 400, 300)
+    assert geometry.ensure_within(None) == Rect()
+    # 2回通しても変わらない
+    rect = geometry.ensure_within(Rect(390, 290, 30, 30))
+    assert geometry.ensure_within(rect) == rect
+
+
+def test_rescale_keeps_the_relative_position():
+    geometry = SelectionGeometry(800, 600)
+    assert geometry.rescale((100, 50, 200, 100), 400, 300) == Rect(200, 100, 400, 200)
+
+
+def test_hit_test_handle(geometry):
+    rect = (100, 100, 80, 60)
+    assert geometry.hit_test_handle(rect, (100, 100)) == "top_left"
+    assert geometry.hit_test_handle(rect, (140, 104)) == "top"
+    assert geometry.hit_test_handle(rect, (184, 160)) == "bottom_right"
+    assert geometry.hit_test_handle(rect, (96, 130)) == "left"
+    assert geometry.hit_test_handle(rect, (140, 130)) is None
+    assert geometry.hit_test_handle(None, (100, 100)) is None
+    # 範囲が変われば当たり判定の範囲も計算し直す
+    assert geometry.hit_test_handle((0, 0, 20, 20), (100, 100)) is None
+
+
+def test_crop_contains_includes_the_outer_edge():
+    assert SelectionGeometry.crop_contains((10, 10, 20, 20), (30, 30))
+    assert not SelectionGeometry.crop_contains((10, 10, 20, 20), (31, 30))
@@ -0,0 +1,105 @@
+import io
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from trim_loader import ImageQueue, RegionReader, open_source
+
+
+def test_failed_load_keeps_the_current_position(tmp_path):
+    good = tmp_path / "a.png"
+    Image.new("RGB", (32, 24)).save(good)
+    broken = tmp_path / "b.png"
+    broken.write_bytes(b"not an image")
+    queue = ImageQueue(preview_size=(16, 16), prefetch_count=0)
+    try:
+        queue.set_paths([str(good), str(broken)])
+        assert queue.load(0).size == (32, 24)
+        with pytest.raises(Exception):
+            queue.load(1)
+        assert queue.index == 0
+    finally:
+        queue.shutdown()
+
+
+def test_concurrent_loads_decode_once(tmp_path, monkeypatch):
+    path = tmp_path / "big.jpg"
+    Image.new("RGB", (640, 480), (10, 20, 30)).save(path)
+    source = open_source(str(path), preview_size=(64, 48))
+    assert not source.is_loaded
+    opened = []
+    real_open = Image.open
+
+    def counting_open(*args, **kwargs):
+        opened.append(args[0])
+        # デコード中に別のスレッドが割り込めるよう少し待つ
+        time.sleep(0.05)
+        return real_open(*args, **kwargs)
+
+    monkeypatch.setattr(Image, "open", counting_open)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        images = list(executor.map(lambda _: source.load(), range(4)))
+    assert len(opened) == 1
+    assert all(image is images[0] for image in images)
+    assert images[0].size == (640, 480)
+
+
+def _pattern(mode, size=(37, 29)):
+    rng = np.random.default_rng(0)
+    if mode == "I;16":
+        return Image.fromarray(rng.integers(0, 65536, (size[1], size[0]), dtype=np.uint16))
+    if mode == "1":
+        return _pattern("L", size).convert("1")
+    bands = len(Image.new(mode, (1, 1)).getbands())
+    pixels = rng.integers(0, 256, (size[1], size[0], bands), dtype=np.uint8)
+    return Image.frombytes(mode, size, pixels.tobytes())
+
+
+def _top_down_bmp(image, path):
+    """高さを負にした、上から下へ行を格納するBMP。Pillowは下から上へのBMPしか書かないので作り直す。"""
+    buffer = io.BytesIO()
+    image.save(buffer, format="BMP")
+    data = bytearray(buffer.getvalue())
+    offset = struct.unpack_from("<I", data, 10)[0]
+    width, height = struct.unpack_from("<ii", data, 18)
+    stride = (width * 3 + 3) // 4 * 4
+    rows = [data[offset + i * stride:offset + (i + 1) * stride] for i in range(height)]
+    struct.pack_into("<i", data, 22, -height)
+    data[offset:offset + height * stride] = b"".join(reversed(rows))
+    path.write_bytes(bytes(data))
+
+
+@pytest.mark.parametrize("format, mode, ystep", [
+    ("TIFF", "RGB", 1), ("TIFF", "L", 1), ("TIFF", "I;16", 1), ("TIFF", "1", 1), ("TIFF", "CMYK", 1),
+    ("PPM", "RGB", 1), ("PPM", "L", 1), ("BMP", "RGB", -1), ("BMP", "RGB", 1),
+])
+def test_region_reader_matches_a_full_decode(tmp_path, format, mode, ystep):
+    image = _pattern(mode)
+    path = tmp_path / ("image." + format.lower())
+    if format == "BMP" and ystep == 1:
+        _top_down_bmp(image, path)
+    else:
+        image.save(path, format=format)
+    reader = RegionReader.open(str(path))
+    assert reader is not None
+    assert [tile[4] for tile in reader.tiles] == [ystep] * len(reader.tiles)
+    with Image.open(path) as full:
+        full.load()
+        for box in [(0, 0, 37, 29), (5, 3, 20, 17), (36, 28, 37, 29), (0, 10, 37, 11), (12, 0, 13, 29)]:
+            region = reader.read(box)
+            assert region.mode == full.mode
+            assert region.tobytes() == full.crop(box).tobytes(), box
+        preview = reader.preview((10, 10))
+        assert preview.size == (10, 8)
+
+
+def test_region_reader_rejects_compressed_and_palette_images(tmp_path):
+    Image.new("RGB", (8, 8)).save(tmp_path / "a.png")
+    Image.new("RGB", (8, 8)).save(tmp_path / "b.tif", compression="tiff_lzw")
+    Image.new("P", (8, 8)).save(tmp_path / "c.bmp")
+    for name in ("a.png", "b.tif", "c.bmp"):
+        assert RegionReader.open(str(tmp_path / name)) is None
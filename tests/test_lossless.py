@@ -0,0 +1,77 @@
+import numpy as np
+from PIL import Image
+
+import trim_lossless
+from trim_core import TrimSession
+from trim_lossless import LosslessJpegJob
+
+
+def _jpeg(path, size=(256, 192)):
+    rng = np.random.default_rng(0)
+    Image.fromarray(rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)).save(path, quality=90)
+    return str(path)
+
+
+def test_fallback_renders_only_when_jpegtran_fails(tmp_path, monkeypatch):
+    # 実行できないjpegtranを指定して、再エンコードに切り替わるようにする
+    monkeypatch.setattr(trim_lossless, "JPEGTRAN_PATH", str(tmp_path / "missing-jpegtran"))
+    session = TrimSession.open(_jpeg(tmp_path / "in.jpg"), preview_size=(64, 48))
+    session.rotate(90)
+    job = session.prepare_save(save_path=str(tmp_path / "out.jpg"), lossless=True)
+    assert isinstance(job, LosslessJpegJob)
+    # ジョブを作っただけでは原寸の画像をデコードしない
+    assert session.history[0].image is None
+    assert job.run() == str(tmp_path / "out.jpg")
+    with Image.open(tmp_path / "out.jpg") as saved:
+        assert saved.size == (192, 256)
+
+
+def _fake_jpegtran(tmp_path):
+    """-copy iccを受け付けない古いjpegtranの代わり。引数を記録し、入力をそのまま出力に書く。"""
+    script = tmp_path / "jpegtran"
+    script.write_text(
+        "#!/bin/sh\n"
+        'echo "$@" >> "%s"\n'
+        'for arg in "$@"; do [ "$arg" = icc ] && exit 1; done\n'
+        'while [ $# -gt 1 ]; do [ "$1" = -outfile ] && out=$2; shift; done\n'
+        'cp "$1" "$out"\n' % (tmp_path / "calls.txt"))
+    script.chmod(0o755)
+    return str(script)
+
+
+def test_copy_falls_back_when_icc_is_unsupported(tmp_path, caplog):
+    jpegtran = _fake_jpegtran(tmp_path)
+    source = _jpeg(tmp_path / "in.jpg")
+    job = LosslessJpegJob(source, str(tmp_path / "out.jpg"), [], fallback=None, jpegtran=jpegtran)
+    assert job.run() == str(tmp_path / "out.jpg")
+    assert job.run() == str(tmp_path / "out.jpg")
+    calls = (tmp_path / "calls.txt").read_text().splitlines()
+    # 対応を確かめるのは1回だけで、保存には-copy noneを使う
+    assert calls[0] == "-copy icc"
+    assert [call.split()[:2] for call in calls[1:]] == [["-copy", "none"]] * 2
+    assert "-copy none" in caplog.text
+    assert (tmp_path / "out.jpg").read_bytes() == (tmp_path / "in.jpg").read_bytes()
+
+
+def test_plan_keeps_nested_crops_inside_the_previous_crop():
+    operations = [("crop", (10, 20, 110, 220), (400, 300)), ("crop", (5, 5, 50, 60), (100, 200))]
+    assert trim_lossless.plan_transform(operations, (400, 300)) == (0, (15, 25, 60, 80))
+    rotated = [("rotate", 90, (400, 300)), ("crop", (10, 20, 110, 220), (300, 400))]
+    assert trim_lossless.plan_transform(rotated, (400, 300)) == (90, (10, 20, 110, 220))
+
+
+def test_plan_rejects_a_crop_outside_the_previous_crop(tmp_path, monkeypatch):
+    # 2回目のトリミングが1回目の範囲から1画素はみ出すと、無劣化では黒い縁を再現できない
+    operations = [("crop", (10, 20, 110, 220), (400, 300)), ("crop", (0, 0, 101, 200), (100, 200))]
+    assert trim_lossless.plan_transform(operations, (400, 300)) is None
+    assert trim_lossless.plan_transform([("crop", (-1, 0, 50, 50), (400, 300))], (400, 300)) is None
+    # セッションでも無劣化のジョブではなく再エンコードのジョブになる
+    monkeypatch.setattr(trim_lossless, "JPEGTRAN_PATH", _fake_jpegtran(tmp_path))
+    session = TrimSession.open(_jpeg(tmp_path / "in.jpg"))
+    session.crop((16, 16, 116, 116))
+    session.crop((0, 0, 101, 100))
+    job = session.prepare_save(save_path=str(tmp_path / "out.jpg"), lossless=True)
+    assert not isinstance(job, LosslessJpegJob)
+    session.revert()
+    session.crop((0, 0, 100, 100))
+    assert isinstance(session.prepare_save(save_path=str(tmp_path / "out.jpg"), lossless=True), LosslessJpegJob)
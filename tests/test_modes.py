@@ -0,0 +1,101 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from trim_modes import (MATTE_COLOR, color_params, convert_mode, for_resampling, prepare_for_format,
+                        to_display_base)
+
+
+def _roundtrip(image, format):
+    buffer = io.BytesIO()
+    prepared = prepare_for_format(image, format)
+    prepared.save(buffer, format=format, **color_params(prepared, format))
+    buffer.seek(0)
+    return prepared, Image.open(buffer)
+
+
+@pytest.mark.parametrize("mode", ["L", "RGB", "CMYK"])
+def test_jpeg_modes_are_kept(mode):
+    image = Image.new(mode, (8, 8))
+    assert prepare_for_format(image, "JPEG") is image
+
+
+def test_cmyk_is_written_to_jpeg_as_cmyk_and_to_png_as_rgb():
+    image = Image.new("CMYK", (8, 8), (0, 255, 255, 0))
+    prepared, saved = _roundtrip(image, "JPEG")
+    assert saved.mode == "CMYK"
+    prepared = prepare_for_format(image, "PNG")
+    assert prepared.mode == "RGB"
+    assert prepared.getpixel((0, 0))[0] > 200 and prepared.getpixel((0, 0))[1] < 50
+
+
+def test_la_is_flattened_to_gray_for_jpeg():
+    image = Image.new("LA", (4, 1), (0, 0))
+    image.putpixel((0, 0), (0, 255))
+    prepared, saved = _roundtrip(image, "JPEG")
+    assert prepared.mode == "L"
+    # 透明な部分は背景色、不透明な部分はもとの色になる
+    assert prepared.getpixel((0, 0)) == 0
+    assert prepared.getpixel((1, 0)) == 255
+    assert saved.mode == "L"
+
+
+def test_transparent_palette_is_flattened_to_rgb_for_jpeg():
+    image = Image.new("P", (4, 1), 0)
+    image.putpalette([0, 0, 0, 255, 0, 0] + [0] * 762)
+    image.info["transparency"] = 0
+    image.putpixel((1, 0), 1)
+    prepared, saved = _roundtrip(image, "JPEG")
+    assert prepared.mode == "RGB"
+    assert prepared.getpixel((0, 0)) == MATTE_COLOR
+    assert prepared.getpixel((1, 0)) == (255, 0, 0)
+    assert "transparency" not in prepared.info
+
+
+def test_opaque_palette_is_converted_to_rgb_for_jpeg_and_kept_for_png():
+    image = Image.new("P", (4, 1), 1)
+    image.putpalette([0, 0, 0, 0, 128, 255] + [0] * 762)
+    assert prepare_for_format(image, "JPEG").getpixel((0, 0)) == (0, 128, 255)
+    assert prepare_for_format(image, "PNG") is image
+
+
+def test_rgba_is_kept_for_png_and_webp():
+    image = Image.new("RGBA", (4, 4), (1, 2, 3, 4))
+    assert prepare_for_format(image, "PNG") is image
+    assert prepare_for_format(image, "WEBP") is image
+
+
+def test_16bit_is_kept_for_png_and_reduced_for_jpeg():
+    image = Image.fromarray(np.full((2, 2), 0x1234, dtype=np.uint16))
+    assert image.mode.startswith("I;16")
+    prepared, saved = _roundtrip(image, "PNG")
+    assert saved.mode.startswith("I;16") or saved.mode == "I"
+    assert saved.getpixel((0, 0)) == 0x1234
+    assert prepare_for_format(image, "JPEG").getpixel((0, 0)) == 0x12
+    # 32bitのIはPNGでは16bitで書く
+    assert prepare_for_format(image.convert("I"), "PNG").mode == "I;16"
+
+
+def test_icc_profile_is_dropped_when_it_no_longer_matches():
+    image = Image.new("L", (2, 2))
+    image.info["icc_profile"] = b"gray profile"
+    assert "icc_profile" not in convert_mode(image, "RGB").info
+    rgb = Image.new("RGB", (2, 2))
+    rgb.info["icc_profile"] = b"rgb profile"
+    assert convert_mode(rgb, "RGBA").info["icc_profile"] == b"rgb profile"
+    assert color_params(rgb, "JPEG") == {"icc_profile": b"rgb profile"}
+    assert color_params(rgb, "PNG") == {}
+
+
+@pytest.mark.parametrize("mode, expected", [("1", "L"), ("P", "RGB"), ("PA", "RGBA"), ("I;16", "I;16"),
+                                            ("CMYK", "CMYK"), ("RGB", "RGB")])
+def test_resampling_modes(mode, expected):
+    assert for_resampling(Image.new(mode, (2, 2))).mode == expected
+
+
+@pytest.mark.parametrize("mode, expected", [("L", "RGB"), ("LA", "RGBA"), ("CMYK", "RGB"), ("I;16", "RGB"),
+                                            ("RGBA", "RGBA")])
+def test_display_base_modes(mode, expected):
+    assert to_display_base(Image.new(mode, (2, 2))).mode == expected
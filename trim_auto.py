@@ -0,0 +1,246 @@
+"""
+画像の内容から自動で求める編集(余白の自動トリミング・傾き補正)。wxに依存しない。
+NumPyが必要で、インストールされていなければAutoTrimErrorを送出する。
+"""
+import math
+from PIL import Image
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+AUTO_TRIM_TOLERANCE = 16     # 背景色との差(各チャンネル0〜255)がこれ以下の画素を背景とみなす
+AUTO_TRIM_BACKGROUND = "edges"   # 背景色の推定方法。"edges"(四辺の画素)・"corners"(四隅)・色のタプル
+AUTO_TRIM_BORDER = 2    # 背景色の推定に使う縁の幅(画素)
+AUTO_TRIM_MIN_CONTENT = 0.001    # 行・列のうち背景でない画素がこの割合を超えたら内容とみなす(ゴミや雑音を無視する)
+AUTO_TRIM_PROXY_SIZE = 1024     # 大まかな範囲を求める縮小画像の長辺
+DESKEW_MAX_ANGLE = 10.0     # 傾きを探す範囲(±度)
+DESKEW_PROXY_SIZE = 1000    # 傾きを求める縮小画像の長辺
+DESKEW_MAX_POINTS = 200000  # 射影に使う文字などの画素の上限(多ければ間引く)
+# 粗い刻みから順に細かくして探す(刻み(度), 前の段の最良値から探す範囲(±刻みの何倍か))
+DESKEW_STEPS = ((0.5, None), (0.05, 10), (0.01, 5))
+
+
+class AutoTrimError(RuntimeError):
+    """自動処理を実行できない場合の例外。"""
+
+
+def _require_numpy():
+    if np is None:
+        raise AutoTrimError("numpy is required for automatic trimming")
+
+
+def _reduce(image, proxy_size):
+    """長辺がproxy_size以下になるよう整数分の1に縮小した画像。縮小の必要がなければNone。"""
+    width, height = image.size
+    factor = math.ceil(max(width, height) / proxy_size)
+    if factor <= 1:
+        return None
+    try:
+        return image.reduce(factor)
+    except ValueError:
+        # "P"や"I;16"などreduceが使えないモードはresizeで縮小
+        return image.resize((-(-width // factor), -(-height // factor)), Image.BOX)
+
+
+def _to_array(image):
+    """
+    比較用の(高さ, 幅, チャンネル)の配列にする。
+    透明度のある画像は透明な部分の色の違いを無視するよう、色に透明度を掛けてから比べる。
+    """
+    if image.mode.startswith("I;16"):
+        # 16bitの画像は上位8bitで比べ、許容差を8bitの値のまま使えるようにする
+        return (np.asarray(image) >> 8).astype(np.uint8)[:, :, None]
+    if image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info):
+        image = image.convert("RGBA").convert("RGBa")
+    elif image.mode not in ("L", "RGB"):
+        image = image.convert("L" if image.mode in ("1", "I", "F") else "RGB")
+    array = np.asarray(image)
+    return array[:, :, None] if array.ndim == 2 else array
+
+
+def estimate_background(read_array, size, method=AUTO_TRIM_BACKGROUND, border=AUTO_TRIM_BORDER):
+    """
+    背景色をチャンネルごとの値の配列で返す。read_array(box)はboxの範囲の配列を返す関数。
+    "edges"は四辺の幅borderの画素の中央値、"corners"は四隅のborder四方の中央値。色のタプルはそのまま使う。
+    """
+    if not isinstance(method, str):
+        return np.asarray(method, dtype=np.int16).reshape(-1)
+    w, h = size
+    b = max(1, min(border, w, h))
+    if method == "corners":
+        boxes = [(0, 0, b, b), (w - b, 0, w, b), (0, h - b, b, h), (w - b, h - b, w, h)]
+    elif method == "edges":
+        boxes = [(0, 0, w, b), (0, h - b, w, h), (0, 0, b, h), (w - b, 0, w, h)]
+    else:
+        raise ValueError(f"unknown background method: {method}")
+    samples = [read_array(box) for box in boxes]
+    pixels = np.concatenate([sample.reshape(-1, sample.shape[2]) for sample in samples])
+    return np.median(pixels, axis=0).astype(np.int16)
+
+
+def _content_counts(array, background, tolerance):
+    """背景でない画素の数を、行ごと・列ごとに数えて返す。"""
+    # 背景色のチャンネル数が違う場合(グレースケールの画像に色を指定したなど)は先頭から使う
+    background = background[:array.shape[2]]
+    diff = np.abs(array.astype(np.int16) - background).max(axis=2) > tolerance
+    return diff.sum(axis=1), diff.sum(axis=0)
+
+
+def _first_last(counts, min_content, extent):
+    """countsが内容とみなす閾値を超える最初と最後の位置。なければNone。"""
+    threshold = int(min_content * extent)
+    indices = np.flatnonzero(counts > threshold)
+    if indices.size == 0:
+        return None
+    return int(indices[0]), int(indices[-1])
+
+
+def find_content_box(image, tolerance=AUTO_TRIM_TOLERANCE, background=AUTO_TRIM_BACKGROUND,
+                     min_content=AUTO_TRIM_MIN_CONTENT, proxy=None, proxy_size=AUTO_TRIM_PROXY_SIZE,
+                     read_region=None):
+    """
+    背景色の余白を除いた内容の範囲を画像座標のボックス(left, top, right, bottom)で返す。内容がなければNone。
+    まず縮小画像で大まかな範囲を求め、原寸では求めた範囲の四辺の近くだけを調べる。
+    縮小画像で背景と見分けられないほど小さく薄い内容(ゴミ程度)は無視される。
+    proxyに縮小画像を渡すとそれを使い、read_regionを渡すと原寸の画像の代わりにそれで範囲を読み込む
+    (imageはsizeだけを使うので、未デコードの画像ではsizeを持つ任意のオブジェクトでよい)。
+    """
+    _require_numpy()
+    if read_region is None:
+        read_region = image.crop
+    width, height = image.size
+    if proxy is None:
+        proxy = _reduce(image, proxy_size)
+        if proxy is None:
+            return _content_box_full(_to_array(image), tolerance, background, min_content)
+    # 背景色は縮小でぼけない原寸の縁から推定する
+    background_color = estimate_background(lambda box: _to_array(read_region(box)), (width, height), background)
+    proxy_array = _to_array(proxy)
+    proxy_h, proxy_w = proxy_array.shape[:2]
+    rows, cols = _content_counts(proxy_array, background_color, tolerance)
+    row_range = _first_last(rows, min_content, proxy_w)
+    col_range = _first_last(cols, min_content, proxy_h)
+    if row_range is None or col_range is None:
+        return None
+    scale_x = width / proxy_w
+    scale_y = height / proxy_h
+    # 縮小画像の1画素は原寸のscale四方に当たるので、前後1画素分の帯を原寸で調べる
+    x_lo = max(0, math.floor((col_range[0] - 1) * scale_x))
+    x_hi = min(width, math.ceil((col_range[1] + 2) * scale_x))
+    y_lo = max(0, math.floor((row_range[0] - 1) * scale_y))
+    y_hi = min(height, math.ceil((row_range[1] + 2) * scale_y))
+    left_band = min(width, math.ceil((col_range[0] + 1) * scale_x))
+    right_band = max(0, math.floor(col_range[1] * scale_x))
+    top_band = min(height, math.ceil((row_range[0] + 1) * scale_y))
+    bottom_band = max(0, math.floor(row_range[1] * scale_y))
+
+    def refine(box, axis, last):
+        region = _to_array(read_region(box))
+        rows, cols = _content_counts(region, background_color, tolerance)
+        counts, extent = (cols, region.shape[0]) if axis == "x" else (rows, region.shape[1])
+        found = _first_last(counts, min_content, extent)
+        if found is None:
+            return None
+        return found[1] if last else found[0]
+
+    left = refine((x_lo, y_lo, left_band, y_hi), "x", False)
+    right = refine((right_band, y_lo, x_hi, y_hi), "x", True)
+    top = refine((x_lo, y_lo, x_hi, top_band), "y", False)
+    bottom = refine((x_lo, bottom_band, x_hi, y_hi), "y", True)
+    # 帯の中で見つからなければ縮小画像で求めた位置を使う
+    left = x_lo + left if left is not None else math.floor(col_range[0] * scale_x)
+    right = right_band + right + 1 if right is not None else math.ceil((col_range[1] + 1) * scale_x)
+    top = y_lo + top if top is not None else math.floor(row_range[0] * scale_y)
+    bottom = bottom_band + bottom + 1 if bottom is not None else math.ceil((row_range[1] + 1) * scale_y)
+    if right <= left or bottom <= top:
+        return None
+    return (left, top, min(width, right), min(height, bottom))
+
+
+def _content_box_full(array, tolerance, background, min_content):
+    """縮小せずに画像全体から内容の範囲を求める。"""
+    background_color = estimate_background(
+        lambda box: array[box[1]:box[3], box[0]:box[2]], (array.shape[1], array.shape[0]), background)
+    rows, cols = _content_counts(array, background_color, tolerance)
+    height, width = array.shape[:2]
+    row_range = _first_last(rows, min_content, width)
+    col_range = _first_last(cols, min_content, height)
+    if row_range is None or col_range is None:
+        return None
+    return (col_range[0], row_range[0], col_range[1] + 1, row_range[1] + 1)
+
+
+def _otsu_threshold(gray):
+    """グレースケールの配列を2つに分ける閾値を大津の方法で求める。"""
+    hist = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    total = hist.sum()
+    levels = np.arange(256)
+    weight0 = np.cumsum(hist)
+    weight1 = total - weight0
+    mean0 = np.cumsum(hist * levels)
+    mean_total = mean0[-1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        between = (mean_total * weight0 / total - mean0) ** 2 / (weight0 * weight1)
+    between[~np.isfinite(between)] = 0
+    return int(np.argmax(between))
+
+
+def _projection_scores(ys, xs, angles):
+    """
+    各角度で画素を回転させたときの行ごとの画素数の二乗和。
+    文字の行が水平に揃う角度で行ごとの数の偏りが大きくなり、値が最大になる。
+    """
+    radians = np.radians(angles)[:, None]
+    rows = ys[None, :] * np.cos(radians) + xs[None, :] * np.sin(radians)
+    rows = np.rint(rows).astype(np.int64)
+    rows -= rows.min()
+    bins = int(rows.max()) + 1
+    # 全角度の投影をまとめて1回のbincountで数える
+    offsets = (np.arange(len(angles)) * bins)[:, None]
+    counts = np.bincount((rows + offsets).ravel(), minlength=bins * len(angles)).reshape(len(angles), bins)
+    return (counts.astype(np.float64) ** 2).sum(axis=1)
+
+
+def estimate_skew(image, max_angle=DESKEW_MAX_ANGLE, proxy_size=DESKEW_PROXY_SIZE, max_points=DESKEW_MAX_POINTS):
+    """
+    文書などの傾きを射影プロファイルで求め、水平にするためにImage.rotateに渡す角度(度)を返す。
+    縮小画像で求めるので精度は0.1度程度。
+    縮小画像の文字などの画素(大津の方法で背景と分けた少ない方)を各角度で行方向に射影し、
+    粗い刻みから細かい刻みへ順に探す。文字などが見つからなければNoneを返す。
+    """
+    _require_numpy()
+    proxy = _reduce(image, proxy_size) or image
+    if proxy.mode in ("RGBA", "LA", "PA") or (proxy.mode == "P" and "transparency" in proxy.info):
+        # 透明な部分は白として扱う
+        rgba = proxy.convert("RGBA")
+        flat = Image.new("RGBA", rgba.size, (255, 255, 255, 255))
+        flat.alpha_composite(rgba)
+        proxy = flat
+    gray = _to_array(proxy.convert("L") if proxy.mode != "L" else proxy)[:, :, 0]
+    threshold = _otsu_threshold(gray)
+    ink = gray <= threshold
+    if ink.sum() * 2 > ink.size:
+        # 暗い背景に明るい文字の場合
+        ink = ~ink
+    ys, xs = np.nonzero(ink)
+    if ys.size == 0:
+        return None
+    rng = np.random.default_rng(0)
+    if ys.size > max_points:
+        pick = rng.choice(ys.size, max_points, replace=False)
+        ys, xs = ys[pick], xs[pick]
+    # 画素の格子に沿う0度だけ射影が鋭くならないよう、各画素の位置を画素内でずらしてから中心基準にする
+    ys = ys + rng.uniform(-0.5, 0.5, ys.size) - gray.shape[0] / 2
+    xs = xs + rng.uniform(-0.5, 0.5, xs.size) - gray.shape[1] / 2
+    best = 0.0
+    for step, span in DESKEW_STEPS:
+        if span is None:
+            angles = np.arange(-max_angle, max_angle + step / 2, step)
+        else:
+            angles = best + np.arange(-span, span + 1) * step
+        scores = _projection_scores(ys, xs, angles)
+        best = float(angles[int(np.argmax(scores))])
+    # 傾きを打ち消す向きに回す
+    return round(-best, 3) + 0.0
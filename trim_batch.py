@@ -0,0 +1,346 @@
+"""
+編集手順(レシピ)の記録と一括適用。wxに依存しない。
+画面で行った回転・トリミング・リサイズと保存時のJPG品質をレシピとしてJSONに保存し、
+フォルダ内の画像すべてに全CPUコアのプロセスで並列に適用する。
+トリミング範囲は画像サイズに対する比(0〜1)で記録するので、大きさの違う画像にも使える。
+
+    python trim_batch.py recipe.json input_dir output_dir [--workers N] [--recursive]
+                         [--auto-trim TOLERANCE] [--straighten] [--lossless] [--target-kb KB]
+                         [--export PROFILES]
+
+--exportに書き出しプロファイル(JSON)を渡すと、1ファイルからプロファイルごとに複数のファイルを書き出す。
+処理が終わったファイルは出力先のdoneログにレシピのハッシュと共に1行ずつ追記し、
+途中で止めても同じレシピ・オプションで再実行すれば続きから処理する。レシピやオプションを変えれば全ファイルを処理し直す。
+失敗したファイルはエラー内容を表示し、終了コード1を返す。
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from trim_core import TrimSession, DEFAULT_JPEG_QUALITY
+from trim_export import ExportJob, load_profiles, validate_profiles
+
+RECIPE_VERSION = 1
+RECIPE_SUFFIX = "_trm"  # 出力ファイル名に付ける文字列
+DONE_LOG_NAME = ".trim_batch_done.txt"  # 出力先に置く処理済みファイルの一覧
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff", ".webp", ".gif")
+# 操作ごとに必須の項目
+STEP_KEYS = {"rotate": ("angle",), "crop": ("box",), "resize": ("long_side",), "crop_resize": ("box", "long_side"),
+             "auto_trim": (), "straighten": ()}
+
+
+class RecipeError(ValueError):
+    """レシピの内容が不正な場合の例外。"""
+
+
+def _normalize_box(box, size):
+    w, h = size
+    left, top, right, bottom = box
+    return [left / w, top / h, right / w, bottom / h]
+
+
+def recipe_from_session(session, jpeg_quality=DEFAULT_JPEG_QUALITY, aspect=None, lossless=False, max_bytes=None):
+    """
+    TrimSessionで元画像から現在の画像までに行った操作をレシピにする。
+    aspectに(横, 縦)の比を渡すと、適用時にトリミング範囲をその縦横比に合わせる。
+    losslessがTrueなら、JPEGはできる限りjpegtranで再エンコードせずに保存する。
+    max_bytesを指定すると、JPEG・WebPはそのバイト数に収まる最も高い品質で保存する。
+    """
+    steps = []
+    for op, params, size in session.operations():
+        if op == "rotate":
+            steps.append({"op": "rotate", "angle": params})
+        elif op == "crop":
+            step = {"op": "crop", "box": _normalize_box(params, size)}
+            if aspect:
+                step["aspect"] = list(aspect)
+            steps.append(step)
+        elif op == "resize":
+            steps.append({"op": "resize", "long_side": params[1]})
+        elif op == "crop_resize":
+            box, _, long_side = params
+            step = {"op": "crop_resize", "box": _normalize_box(box, size), "long_side": long_side}
+            if aspect:
+                step["aspect"] = list(aspect)
+            steps.append(step)
+    return {"version": RECIPE_VERSION, "steps": steps,
+            "save": {"jpeg_quality": jpeg_quality, "suffix": RECIPE_SUFFIX, "lossless": lossless,
+                     "max_bytes": max_bytes}}
+
+
+def save_recipe(recipe, path):
+    with open(path, "w", encoding="utf-8") as fp:
+        json.dump(recipe, fp, indent=2, ensure_ascii=False)
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def validate_recipe(recipe):
+    """レシピの操作と保存の設定を確かめる。不正ならRecipeErrorを送出する。"""
+    if not isinstance(recipe.get("steps"), list):
+        raise RecipeError("steps must be a list")
+    for step in recipe["steps"]:
+        if not isinstance(step, dict) or step.get("op") not in STEP_KEYS:
+            raise RecipeError(f"unknown operation: {step}")
+        missing = [key for key in STEP_KEYS[step["op"]] if key not in step]
+        if missing:
+            raise RecipeError("%s requires %s" % (step["op"], ", ".join(missing)))
+        if "angle" in step and not _is_number(step["angle"]):
+            raise RecipeError(f"invalid angle: {step['angle']}")
+        if "box" in step and not (isinstance(step["box"], list) and len(step["box"]) == 4 and
+                                  all(_is_number(value) for value in step["box"])):
+            raise RecipeError(f"invalid box: {step['box']}")
+        if "long_side" in step and not (_is_int(step["long_side"]) and step["long_side"] > 0):
+            raise RecipeError(f"invalid long_side: {step['long_side']}")
+    save = recipe.get("save")
+    if not isinstance(save, dict):
+        raise RecipeError("save must be an object")
+    quality = save.get("jpeg_quality", DEFAULT_JPEG_QUALITY)
+    if not (_is_int(quality) and 1 <= quality <= 100):
+        raise RecipeError(f"invalid jpeg_quality: {quality}")
+    suffix = save.get("suffix", RECIPE_SUFFIX)
+    if not suffix or not isinstance(suffix, str) or os.sep in suffix or "/" in suffix:
+        raise RecipeError(f"invalid suffix: {suffix}")
+    if not isinstance(save.get("lossless", False), bool):
+        raise RecipeError(f"invalid lossless: {save['lossless']}")
+    max_bytes = save.get("max_bytes")
+    if max_bytes is not None and not (_is_int(max_bytes) and max_bytes > 0):
+        raise RecipeError(f"invalid max_bytes: {max_bytes}")
+
+
+def load_recipe(path):
+    with open(path, encoding="utf-8") as fp:
+        recipe = json.load(fp)
+    if not isinstance(recipe, dict) or recipe.get("version") != RECIPE_VERSION:
+        raise RecipeError(f"unsupported recipe: {path}")
+    recipe.setdefault("save", {})
+    validate_recipe(recipe)
+    if "export" in recipe:
+        recipe["export"] = validate_profiles(recipe["export"])
+    return recipe
+
+
+def denormalize_box(box, size, aspect=None):
+    """
+    比で表したboxを画像座標のボックスにする。aspectが指定されていれば、
+    中心と幅を保ち(収まらなければ高さを基準にして)その縦横比に合わせる。
+    """
+    w, h = size
+    left, top, right, bottom = box
+    if aspect:
+        ratio = aspect[0] / aspect[1]
+        cx = (left + right) / 2 * w
+        cy = (top + bottom) / 2 * h
+        box_w = min((right - left) * w, w)
+        box_h = box_w / ratio
+        if box_h > h:
+            box_h = h
+            box_w = box_h * ratio
+        left_px = min(max(0, cx - box_w / 2), w - box_w)
+        top_px = min(max(0, cy - box_h / 2), h - box_h)
+        left, top, right, bottom = (left_px / w, top_px / h, (left_px + box_w) / w, (top_px + box_h) / h)
+    pixel_box = [
+        max(0, min(w, int(round(left * w)))), max(0, min(h, int(round(top * h)))),
+        max(0, min(w, int(round(right * w)))), max(0, min(h, int(round(bottom * h)))),
+    ]
+    # 小さな画像でも1画素は残す
+    pixel_box[2] = max(pixel_box[2], min(w, pixel_box[0] + 1))
+    pixel_box[3] = max(pixel_box[3], min(h, pixel_box[1] + 1))
+    if pixel_box[2] <= pixel_box[0] or pixel_box[3] <= pixel_box[1]:
+        raise RecipeError("crop box is empty for image size %dx%d" % (w, h))
+    return tuple(pixel_box)
+
+
+def apply_recipe(session, recipe):
+    """レシピの操作をTrimSessionに順に適用する。"""
+    previous = None
+    for step in recipe["steps"]:
+        op = step.get("op")
+        if op == "rotate":
+            if previous == "rotate":
+                # 続けて記録された回転は、前の回転の結果を基準にした角度(もどるの後に回転した場合)
+                session.commit_rotation()
+            session.rotate(step["angle"])
+        elif op == "crop":
+            session.crop(denormalize_box(step["box"], session.size, step.get("aspect")))
+        elif op == "resize":
+            session.resize(step["long_side"])
+        elif op == "crop_resize":
+            session.crop_resize(denormalize_box(step["box"], session.size, step.get("aspect")), step["long_side"])
+        elif op == "auto_trim":
+            # 余白の自動トリミング。オプションはtrim_auto.find_content_boxの引数と同じ名前
+            options = {key: step[key] for key in ("tolerance", "background", "min_content") if key in step}
+            box = session.content_box(**options)
+            if box is not None:
+                session.crop(box)
+        elif op == "straighten":
+            # 傾きの自動補正。オプションはtrim_auto.estimate_skewの引数と同じ名前
+            options = {key: step[key] for key in ("max_angle",) if key in step}
+            session.straighten(**options)
+        else:
+            raise RecipeError(f"unknown operation: {op}")
+        previous = op
+
+
+def output_path(path, input_dir, output_dir, recipe):
+    """
+    出力先のパス。input_dirからのサブフォルダの構成は出力先でも保つ。
+    書き出しプロファイルがある場合は、各プロファイルの末尾の文字列と拡張子を付ける前のパスを返す。
+    """
+    relative = os.path.relpath(path, input_dir)
+    name, ext = os.path.splitext(relative)
+    if recipe.get("export"):
+        return os.path.join(output_dir, name)
+    return os.path.join(output_dir, name + recipe["save"].get("suffix", RECIPE_SUFFIX) + ext)
+
+
+def process_file(path, recipe, save_path):
+    """
+    1ファイルにレシピを適用してsave_pathに保存し、保存先のパスを返す。ワーカープロセスで実行する。
+    書き出しプロファイルがある場合はプロファイルごとに書き出し、保存先のパスのリストを返す。
+    """
+    # 履歴は使わないのでチェックポイントを残さない
+    session = TrimSession.open(path, max_history=2, memory_budget=0)
+    apply_recipe(session, recipe)
+    if recipe.get("export"):
+        return ExportJob(session.current_image, save_path, recipe["export"]).run()
+    save = recipe["save"]
+    return session.save(jpeg_quality=save.get("jpeg_quality", DEFAULT_JPEG_QUALITY), save_path=save_path,
+                        lossless=save.get("lossless", False), max_bytes=save.get("max_bytes"))
+
+
+def find_images(input_dir, recursive=False):
+    paths = []
+    for root, dirs, files in os.walk(input_dir):
+        for file_name in sorted(files):
+            if os.path.splitext(file_name)[1].lower() in IMAGE_EXTENSIONS:
+                paths.append(os.path.join(root, file_name))
+        if not recursive:
+            break
+        dirs.sort()
+    return paths
+
+
+def recipe_key(recipe):
+    """doneログでレシピを区別するハッシュ。コマンドラインで変えた操作・保存の設定・書き出しプロファイルも含む。"""
+    data = json.dumps(recipe, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:16]
+
+
+def read_done_log(path, key):
+    """doneログのうち、ハッシュがkeyのレシピで処理済みのファイルのパス。"""
+    if not os.path.exists(path):
+        return set()
+    done = set()
+    with open(path, encoding="utf-8") as fp:
+        for line in fp:
+            line_key, _, done_path = line.rstrip("\n").partition("\t")
+            if line_key == key and done_path:
+                done.add(done_path)
+    return done
+
+
+def run_batch(recipe, paths, input_dir, output_dir, workers=None, done_log=None, log=print):
+    """
+    pathsの画像にレシピを並列に適用する。done_logに同じレシピで処理済みとあるファイルは飛ばし、成功したファイルを追記する。
+    失敗したファイルの[(パス, エラー内容)]を返す。
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    key = recipe_key(recipe)
+    done = read_done_log(done_log, key) if done_log else set()
+    pending = [path for path in paths if os.path.abspath(path) not in done]
+    if len(pending) < len(paths):
+        log("skip %d files already done" % (len(paths) - len(pending)))
+    failures = []
+    done_fp = open(done_log, "a", encoding="utf-8") if done_log else None
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            claimed = {}
+            for path in pending:
+                save_path = output_path(path, input_dir, output_dir, recipe)
+                if save_path in claimed:
+                    # 書き出しプロファイルでは拡張子だけが違うファイルの出力先が重なる
+                    failures.append((path, "output collides with %s" % claimed[save_path]))
+                    log("ERROR %s: %s" % (path, failures[-1][1]))
+                    continue
+                claimed[save_path] = path
+                futures[executor.submit(process_file, path, recipe, save_path)] = path
+            for count, future in enumerate(as_completed(futures), 1):
+                path = futures[future]
+                try:
+                    saved = future.result()
+                except Exception as exc:
+                    failures.append((path, "%s: %s" % (type(exc).__name__, exc)))
+                    log("[%d/%d] ERROR %s: %s" % (count, len(pending), path, failures[-1][1]))
+                    continue
+                if done_fp is not None:
+                    # 中断しても処理済みの分を失わないよう1件ごとに書き出す
+                    done_fp.write("%s\t%s\n" % (key, os.path.abspath(path)))
+                    done_fp.flush()
+                log("[%d/%d] %s -> %s" % (count, len(pending), path, saved))
+    finally:
+        if done_fp is not None:
+            done_fp.close()
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="レシピをフォルダ内の画像に一括で適用する")
+    parser.add_argument("recipe", help="画面から保存したレシピ(JSON)")
+    parser.add_argument("input_dir")
+    parser.add_argument("output_dir")
+    parser.add_argument("--workers", type=int, default=None, help="プロセス数(既定はCPUコア数)")
+    parser.add_argument("--recursive", action="store_true", help="サブフォルダの画像も処理する")
+    parser.add_argument("--done-log", help="処理済みファイルの一覧(既定は出力先の%s)" % DONE_LOG_NAME)
+    parser.add_argument("--auto-trim", type=int, metavar="TOLERANCE", default=None,
+                        help="レシピの前に、背景色との差がTOLERANCE以下の余白を自動でトリミングする")
+    parser.add_argument("--straighten", action="store_true", help="レシピの前に傾きを自動で補正する")
+    parser.add_argument("--lossless", action="store_true",
+                        help="トリミングと90度単位の回転だけのJPEGはjpegtranで再エンコードせずに保存する")
+    parser.add_argument("--target-kb", type=float, default=None,
+                        help="JPEG・WebPをこのサイズ(KB)に収まる最も高い品質で保存する")
+    parser.add_argument("--export", metavar="PROFILES",
+                        help="書き出しプロファイル(JSON)。プロファイルごとに形式・長辺・品質の違うファイルを書き出す")
+    args = parser.parse_args(argv)
+
+    recipe = load_recipe(args.recipe)
+    # 回転でできる四隅の余白を背景と誤らないよう、余白のトリミングを先に行う
+    prefix = []
+    if args.auto_trim is not None:
+        prefix.append({"op": "auto_trim", "tolerance": args.auto_trim})
+    if args.straighten:
+        prefix.append({"op": "straighten"})
+    recipe["steps"] = prefix + recipe["steps"]
+    if args.lossless:
+        recipe["save"]["lossless"] = True
+    if args.target_kb:
+        recipe["save"]["max_bytes"] = int(args.target_kb * 1024)
+    if args.export:
+        recipe["export"] = load_profiles(args.export)
+    # コマンドラインで変えた設定も、処理を始める前に確かめる
+    try:
+        validate_recipe(recipe)
+    except RecipeError as exc:
+        parser.error(str(exc))
+    paths = find_images(args.input_dir, args.recursive)
+    done_log = args.done_log or os.path.join(args.output_dir, DONE_LOG_NAME)
+    failures = run_batch(recipe, paths, args.input_dir, args.output_dir, args.workers, done_log)
+    if failures:
+        print("%d of %d files failed:" % (len(failures), len(paths)))
+        for path, error in failures:
+            print("  %s: %s" % (path, error))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
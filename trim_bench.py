@@ -0,0 +1,363 @@
+"""
+画面を使わずに実行できるベンチマーク。
+合成した画像(1〜200MP、RGB・RGBA・L・P)で、ImagePanelが行う操作と同じTrimSessionの処理
+(回転・トリミング・リサイズ・形式と品質ごとの保存と読み込み・表示用ビットマップの作成)と、
+トリミング範囲の計算(trim_geometry)の時間を測り、操作ごとのメモリ使用量の増加分も記録する。
+
+    python trim_bench.py --sizes 1 12 --output bench.json
+    python trim_bench.py --sizes 1 12 --baseline bench.json
+
+結果はJSONで保存でき、--baselineに以前の結果を渡すと操作ごとの比を表示する。
+許容範囲(--tolerance)を超えて遅くなった操作があれば終了コード1を返す。
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import PIL
+from PIL import Image
+from trim_core import TrimSession
+from trim_display import DisplayPyramid
+from trim_geometry import SelectionGeometry, Rect, HANDLE_NAMES
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+BENCH_SIZES_MP = (1, 12, 50, 200)   # 合成する画像の画素数(メガピクセル)
+BENCH_MODES = ("RGB", "RGBA", "L", "LA", "P", "CMYK", "I;16")
+BENCH_REPEAT = 3    # 各操作の繰り返し回数。中央値と最小値を記録する
+BENCH_ASPECT = (3, 2)   # 合成する画像の縦横比
+# 保存する形式(拡張子)と品質。品質はJPEGだけに使う
+BENCH_SAVE_FORMATS = ((".jpg", 70), (".jpg", 95), (".png", None), (".tif", None))
+BENCH_ROTATION_ANGLE = 1.5
+BENCH_RESIZE_SIZE = 1024
+BENCH_DISPLAY_SIZE = (1600, 900)    # 表示用ビットマップを作る大きさ
+MICRO_LOOPS = 20000     # トリミング範囲の計算の繰り返し回数
+MEMORY_SAMPLE_INTERVAL = 0.005  # メモリ使用量を調べる間隔(秒)
+REGRESSION_TOLERANCE = 0.10     # 基準より何割遅くなったら遅くなったとみなすか
+
+
+def current_rss():
+    """プロセスの使用メモリ(バイト)。取得できない環境ではNone。"""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm") as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class PeakMemory:
+    """
+    withの間、別スレッドで使用メモリ(RSS)を調べ続け、最大値をpeak_rssに、開始時からの最大の増加分をpeak_bytesに入れる。
+    プロセスがすでに確保していて再利用されたメモリは増加分に数えられない。
+    """
+
+    def __init__(self, interval=MEMORY_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.peak_bytes = None
+        self.peak_rss = None
+        self._start = None
+        self._peak = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            rss = current_rss()
+            if rss is not None and rss > self._peak:
+                self._peak = rss
+
+    def __enter__(self):
+        self._start = current_rss()
+        if self._start is not None:
+            self._peak = self._start
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            rss = current_rss()
+            self.peak_rss = max(self._peak, rss or 0)
+            self.peak_bytes = self.peak_rss - self._start
+        return False
+
+
+def make_image(megapixels, mode, aspect=BENCH_ASPECT):
+    """
+    グラデーションとノイズを合成した画像を作る。圧縮の時間が実際の写真に近くなるよう、平坦な画像にはしない。
+    大きな画像でも速く作れるよう、1/4の大きさで作ってから拡大する。
+    """
+    aw, ah = aspect
+    height = max(1, int(round((megapixels * 1000000 * ah / aw) ** 0.5)))
+    width = max(1, int(round(megapixels * 1000000 / height)))
+    small = (max(1, width // 4), max(1, height // 4))
+    gradient = Image.linear_gradient("L").resize(small, Image.BILINEAR)
+    noise = Image.effect_noise(small, 40).convert("L")
+    bands = [
+        Image.blend(gradient, noise, 0.3),
+        Image.blend(gradient.transpose(Image.Transpose.ROTATE_90).resize(small), noise, 0.3),
+        Image.blend(gradient.transpose(Image.Transpose.FLIP_TOP_BOTTOM), noise, 0.5),
+    ]
+    alpha = gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+    if mode in ("L", "P", "I;16"):
+        image = bands[0].resize((width, height), Image.BICUBIC)
+        if mode == "P":
+            # putpaletteでLからPになる
+            image.putpalette([v for i in range(256) for v in (i, 255 - i, (i * 7) % 256)])
+        elif mode == "I;16":
+            # 8bitの値を16bitの範囲に広げる
+            image = image.convert("I").point(lambda value: value * 257).convert("I;16")
+        return image
+    if mode == "LA":
+        bands = [bands[0], alpha]
+    elif mode == "RGBA":
+        bands.append(alpha)
+    elif mode == "CMYK":
+        bands.append(Image.blend(alpha, noise, 0.2))
+    return Image.merge(mode, bands).resize((width, height), Image.BICUBIC)
+
+
+def measure(func, repeat=BENCH_REPEAT, setup=None):
+    """funcをrepeat回実行して、所要時間(秒)のリストと、メモリの最大増加分と最大使用量(バイト)を返す。"""
+    times = []
+    peak = None
+    peak_rss = None
+    for _ in range(repeat):
+        args = setup() if setup is not None else ()
+        with PeakMemory() as memory:
+            start = time.perf_counter()
+            func(*args)
+            times.append(time.perf_counter() - start)
+        if memory.peak_bytes is not None:
+            peak = max(peak or 0, memory.peak_bytes)
+            peak_rss = max(peak_rss or 0, memory.peak_rss)
+        del args
+    return times, peak, peak_rss
+
+
+def new_session(image):
+    session = TrimSession()
+    session.set_image(image, file_name="bench.png")
+    return session
+
+
+def center_box(size, fraction=0.5):
+    w, h = size
+    cw, ch = int(w * fraction), int(h * fraction)
+    left, top = (w - cw) // 2, (h - ch) // 2
+    return (left, top, left + cw, top + ch)
+
+
+def image_cases(image, work_dir, prefix="bench"):
+    """
+    画像1枚に対する(操作名, 実行する関数, 準備する関数)を順に返す。
+    保存したファイルはwork_dirにprefixを付けて置き、続けて読み込みの時間を測るのに使う。
+    """
+    def rotate_preview(session):
+        # 回転ボタンを押したときの処理。表示用の縮小画像だけを回転する
+        session.rotate(BENCH_ROTATION_ANGLE)
+        session.display_image
+
+    def rotate_apply(session):
+        session.rotate(BENCH_ROTATION_ANGLE)
+        session.current_image
+
+    def rotate_crop(session):
+        session.rotate(BENCH_ROTATION_ANGLE)
+        session.crop(center_box(session.size))
+        session.current_image
+
+    def crop(session):
+        session.crop(center_box(session.size))
+        session.current_image
+
+    def resize(session):
+        session.resize(BENCH_RESIZE_SIZE)
+        session.current_image
+
+    def crop_resize(session):
+        session.crop_resize(center_box(session.size), BENCH_RESIZE_SIZE)
+        session.current_image
+
+    def display_build(session):
+        # ImagePanel._build_layer_bitmapのうちwxを使わない部分
+        DisplayPyramid(session.display_image).get_display(BENCH_DISPLAY_SIZE, Image.BILINEAR).tobytes()
+
+    def display_resize(pyramid):
+        # 段を作り終えた後の、ウィンドウの大きさを変えたときの再描画。表示用のモードへの変換は含まれない
+        pyramid.get_display(BENCH_DISPLAY_SIZE, Image.BILINEAR).tobytes()
+
+    def warm_pyramid():
+        pyramid = DisplayPyramid(new_session(image).display_image)
+        pyramid.get(BENCH_DISPLAY_SIZE)
+        return (pyramid,)
+
+    setup = lambda: (new_session(image),)
+    for name, func in (("rotate_preview", rotate_preview), ("rotate_apply", rotate_apply),
+                       ("rotate_crop", rotate_crop), ("crop", crop), ("resize", resize),
+                       ("crop_resize", crop_resize), ("display_build", display_build)):
+        yield name, func, setup
+    yield "display_resize", display_resize, warm_pyramid
+
+    for ext, quality in BENCH_SAVE_FORMATS:
+        path = os.path.join(work_dir, prefix + ext)
+        label = ext.lstrip(".") + ("_q%d" % quality if quality is not None else "")
+
+        def save(session, path=path, quality=quality):
+            session.save(jpeg_quality=quality, save_path=path)
+
+        def open_file(path=path):
+            TrimSession.open(path, preview_size=BENCH_DISPLAY_SIZE).display_image
+
+        yield "save_" + label, save, setup
+        yield "open_" + label, open_file, None
+
+
+def run_image_benchmarks(sizes, modes, repeat, work_dir, log=print):
+    results = []
+    for megapixels in sizes:
+        for mode in modes:
+            image = make_image(megapixels, mode)
+            prefix = "bench_%s_%s" % (megapixels, mode)
+            failed = set()
+            for name, func, setup in image_cases(image, work_dir, prefix):
+                record = {"group": "image", "name": name, "mode": mode, "megapixels": megapixels,
+                          "size": list(image.size)}
+                try:
+                    if name.startswith("open_") and "save_" + name[5:] in failed:
+                        raise FileNotFoundError("not saved")
+                    times, peak, peak_rss = measure(func, repeat, setup)
+                except (OSError, ValueError) as exc:
+                    # 保存形式に合わせたモードの変換でも扱えない組み合わせ
+                    failed.add(name)
+                    record["error"] = "%s: %s" % (type(exc).__name__, exc)
+                    log("%-16s %-5s %4sMP  %s" % (name, mode, megapixels, record["error"]))
+                    results.append(record)
+                    continue
+                record.update(_time_fields(times))
+                record["peak_mb"] = round(peak / 1048576, 1) if peak is not None else None
+                record["rss_peak_mb"] = round(peak_rss / 1048576, 1) if peak_rss is not None else None
+                log("%-16s %-5s %4sMP  median %9.2f ms  min %9.2f ms  peak %s MB" % (
+                    name, mode, megapixels, record["median_ms"], record["min_ms"], record["peak_mb"]))
+                results.append(record)
+            del image
+    return results
+
+
+def _time_fields(times):
+    return {"median_ms": round(statistics.median(times) * 1000, 3), "min_ms": round(min(times) * 1000, 3),
+            "repeat": len(times)}
+
+
+def geometry_cases():
+    """トリミング範囲の計算1回分の関数を(名前, 関数)で返す。"""
+    geometry = SelectionGeometry(*BENCH_DISPLAY_SIZE)
+    origin = Rect(400, 200, 600, 400)
+    crop = origin.as_tuple()
+    for ratio_name, ratio in (("free", None), ("ratio", 16 / 9)):
+        for handle in HANDLE_NAMES:
+            yield ("resize_%s_%s" % (ratio_name, handle),
+                   lambda handle=handle, ratio=ratio: geometry.resize(origin, (1200, 800), handle, ratio))
+        yield ("create_" + ratio_name,
+               lambda ratio=ratio: geometry.create((100, 100), (900, 700), ratio))
+    yield "move", lambda: geometry.move(origin, 37, -21)
+    yield "hit_test_handle", lambda: geometry.hit_test_handle(crop, (1000, 600))
+    yield "apply_aspect", lambda: geometry.apply_aspect(crop, 4 / 3)
+
+
+def run_geometry_benchmarks(repeat, loops=MICRO_LOOPS, log=print):
+    results = []
+    for name, func in geometry_cases():
+        def loop(func=func):
+            for _ in range(loops):
+                func()
+        times, _, _ = measure(loop, repeat)
+        record = {"group": "geometry", "name": name, "mode": None, "megapixels": None, "loops": loops}
+        record.update(_time_fields(times))
+        record["per_call_us"] = round(min(times) / loops * 1000000, 3)
+        log("%-28s %8.3f us/call" % (name, record["per_call_us"]))
+        results.append(record)
+    return results
+
+
+def result_key(record):
+    return (record["group"], record["name"], record["mode"], record["megapixels"])
+
+
+def compare(results, baseline, tolerance=REGRESSION_TOLERANCE, log=print):
+    """基準の結果と最小時間を比べ、許容範囲を超えて遅くなった操作のリストを返す。"""
+    base = {result_key(record): record for record in baseline["results"] if "min_ms" in record}
+    regressions = []
+    for record in results:
+        old = base.get(result_key(record))
+        if old is None or "min_ms" not in record or not old["min_ms"]:
+            continue
+        ratio = record["min_ms"] / old["min_ms"]
+        slower = ratio > 1 + tolerance
+        if slower:
+            regressions.append(record)
+        log("%-9s %-28s %-5s %5s  %9.2f -> %9.2f ms  x%.2f%s" % (
+            record["group"], record["name"], record["mode"] or "", record["megapixels"] or "",
+            old["min_ms"], record["min_ms"], ratio, "  SLOWER" if slower else ""))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Image-Trimming-Toolの処理時間とメモリ使用量を測る")
+    parser.add_argument("--sizes", type=float, nargs="+", default=list(BENCH_SIZES_MP), help="画像の画素数(MP)")
+    parser.add_argument("--modes", nargs="+", default=list(BENCH_MODES), choices=BENCH_MODES)
+    parser.add_argument("--repeat", type=int, default=BENCH_REPEAT)
+    parser.add_argument("--skip-images", action="store_true", help="画像の操作を測らない")
+    parser.add_argument("--skip-geometry", action="store_true", help="トリミング範囲の計算を測らない")
+    parser.add_argument("--output", help="結果を書き出すJSONファイル")
+    parser.add_argument("--baseline", help="比較する以前の結果のJSONファイル")
+    parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE)
+    args = parser.parse_args(argv)
+    sizes = [int(size) if size == int(size) else size for size in args.sizes]
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="trim_bench_") as work_dir:
+        if not args.skip_images:
+            results += run_image_benchmarks(sizes, args.modes, args.repeat, work_dir)
+    if not args.skip_geometry:
+        results += run_geometry_benchmarks(args.repeat)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "pillow": PIL.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "memory_measured": current_rss() is not None,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fp:
+            json.dump(report, fp, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as fp:
+            baseline = json.load(fp)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("%d operations are slower than the baseline." % len(regressions))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
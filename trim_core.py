@@ -0,0 +1,743 @@
+"""
+wxに依存しないトリミング処理のコア。
+GUI(Image-Trimming-Tool.py)からも、スクリプトやバッチ処理からも同じ処理を呼び出せるようにする。
+このモジュールはwxをimportしないこと。
+"""
+import os
+import io
+import math
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from trim_loader import open_source, image_nbytes
+from trim_display import DisplayPyramid
+from trim_modes import for_resampling, to_display_base, prepare_for_format, color_params
+from trim_auto import find_content_box, estimate_skew
+from trim_lossless import prepare_lossless_job
+from trim_encode import encode_to_size, encoder_view, TARGET_SIZE_FORMATS
+
+DEFAULT_JPEG_QUALITY = 70
+MAX_HISTORY = 10    # もどるで戻れる履歴の上限
+HISTORY_MEMORY_BUDGET = 1024 * 1024 * 1024  # もどる用のチェックポイント画像に使うメモリの上限(バイト)
+ROTATION_PROXY_SIZE = 1600   # 回転角の調整中に表示用として回転する縮小画像の長辺
+RESIZE_REDUCING_GAP = 3.0   # 大きく縮小するときは先にreduceで整数分の1にする(Noneで無効)
+CLIPBOARD_PNG_COMPRESS_LEVEL = 1    # クリップボード用PNGの圧縮レベル(速度優先)
+
+
+def display_rect_to_box(rect, display_size, image_size):
+    """
+    表示座標の矩形(x, y, w, h)を画像座標のボックス(left, top, right, bottom)に変換する。
+    表示サイズや変換後の幅・高さが0の場合はNoneを返す。
+    """
+    disp_w, disp_h = display_size
+    if disp_w == 0 or disp_h == 0:
+        return None
+    img_w, img_h = image_size
+    scale_x = img_w / disp_w
+    scale_y = img_h / disp_h
+    crop_x = max(0, rect[0])
+    crop_y = max(0, rect[1])
+    # 表示座標をround()を使って画像座標へ変換
+    x = round(crop_x * scale_x)
+    y = round(crop_y * scale_y)
+    w = round(rect[2] * scale_x)
+    h = round(rect[3] * scale_y)
+    if w == 0 or h == 0:
+        return None
+    return (x, y, x + w, y + h)
+
+
+def box_to_display_rect(box, display_size, image_size):
+    """画像座標のボックス(left, top, right, bottom)を表示座標の矩形(x, y, w, h)に変換する。"""
+    disp_w, disp_h = display_size
+    img_w, img_h = image_size
+    scale_x = disp_w / img_w
+    scale_y = disp_h / img_h
+    x = round(box[0] * scale_x)
+    y = round(box[1] * scale_y)
+    return (x, y, round(box[2] * scale_x) - x, round(box[3] * scale_y) - y)
+
+
+def fit_long_side(size, target_size):
+    """長辺がtarget_sizeになる縮小後のサイズを返す。縮小の必要がなければNoneを返す。"""
+    w, h = size
+    long_side = max(w, h)
+    if long_side <= target_size:
+        return None
+    # 長辺はちょうどtarget_sizeにし、短辺は比率を保って四捨五入する
+    short_side = max(1, int(round(min(w, h) * target_size / long_side)))
+    return (target_size, short_side) if w >= h else (short_side, target_size)
+
+
+def save_image_atomic(image, path, format=None, **params):
+    """
+    一時ファイルに書き出してからos.replaceで置き換える。
+    途中で失敗・強制終了しても、保存先に書きかけのファイルが残らない。
+    """
+    if format is None:
+        format = Image.registered_extensions().get(os.path.splitext(path)[1].lower())
+    return write_file_atomic(path, lambda fp: image.save(fp, format=format, **params))
+
+
+def write_file_atomic(path, write):
+    """write(fp)で一時ファイルに書き出してから、os.replaceでpathに置き換える。"""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "xb") as fp:
+            write(fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return path
+
+
+class SaveJob:
+    """
+    保存する画像・保存先・保存パラメータの組。画像は変更されないのでワーカースレッドに渡せる。
+    imageにはImageSnapshotも渡せ、その場合は原寸のデコードや回転もrun()の中(ワーカースレッド)で行う。
+    保存形式で書けないモードの変換も、run()の中で行う。
+    max_bytesを指定するとJPEG・WebPはそのバイト数に収まる最も高い品質で保存し、params["quality"]は使わない。
+    """
+
+    def __init__(self, image, path, format=None, params=None, max_bytes=None):
+        self.image = image
+        self.path = path
+        self.format = format
+        self.params = params or {}
+        self.max_bytes = max_bytes
+        self.quality = None     # ファイルサイズを指定した保存で選ばれた品質
+
+    def run(self):
+        save_dir = os.path.dirname(self.path)
+        if save_dir:
+            os.makedirs(save_dir, exist_ok=True)
+        format = self.format or Image.registered_extensions().get(os.path.splitext(self.path)[1].lower())
+        # 同じ画像を別のジョブと同時に保存してもよいように、このジョブ専用の画像オブジェクトで保存する
+        image = encoder_view(prepare_for_format(materialize(self.image), format))
+        params = dict(color_params(image, format), **self.params)
+        if self.max_bytes and format in TARGET_SIZE_FORMATS:
+            params.pop("quality", None)
+            self.quality, data = encode_to_size(image, format, self.max_bytes, **params)
+            return write_file_atomic(self.path, lambda fp: fp.write(data))
+        return save_image_atomic(image, self.path, format=format, **params)
+
+
+class BackgroundSaver:
+    """
+    SaveJobを1本のワーカースレッドで受け付けた順に実行する。
+    on_doneは保存の完了・失敗ごとにワーカースレッドからFutureを引数に呼ばれる。
+    """
+
+    def __init__(self, on_done=None):
+        self.on_done = on_done
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="save")
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    @property
+    def pending(self):
+        """実行中・待機中の保存の数。"""
+        with self._lock:
+            return self._pending
+
+    def submit(self, job):
+        with self._lock:
+            self._pending += 1
+        future = self._executor.submit(job.run)
+        future.add_done_callback(self._finished)
+        return future
+
+    def _finished(self, future):
+        with self._lock:
+            self._pending -= 1
+        if self.on_done:
+            self.on_done(future)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+def encode_clipboard_data(image, with_png=True, with_bitmap=True, compress_level=CLIPBOARD_PNG_COMPRESS_LEVEL):
+    """
+    クリップボードに渡すデータを作る。UIスレッド以外から呼んでよい。
+    imageにはImageSnapshotも渡せ、その場合は画像を作るところから呼び出したスレッドで行う。
+    png: 低圧縮のPNGのバイト列、bitmap: 無圧縮ビットマップ用の(mode, size, バイト列)。不要なものはNone。
+    """
+    image = materialize(image)
+    png_bytes = None
+    bitmap = None
+    if with_png:
+        buffer = io.BytesIO()
+        prepare_for_format(image, "PNG").save(buffer, format="PNG", compress_level=compress_level)
+        png_bytes = buffer.getvalue()
+    if with_bitmap:
+        converted = to_display_base(image)
+        bitmap = (converted.mode, converted.size, converted.tobytes())
+    return {"png": png_bytes, "bitmap": bitmap}
+
+
+def rotation_transform(size, angle):
+    """
+    Image.rotate(angle, expand=True)と同じ出力サイズと、出力座標→入力座標のアフィン行列を返す。
+    PILが転置で処理する0・90・180・270度では行列の代わりにNoneを返す。
+    """
+    w, h = size
+    angle = angle % 360.0
+    if angle in (0, 180):
+        return (w, h), None
+    if angle in (90, 270):
+        return (h, w), None
+    # PILのImage.rotateと同じ計算をする(丸め方も合わせないと出力サイズが1画素ずれる)
+    rad = -math.radians(angle)
+    matrix = [
+        round(math.cos(rad), 15), round(math.sin(rad), 15), 0.0,
+        round(-math.sin(rad), 15), round(math.cos(rad), 15), 0.0,
+    ]
+
+    def transform(x, y):
+        a, b, c, d, e, f = matrix
+        return a * x + b * y + c, d * x + e * y + f
+
+    cx, cy = w / 2, h / 2
+    matrix[2], matrix[5] = transform(-cx, -cy)
+    matrix[2] += cx
+    matrix[5] += cy
+    xx = []
+    yy = []
+    for x, y in ((0, 0), (w, 0), (w, h), (0, h)):
+        tx, ty = transform(x, y)
+        xx.append(tx)
+        yy.append(ty)
+    nw = math.ceil(max(xx)) - math.floor(min(xx))
+    nh = math.ceil(max(yy)) - math.floor(min(yy))
+    matrix[2], matrix[5] = transform(-(nw - w) / 2.0, -(nh - h) / 2.0)
+    return (nw, nh), matrix
+
+
+def rotated_crop_source_box(size, angle, box, margin=3):
+    """
+    回転後の座標のboxを作るのに必要な、回転前の画像の範囲(left, top, right, bottom)を返す。
+    marginはバイキュービック補間が参照する周囲の画素の分。
+    """
+    _, matrix = rotation_transform(size, angle)
+    if matrix is None:
+        return (0, 0) + tuple(size)
+    a, b, c, d, e, f = matrix
+    left, top, right, bottom = box
+    xs = []
+    ys = []
+    for x, y in ((left, top), (right, top), (right, bottom), (left, bottom)):
+        xs.append(a * x + b * y + c)
+        ys.append(d * x + e * y + f)
+    w, h = size
+    src_left = min(w, max(0, math.floor(min(xs)) - margin))
+    src_top = min(h, max(0, math.floor(min(ys)) - margin))
+    return (src_left, src_top,
+            max(src_left, min(w, math.ceil(max(xs)) + margin)), max(src_top, min(h, math.ceil(max(ys)) + margin)))
+
+
+def rotate_crop(image, angle, box, source_size=None, source_offset=(0, 0)):
+    """
+    image.rotate(angle, expand=True, resample=BICUBIC).crop(box)と同じ結果を、
+    回転後の全体を作らずにboxの範囲の画素だけを1回のアフィン変換で作る。
+    imageが元画像の一部(source_offsetの位置から切り出したもの)の場合はsource_sizeに元画像のサイズを渡す。
+    """
+    if source_size is None:
+        source_size = image.size
+    _, matrix = rotation_transform(source_size, angle)
+    if matrix is None:
+        # 90度単位は転置なので回してから切り出しても安い
+        return image.rotate(angle, expand=True, resample=Image.BICUBIC).crop(box)
+    a, b, c, d, e, f = matrix
+    left, top, right, bottom = box
+    # 出力の原点をboxの左上に移し、入力側は切り出し位置の分だけずらす
+    shifted = (a, b, a * left + b * top + c - source_offset[0],
+               d, e, d * left + e * top + f - source_offset[1])
+    return for_resampling(image).transform((right - left, bottom - top), Image.AFFINE, shifted, resample=Image.BICUBIC)
+
+
+def apply_operation(image, op, params):
+    """
+    履歴の操作を1つ画像に適用した結果を返す。トリミングと90度単位の回転はモードを変えずに行い、
+    補間が必要な操作だけfor_resamplingで補間できるモードにする。
+    """
+    if op == "rotate":
+        if params % 90 == 0:
+            return image.rotate(params, expand=True)
+        return for_resampling(image).rotate(params, expand=True, resample=Image.BICUBIC)
+    if op == "crop":
+        return image.crop(params)
+    if op == "resize":
+        size, _ = params
+        return for_resampling(image).resize(size, Image.LANCZOS)
+    if op == "crop_resize":
+        # 切り出したバッファを作らず、boxの範囲から直接1回で縮小する
+        box, size, _ = params
+        return for_resampling(image).resize(size, Image.LANCZOS, box=box, reducing_gap=RESIZE_REDUCING_GAP)
+    raise ValueError(f"unknown operation: {op}")
+
+
+class HistoryEntry:
+    """
+    もどる用の履歴の1項目。parentの画像にop(params)を適用した状態を表す。
+    imageはチェックポイントとして保持している画像で、Noneならparentから再生して作り直す。
+    parentがNoneの項目は元画像で、imageがNoneなら原寸を未デコードの状態を表す。
+    """
+    __slots__ = ("op", "params", "parent", "image", "serial")
+    _next_serial = 0
+
+    def __init__(self, op, params, parent, image=None):
+        self.op = op
+        self.params = params
+        self.parent = parent
+        self.image = image
+        # チェックポイントを新しい順に残すための通し番号
+        HistoryEntry._next_serial += 1
+        self.serial = HistoryEntry._next_serial
+
+
+def replay_entry(entry, source):
+    """
+    履歴項目の画像を、最も近いチェックポイントから操作を再生して作る。
+    sourceは元画像を読み込むtrim_loader.ImageSource。
+    """
+    if entry.image is not None:
+        return entry.image
+    if entry.parent is None:
+        # 元画像は常に保持する
+        entry.image = source.load()
+        return entry.image
+    parent = entry.parent
+    if entry.op == "crop" and parent.image is None:
+        if parent.parent is None and source.can_read_region:
+            # 元画像を未デコードなら範囲にかかる部分だけを読み込む
+            return source.read_region(entry.params)
+        if parent.op == "rotate":
+            # 回転後の全体を作らず、トリミング範囲だけを回転前の画像から直接作る
+            return _replay_rotate_crop(parent.parent, parent.params, entry.params, source)
+    if entry.op == "crop_resize" and parent.image is None and (parent.parent is None or parent.op == "rotate"):
+        # 範囲読み込みや回転との合成が使えるよう、トリミング部分だけを先に作ってから縮小する
+        box, size, _ = entry.params
+        cropped = replay_entry(HistoryEntry("crop", box, parent), source)
+        return for_resampling(cropped).resize(size, Image.LANCZOS, reducing_gap=RESIZE_REDUCING_GAP)
+    return apply_operation(replay_entry(parent, source), entry.op, entry.params)
+
+
+def _replay_rotate_crop(base, angle, box, source):
+    if base.image is None and base.parent is None and source.can_read_region:
+        # 未デコードの巨大な元画像からは、回転後の範囲にかかる部分だけを読み込む
+        source_box = rotated_crop_source_box(source.size, angle, box)
+        if source_box[2] <= source_box[0] or source_box[3] <= source_box[1]:
+            # 回転後の画像の余白だけを切り出す場合
+            return Image.new(source.region_reader.mode, (box[2] - box[0], box[3] - box[1]))
+        region = source.read_region(source_box)
+        return rotate_crop(region, angle, box, source_size=source.size, source_offset=source_box[:2])
+    return rotate_crop(replay_entry(base, source), angle, box)
+
+
+def _detach(entry):
+    """entryから最も近いチェックポイント(または元画像)までの履歴項目を複製する。"""
+    # UIスレッドがチェックポイントを捨てても影響しないよう、画像は1回だけ読んで複製に持たせる
+    image = entry.image
+    if image is not None:
+        return HistoryEntry(entry.op, entry.params, None, image)
+    parent = _detach(entry.parent) if entry.parent is not None else None
+    return HistoryEntry(entry.op, entry.params, parent)
+
+
+class ImageSnapshot:
+    """
+    履歴項目の画像を後から作るための、履歴と元画像の複製。UIスレッドで作り、render()はワーカースレッドで呼ぶ。
+    作った後にセッションで編集を続けたり別の画像を開いたりしても、作った時点の画像が得られる。
+    """
+
+    def __init__(self, entry, source):
+        self.entry = _detach(entry)
+        self.source = source
+
+    def render(self):
+        return replay_entry(self.entry, self.source)
+
+
+def materialize(image):
+    """ImageSnapshotなら画像を作って返し、PILの画像ならそのまま返す。"""
+    if isinstance(image, ImageSnapshot):
+        return image.render()
+    return image
+
+
+class TrimSession:
+    """
+    1枚の画像に対する回転・トリミング・リサイズ・保存と、もどる用の履歴を管理する。
+    座標はすべて画像座標で扱い、表示座標との変換は呼び出し側で行う。
+    履歴は画像のコピーではなく操作の記録として持ち、memory_budgetの範囲でだけチェックポイント画像を残す。
+    PILの画像はその場で書き換えず常に新しい画像を作るので、同じ画像を現在の画像・履歴・回転の基準で共有する。
+    """
+
+    def __init__(self, max_history=MAX_HISTORY, memory_budget=HISTORY_MEMORY_BUDGET):
+        # 原寸のデコードを遅らせているファイル(trim_loader.ImageSource)
+        self.source = None
+        self.history = []
+        self.max_history = max_history
+        self.memory_budget = memory_budget
+        # 回転は基準となる履歴項目からの累積角度で行う
+        self._rotation_base = None
+        self.rotation_angle_total = 0.0
+        # 回転中の表示用縮小画像 {履歴項目の通し番号: 画像}
+        self._proxy_cache = {}
+        self.file_name = ""
+        self.file_dir = ""
+        # 現在の画像がクリップボードから取得された場合はTrue
+        self.from_clipboard = False
+
+    @classmethod
+    def open(cls, path, preview_size=None, **kwargs):
+        session = cls(**kwargs)
+        session.set_source(open_source(path, preview_size=preview_size))
+        return session
+
+    @property
+    def has_image(self):
+        return bool(self.history)
+
+    @property
+    def original_image(self):
+        if not self.history:
+            return None
+        root = self.history[0]
+        while root.parent is not None:
+            root = root.parent
+        return self._replay(root)
+
+    @property
+    def current_image(self):
+        """
+        現在の原寸画像。プレビューしか読み込んでいなければここで原寸をデコードし、
+        調整中の回転があればここで初めて原寸に適用する。
+        """
+        if not self.history:
+            return None
+        entry = self.history[-1]
+        if entry.image is None:
+            entry.image = self._replay(entry)
+        return entry.image
+
+    @property
+    def rotation_base_image(self):
+        if self._rotation_base is None:
+            return None
+        return self._replay(self._rotation_base)
+
+    @property
+    def is_materialized(self):
+        """現在の状態の原寸画像がメモリ上にあればTrue。"""
+        return bool(self.history) and self.history[-1].image is not None
+
+    @property
+    def display_image(self):
+        """
+        表示に使う画像。原寸をまだデコードしていなければ縮小プレビューを、
+        回転を原寸に適用していなければ縮小画像を回転したものを返す。
+        """
+        if not self.history:
+            return None
+        return self._display_for(self.history[-1], top=True)
+
+    @property
+    def size(self):
+        """現在の画像の原寸サイズ。原寸をデコード・回転せずに取得できる。"""
+        if not self.history:
+            return (0, 0)
+        return self._entry_size(self.history[-1])
+
+    def set_image(self, pil_image, file_name="", from_clipboard=False):
+        self.source = None
+        # コピーせずに共有する。遅延読み込みの画像はここでデコードしてファイルから切り離す
+        pil_image.load()
+        self._init_history(pil_image)
+        self.from_clipboard = from_clipboard
+        self.file_name = os.path.basename(file_name)
+        self.file_dir = os.path.dirname(file_name)
+
+    def set_source(self, source):
+        """trim_loader.ImageSourceを読み込む。原寸のデコードは必要になるまで行わない。"""
+        self.source = source
+        self._init_history(source.load() if source.is_loaded else None)
+        self.from_clipboard = False
+        self.file_name = os.path.basename(source.path)
+        self.file_dir = os.path.dirname(source.path)
+
+    def _init_history(self, image):
+        root = HistoryEntry("source", None, None, image)
+        self.history = [root]
+        self._proxy_cache = {}
+        # 新しい画像を読み込んだあとに回転の基準をリセット
+        self._rotation_base = root
+        self.rotation_angle_total = 0.0
+
+    def _entry_size(self, entry):
+        if entry.image is not None:
+            return entry.image.size
+        if entry.parent is None:
+            return self.source.size
+        if entry.op == "rotate":
+            return rotation_transform(self._entry_size(entry.parent), entry.params)[0]
+        if entry.op == "crop":
+            left, top, right, bottom = entry.params
+            return (right - left, bottom - top)
+        if entry.op in ("resize", "crop_resize"):
+            return tuple(entry.params[-2])
+        return tuple(entry.params)
+
+    def operations(self):
+        """元画像から現在の画像までに適用した操作を、(操作, パラメータ, 適用前のサイズ)のリストで返す。"""
+        chain = []
+        entry = self.history[-1] if self.history else None
+        while entry is not None and entry.parent is not None:
+            chain.append((entry.op, entry.params, self._entry_size(entry.parent)))
+            entry = entry.parent
+        chain.reverse()
+        return chain
+
+    def _display_for(self, entry, top=False):
+        """履歴項目の表示用画像。topは現在の状態(縮小せずに原寸を返してよい)かどうか。"""
+        if entry.image is not None:
+            if top:
+                return entry.image
+            cached = self._proxy_cache.get(entry.serial)
+            if cached is None:
+                # 回転の基準はROTATION_PROXY_SIZEまで縮小してから回す
+                proxy_size = fit_long_side(entry.image.size, ROTATION_PROXY_SIZE)
+                if proxy_size is None:
+                    cached = to_display_base(entry.image)
+                else:
+                    cached = DisplayPyramid(entry.image).get(proxy_size)
+                self._proxy_cache[entry.serial] = cached
+            return cached
+        if entry.parent is None:
+            return self.source.preview
+        if entry.op != "rotate":
+            return self.current_image if top else self._replay(entry)
+        cached = self._proxy_cache.get(entry.serial)
+        if cached is None:
+            base = self._display_for(entry.parent)
+            # 表示用なので速いバイリニア補間で回す
+            cached = base.rotate(entry.params, expand=True, resample=Image.BILINEAR)
+            # 回転ボタンを押すたびに増えないよう、表示中の回転と基準の縮小画像だけを残す
+            keep = {entry.parent.serial}
+            self._proxy_cache = {k: v for k, v in self._proxy_cache.items() if k in keep}
+            self._proxy_cache[entry.serial] = cached
+        return cached
+
+    def _replay(self, entry):
+        """履歴項目の画像を、最も近いチェックポイントから操作を再生して作る。"""
+        return replay_entry(entry, self.source)
+
+    def snapshot(self):
+        """
+        現在の画像のImageSnapshot。原寸のデコードや回転をせずに作れるので、
+        保存などで原寸が必要な処理をワーカースレッドに渡すときに使う。
+        """
+        if not self.history:
+            return None
+        return ImageSnapshot(self.history[-1], self.source)
+
+    def _push_history(self, op, params, parent, image):
+        if len(self.history) >= self.max_history:
+            # 押し出された項目も、残っている項目の再生元としてparent経由で参照され続ける
+            self.history.pop(0)
+        entry = HistoryEntry(op, params, parent, image)
+        self.history.append(entry)
+        self._trim_checkpoints()
+        return entry
+
+    def _trim_checkpoints(self):
+        """memory_budgetに収まるよう、新しい履歴項目から順にチェックポイントを残す。"""
+        live = {}
+        for entry in self.history:
+            while entry is not None and id(entry) not in live:
+                live[id(entry)] = entry
+                entry = entry.parent
+        # 元画像・現在の画像・回転の基準は常に保持する
+        pinned = [self.history[-1], self._rotation_base]
+        used = sum(image_nbytes(entry.image) for entry in pinned if entry is not None and entry.image is not None)
+        for entry in sorted(live.values(), key=lambda e: e.serial, reverse=True):
+            if entry.image is None or entry.parent is None or any(entry is p for p in pinned):
+                continue
+            nbytes = image_nbytes(entry.image)
+            if used + nbytes <= self.memory_budget:
+                used += nbytes
+            else:
+                entry.image = None
+
+    def _apply(self, op, params):
+        """現在の画像に操作を適用して履歴に追加し、回転の基準をその結果にする。"""
+        parent = self.history[-1]
+        image = self._replay(HistoryEntry(op, params, parent))
+        self._rotation_base = self._push_history(op, params, parent, image)
+        self.rotation_angle_total = 0.0
+        self._proxy_cache = {}
+
+    def rotate(self, delta):
+        """
+        回転角を調整する。原寸の回転はトリミング・リサイズ・保存などで
+        current_imageが必要になったときに、累積角度で1回だけ行う。
+        """
+        if self._rotation_base is None:
+            return False
+        # 累積回転角を0〜360度の範囲に保つ
+        self.rotation_angle_total = (self.rotation_angle_total + delta) % 360
+        self._push_history("rotate", self.rotation_angle_total, self._rotation_base, None)
+        return True
+
+    def commit_rotation(self):
+        """
+        保留中の回転を確定し、以後の回転は回転後の画像を基準に測る。もどるで回転の項目に戻ったときと同じ状態になる。
+        原寸の回転はここでも行わない。
+        """
+        if not self.history or self.history[-1] is self._rotation_base:
+            return False
+        self._rotation_base = self.history[-1]
+        self.rotation_angle_total = 0.0
+        self._trim_checkpoints()
+        return True
+
+    def straighten(self, **options):
+        """
+        傾きを自動で求めて回転し、回転角(度)を返す。傾きが求められなければNoneを返す。
+        傾きは回転の基準の縮小画像から求め、累積回転角をその角度にするので、原寸の回転は1回で済む。
+        optionsはtrim_auto.estimate_skewに渡す。NumPyがなければtrim_auto.AutoTrimErrorを送出する。
+        """
+        if self._rotation_base is None:
+            return None
+        angle = estimate_skew(self._display_for(self._rotation_base), **options)
+        if angle is None:
+            return None
+        self.rotate(angle - self.rotation_angle_total)
+        return angle
+
+    def crop(self, box):
+        """画像座標のボックス(left, top, right, bottom)でトリミングする。"""
+        if box is None or not self.has_image:
+            return False
+        # 巨大な画像は全体をデコードせず、範囲にかかる部分だけを読み込む(_replay参照)
+        # トリミング後に回転の基準をリセット
+        self._apply("crop", tuple(box))
+        return True
+
+    def crop_resize(self, box, target_size):
+        """
+        boxでトリミングし、長辺がtarget_sizeを超えていれば縮小する。
+        トリミングと縮小を別々に行わず、元の画像から1回のリサンプリングで作り、履歴にも1項目だけ追加する。
+        """
+        if box is None or not self.has_image:
+            return False
+        box = tuple(box)
+        new_size = fit_long_side((box[2] - box[0], box[3] - box[1]), target_size)
+        if new_size is None:
+            return self.crop(box)
+        # 指定された長辺も残し、レシピなどで操作を記録するときに使う
+        self._apply("crop_resize", (box, new_size, target_size))
+        return True
+
+    def content_box(self, **options):
+        """
+        背景色の余白を除いた内容の範囲を画像座標のボックスで返す。内容がなければNone。
+        optionsはtrim_auto.find_content_boxに渡す。NumPyがなければtrim_auto.AutoTrimErrorを送出する。
+        """
+        if not self.has_image:
+            return None
+        entry = self.history[-1]
+        if entry.image is None and entry.parent is None:
+            # 未デコードの元画像はプレビューで大まかに求め、四辺の近くだけを原寸で読み込む
+            return find_content_box(self.source, proxy=self.source.preview, read_region=self.source.read_region,
+                                    **options)
+        return find_content_box(self.current_image, **options)
+
+    def revert(self):
+        if len(self.history) <= 1:
+            return False
+        self.history.pop()
+        entry = self.history[-1]
+        if entry.image is None and entry.parent is not None and entry.op != "rotate":
+            # 戻った先は現在の画像になるのでチェックポイントとして保持する
+            # (未デコードの元画像と、原寸に未適用の回転はそのまま遅延させる)
+            entry.image = self._replay(entry)
+        self._rotation_base = entry
+        self.rotation_angle_total = 0.0
+        self._trim_checkpoints()
+        return True
+
+    def resize(self, target_size):
+        """長辺がtarget_sizeを超える場合だけ縮小する。"""
+        if not self.has_image:
+            return False
+        new_size = fit_long_side(self.size, target_size)
+        if new_size is None:
+            return False
+        # 画像サイズ変更後に回転の基準をリセット
+        self._apply("resize", (new_size, target_size))
+        return True
+
+    def output_base(self, clipboard_dir=None):
+        """保存先のパスから末尾の文字列と拡張子を除いたもの。保存先が決められない場合はNoneを返す。"""
+        if self.from_clipboard:
+            # クリップボードからの画像はタイムスタンプ付きの名前にする
+            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+            return os.path.join(clipboard_dir or os.getcwd(), f"clipboard_{timestamp}")
+        if self.file_name:
+            return os.path.join(self.file_dir, os.path.splitext(self.file_name)[0])
+        return None
+
+    def save_path(self, clipboard_dir=None):
+        """保存先のパスを返す。保存先が決められない場合はNoneを返す。"""
+        base = self.output_base(clipboard_dir)
+        if base is None:
+            return None
+        if self.from_clipboard:
+            # クリップボードからの画像はPNGで保存
+            return base + ".png"
+        return base + "_trm" + os.path.splitext(self.file_name)[1]
+
+    def prepare_save(self, jpeg_quality=DEFAULT_JPEG_QUALITY, clipboard_dir=None, save_path=None, lossless=False,
+                     max_bytes=None):
+        """
+        現在の画像を保存するSaveJobを返す。保存できない場合はNoneを返す。
+        losslessがTrueで、元のJPEGファイルにトリミングと90度単位の回転しかしていなければ、
+        jpegtranで再エンコードせずに保存するジョブを返す(失敗したときは再エンコードする)。
+        max_bytesを指定するとJPEG・WebPはそのバイト数に収まる最も高い品質で保存する。無劣化保存より優先する。
+        """
+        if not self.has_image:
+            return None
+        if save_path is None:
+            save_path = self.save_path(clipboard_dir)
+        if save_path is None:
+            return None
+        params = {}
+        ext = os.path.splitext(save_path)[1].lower()
+        if ext in [".jpg", ".jpeg"]:
+            params["quality"] = jpeg_quality
+        # 原寸のデコードや回転はワーカースレッドで行う
+        job = SaveJob(self.snapshot(), save_path, params=params, max_bytes=max_bytes)
+        if (lossless and not max_bytes and ext in [".jpg", ".jpeg"] and
+                self.source is not None and not self.from_clipboard):
+            # jobは失敗したときの再エンコード用。スナップショットから保存するので、それまで画像は作らない
+            lossless_job = prepare_lossless_job(self.source.path, self.operations(), save_path, job)
+            if lossless_job is not None:
+                return lossless_job
+        return job
+
+    def save(self, jpeg_quality=DEFAULT_JPEG_QUALITY, clipboard_dir=None, save_path=None, lossless=False,
+             max_bytes=None):
+        """現在の画像を保存し、保存先のパスを返す。"""
+        job = self.prepare_save(jpeg_quality, clipboard_dir, save_path, lossless, max_bytes)
+        if job is None:
+            return None
+        return job.run()
@@ -0,0 +1,175 @@
+"""
+表示用の画像処理と描画時間の計測。wxに依存しない部分だけをここに置く。
+"""
+import json
+import math
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import lru_cache
+from PIL import Image
+from trim_modes import has_alpha, to_display_base
+
+PYRAMID_MIN_SIZE = 256  # 長辺がこれより小さい段は作らない
+CHECKER_SIZE = 8    # 透明部分に敷く市松模様の1マスの大きさ(物理ピクセル)
+CHECKER_LEVELS = (204, 255)     # 市松模様の2色の明るさ
+PAINT_STATS_WINDOW = 240    # 描画時間の統計に使う直近のフレーム数
+
+
+class DisplayPyramid:
+    """
+    元画像を1/2ずつ縮小した段を保持し、表示サイズ以上で最も小さい段から縮小して表示用画像を作る。
+    段は必要になったときに1回だけ作るので、表示サイズの変更にかかる時間は画面サイズに比例する。
+    縮小した段は作るときに1回だけ表示用のRGBかRGBAにしておき、再描画のたびには変換しない。
+    画像が編集されたら新しいDisplayPyramidを作り直すこと。
+    """
+
+    def __init__(self, image, min_size=PYRAMID_MIN_SIZE):
+        self.image = image
+        self.min_size = min_size
+        self.levels = [image]
+        self._base = None   # 元画像を表示用のモードにしたもの。元画像の大きさで使うときだけ作る
+
+    def _display_base(self):
+        if self._base is None:
+            self._base = to_display_base(self.image)
+        return self._base
+
+    def _build_next_level(self):
+        last = self.levels[-1]
+        w, h = last.size
+        if max(w, h) // 2 < self.min_size or min(w, h) < 2:
+            return None
+        try:
+            # reduceは2x2の平均なのでresizeより高速。変換は縮小後の1/4の画素数で済ませる
+            level = to_display_base(last.reduce(2))
+        except ValueError:
+            # "1"や"P"、16bitなどreduceが使えないモードは先に表示用のモードにする
+            level = self._display_base().reduce(2)
+        self.levels.append(level)
+        return level
+
+    def level_for(self, size):
+        """幅・高さともにsize以上となる最も小さい段を返す。"""
+        target_w, target_h = size
+        index = 0
+        while True:
+            if index + 1 >= len(self.levels) and self._build_next_level() is None:
+                break
+            next_w, next_h = self.levels[index + 1].size
+            if next_w < target_w or next_h < target_h:
+                break
+            index += 1
+        return self.levels[index]
+
+    def get(self, size, resample=Image.BILINEAR):
+        """sizeに縮小した表示用のRGBかRGBAの画像を返す。"""
+        level = self.level_for(size)
+        if level is self.image:
+            level = self._display_base()
+        if level.size == tuple(size):
+            return level
+        return level.resize(size, resample)
+
+    def get_display(self, size, resample=Image.BILINEAR):
+        """sizeに縮小し、to_displayで表示用のRGBかRGBAにした画像を返す。"""
+        return to_display(self.get(size, resample))
+
+
+@lru_cache(maxsize=4)
+def checkerboard(size, cell=CHECKER_SIZE, levels=CHECKER_LEVELS):
+    """透明部分の下に敷く市松模様のRGBA画像。同じ大きさなら作り直さずに使い回す。"""
+    w, h = size
+    cols = -(-w // cell)
+    rows = -(-h // cell)
+    cells = bytes(levels[(x + y) % 2] for y in range(rows) for x in range(cols))
+    pattern = Image.frombytes("L", (cols, rows), cells).resize((cols * cell, rows * cell), Image.NEAREST)
+    return pattern.crop((0, 0, w, h)).convert("RGBA")
+
+
+def to_display(image):
+    """
+    表示用のRGBかRGBAの画像にする。透明度のある画像は市松模様に重ね、不透明なRGBAとして返す。
+    RGBの画像はそのまま返すので、変換のコピーは作らない。
+    """
+    if image.mode == "RGB":
+        return image
+    if has_alpha(image):
+        rgba = image if image.mode == "RGBA" else to_display_base(image)
+        return Image.alpha_composite(checkerboard(rgba.size), rgba)
+    return to_display_base(image)
+
+
+class FrameStats:
+    """
+    描画1回ごとの段階別の所要時間(ミリ秒)を直近window回分保持し、p50・p95・maxを求める。
+    begin_frame()からend_frame()までの間にstage()で囲んだ処理を段階として記録する。
+    """
+
+    def __init__(self, window=PAINT_STATS_WINDOW):
+        self.window = window
+        self.samples = {}
+        self._frame = None
+        self._frame_start = 0.0
+
+    def begin_frame(self):
+        self._frame = {}
+        self._frame_start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self._frame is not None:
+                self._frame[name] = self._frame.get(name, 0.0) + time.perf_counter() - start
+
+    def end_frame(self):
+        if self._frame is None:
+            return
+        self._frame["total"] = time.perf_counter() - self._frame_start
+        for name, seconds in self._frame.items():
+            if name not in self.samples:
+                self.samples[name] = deque(maxlen=self.window)
+            self.samples[name].append(seconds * 1000.0)
+        self._frame = None
+
+    def summary(self):
+        """{段階名: {"count", "p50", "p95", "max"}}を返す。時間はミリ秒。"""
+        result = {}
+        for name, values in self.samples.items():
+            ordered = sorted(values)
+            result[name] = {
+                "count": len(ordered),
+                "p50": _percentile(ordered, 50),
+                "p95": _percentile(ordered, 95),
+                "max": ordered[-1],
+            }
+        return result
+
+    def format_lines(self):
+        """HUDに表示する1段階1行の文字列のリスト。合計を先頭にする。"""
+        summary = self.summary()
+        names = sorted(summary, key=lambda name: (name != "total", name))
+        return ["%-12s p50 %6.2f  p95 %6.2f  max %6.2f ms" % (
+            name, summary[name]["p50"], summary[name]["p95"], summary[name]["max"]) for name in names]
+
+    def dump(self, path):
+        """集計と直近の生データをJSONで書き出す。"""
+        data = {
+            "window": self.window,
+            "summary": self.summary(),
+            "samples": {name: list(values) for name, values in self.samples.items()},
+        }
+        with open(path, "w", encoding="utf-8") as fp:
+            json.dump(data, fp, indent=2)
+        return path
+
+
+def _percentile(ordered, percent):
+    """ソート済みの値から最近傍順位法でパーセンタイルを求める。"""
+    if not ordered:
+        return 0.0
+    rank = max(1, math.ceil(len(ordered) * percent / 100))
+    return ordered[rank - 1]
@@ -0,0 +1,119 @@
+"""
+保存時のエンコード。wxに依存しない。
+ファイルサイズの上限を指定したJPEG・WebPの保存では、メモリ上での試し書きで品質を探し、上限に収まる最も高い品質で書き出す。
+品質の探索は1回にTARGET_SEARCH_WAYS個の品質を別スレッドで同時に試すk分探索で、
+PillowのエンコーダーはGILを解放するので、試し書きは複数のCPUコアで並列に進む。
+"""
+import io
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+TARGET_SIZE_FORMATS = ("JPEG", "WEBP")
+TARGET_QUALITY_RANGE = (5, 95)  # 探索する品質の範囲
+TARGET_SEARCH_WAYS = 4  # 1回に並列で試す品質の数
+TARGET_PROXY_PIXELS = 1000000   # 最初の見積もりに使う縮小画像の画素数(0で見積もらない)
+# 見積もりを行う最小の画素数。これより小さい画像は縮小しても試し書きの時間がほとんど変わらない
+TARGET_PROXY_MIN_PIXELS = 4000000
+TARGET_PROXY_MARGIN = 8     # 見積もった品質の前後この幅を原寸で最初に試す
+
+
+class TargetSizeError(ValueError):
+    """最も低い品質でもファイルサイズの上限に収まらない場合の例外。"""
+
+
+def encoder_view(image):
+    """
+    imageと画素を共有する別の画像オブジェクト。Image.saveは保存時の引数をself.encoderinfoに書き込んでから
+    エンコードするので、同じ画像オブジェクトを複数のスレッドで同時に保存すると引数が混ざる。
+    保存ごとにこれを使えば、画素はコピーせずに保存時の引数だけを別々に持てる。
+    """
+    image.load()
+    # Pillowには画素を共有する画像を作る公開APIがなく、copy()では試し書きのたびに原寸をコピーしてしまう。
+    # _newはcopy()やcrop()の内部で使われている、画素の入れ物(im)から画像オブジェクトを作るメソッド
+    # (エンコード結果が同じことはtests/test_encode.pyで確かめている)
+    return image._new(image.im)
+
+
+def encode_to_bytes(image, format, quality, **params):
+    """メモリ上でエンコードしたバイト列を返す。同じimageを複数のスレッドから同時に渡してよい。"""
+    buffer = io.BytesIO()
+    encoder_view(image).save(buffer, format=format, quality=quality, **params)
+    return buffer.getvalue()
+
+
+def _spread(low, high, ways):
+    """low〜highの範囲を(ways+1)等分する品質を返す。範囲が狭ければすべての品質を返す。"""
+    if high - low + 1 <= ways:
+        return list(range(low, high + 1))
+    return sorted({low + (high - low) * (i + 1) // (ways + 1) for i in range(ways)})
+
+
+def search_quality(encode, max_bytes, low, high, ways, executor, first=None):
+    """
+    encode(品質)のバイト数がmax_bytes以下となる最も高い品質を探し、(品質, エンコード結果)を返す。
+    収まる品質がなければ(None, 最も小さかったエンコード結果)を返す。firstを渡すと最初の回はその品質を試す。
+    """
+    best = None
+    smallest = None
+    candidates = first
+    while low <= high:
+        candidates = [q for q in (candidates or _spread(low, high, ways)) if low <= q <= high]
+        if not candidates:
+            candidates = _spread(low, high, ways)
+        results = sorted(zip(candidates, executor.map(encode, candidates)))
+        candidates = None
+        for quality, data in results:
+            if smallest is None or len(data) < len(smallest):
+                smallest = data
+            if len(data) <= max_bytes:
+                if best is None or quality > best[0]:
+                    best = (quality, data)
+                low = max(low, quality + 1)
+            else:
+                high = min(high, quality - 1)
+    if best is None:
+        return None, smallest
+    return best
+
+
+def _proxy_estimate(image, format, max_bytes, low, high, ways, executor, params):
+    """画素数を減らした縮小画像で、画素あたりのバイト数が同じとみなして品質を見積もる。"""
+    pixels = image.size[0] * image.size[1]
+    if pixels < max(TARGET_PROXY_MIN_PIXELS, TARGET_PROXY_PIXELS):
+        return None
+    ratio = (TARGET_PROXY_PIXELS / pixels) ** 0.5
+    proxy = image.resize((max(1, int(image.size[0] * ratio)), max(1, int(image.size[1] * ratio))), Image.BILINEAR)
+    scale = proxy.size[0] * proxy.size[1] / (image.size[0] * image.size[1])
+    quality, _ = search_quality(lambda q: encode_to_bytes(proxy, format, q, **params),
+                                max_bytes * scale, low, high, ways, executor)
+    return quality
+
+
+def encode_to_size(image, format, max_bytes, quality_range=TARGET_QUALITY_RANGE, ways=TARGET_SEARCH_WAYS,
+                   proxy=True, executor=None, **params):
+    """
+    imageをformat(JPEGかWebP)でmax_bytes以下に収まる最も高い品質でエンコードし、(品質, バイト列)を返す。
+    proxyがTrueで画像がTARGET_PROXY_MIN_PIXELS以上あれば、縮小画像で品質を見積もり、その前後から原寸での探索を始める。
+    収まらなければTargetSizeErrorを送出する。imageは保存形式で書けるモードにしておくこと。
+    """
+    if format not in TARGET_SIZE_FORMATS:
+        raise ValueError(f"target size is not supported for {format}")
+    low, high = quality_range
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=ways, thread_name_prefix="encode")
+    try:
+        first = None
+        if proxy and TARGET_PROXY_PIXELS:
+            estimate = _proxy_estimate(image, format, max_bytes, low, high, ways, executor, params)
+            if estimate is not None:
+                first = sorted({min(high, max(low, estimate + offset))
+                                for offset in (-TARGET_PROXY_MARGIN, 0, TARGET_PROXY_MARGIN)})
+        quality, data = search_quality(lambda q: encode_to_bytes(image, format, q, **params),
+                                       max_bytes, low, high, ways, executor, first)
+    finally:
+        if own_executor:
+            executor.shutdown()
+    if quality is None:
+        raise TargetSizeError("%d bytes at quality %d exceeds the limit of %d bytes" % (len(data), low, max_bytes))
+    return quality, data
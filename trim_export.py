@@ -0,0 +1,142 @@
+"""
+書き出しプロファイル。wxに依存しない。
+1枚の画像から、形式・長辺・品質・ファイル名の末尾を指定した複数のファイルを一度に書き出す。
+縮小は長辺の大きい順に行い、小さい出力は大きい出力用に縮小した画像からさらに縮小する。
+縮小が済んだ出力から順にスレッドプールでエンコードするので、エンコードと次の縮小も並行して進む。
+"""
+import json
+import math
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from trim_core import SaveJob, fit_long_side, materialize, RESIZE_REDUCING_GAP
+from trim_modes import for_resampling
+
+EXPORT_EXTENSIONS = {"JPEG": ".jpg", "WEBP": ".webp", "PNG": ".png", "TIFF": ".tif"}
+QUALITY_FORMATS = ("JPEG", "WEBP")  # qualityを指定できる形式
+# 中間の縮小画像から縮小するのは、それが目標の長辺のこの倍以上ある場合だけ(足りなければ元画像から縮小する)
+EXPORT_CASCADE_RATIO = 2.0
+DEFAULT_EXPORT_PROFILES = [
+    {"suffix": "_full", "format": "JPEG", "long_side": None, "quality": 90},
+    {"suffix": "_web", "format": "WEBP", "long_side": 2048, "quality": 80},
+    {"suffix": "_thumb", "format": "JPEG", "long_side": 640, "quality": 80},
+    {"suffix": "_small", "format": "JPEG", "long_side": 320, "quality": 75},
+]
+
+
+class ProfileError(ValueError):
+    """書き出しプロファイルの内容が不正な場合の例外。"""
+
+
+def _is_int(value):
+    # boolはintのサブクラスなので除く
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def validate_profiles(profiles):
+    """
+    プロファイルのリストを確かめ、形式名を大文字にしたコピーを返す。
+    各プロファイルはformat・suffixが必須で、long_side(Noneなら縮小しない)・quality・max_bytesは省略できる。
+    """
+    if not isinstance(profiles, list) or not profiles:
+        raise ProfileError("profiles must be a non-empty list")
+    result = []
+    suffixes = set()
+    for profile in profiles:
+        profile = dict(profile)
+        profile["format"] = str(profile.get("format", "")).upper()
+        if profile["format"] not in EXPORT_EXTENSIONS:
+            raise ProfileError(f"unsupported format: {profile['format']}")
+        suffix = profile.get("suffix")
+        if not suffix or not isinstance(suffix, str):
+            raise ProfileError("suffix is required")
+        key = (suffix, profile["format"])
+        if key in suffixes:
+            # 同じファイル名に上書きしてしまう
+            raise ProfileError(f"duplicate suffix: {suffix}")
+        suffixes.add(key)
+        long_side = profile.get("long_side")
+        if long_side is not None and (not _is_int(long_side) or long_side <= 0):
+            raise ProfileError(f"invalid long_side: {long_side}")
+        quality = profile.get("quality")
+        if quality is not None and (not _is_int(quality) or not 1 <= quality <= 100):
+            raise ProfileError(f"invalid quality: {quality}")
+        max_bytes = profile.get("max_bytes")
+        if max_bytes is not None and (not _is_int(max_bytes) or max_bytes <= 0):
+            raise ProfileError(f"invalid max_bytes: {max_bytes}")
+        result.append(profile)
+    return result
+
+
+def load_profiles(path):
+    with open(path, encoding="utf-8") as fp:
+        return validate_profiles(json.load(fp))
+
+
+def sized_images(image, long_sides):
+    """
+    long_sidesの各長辺に縮小した画像を、長辺の大きい順に(長辺, 画像)で返す。
+    Noneや画像より大きい長辺には元画像を返し、同じ長辺は1回だけ縮小する。
+    """
+    produced = [image]  # 作った画像。大きい順
+    for long_side in sorted(set(long_sides), key=lambda side: -(side or math.inf)):
+        new_size = fit_long_side(image.size, long_side) if long_side is not None else None
+        if new_size is None:
+            yield long_side, image
+            continue
+        # 十分な大きさがある中で最も小さい画像から縮小する
+        base = image
+        for candidate in produced:
+            if max(candidate.size) >= long_side * EXPORT_CASCADE_RATIO:
+                base = candidate
+        resized = for_resampling(base).resize(new_size, Image.LANCZOS, reducing_gap=RESIZE_REDUCING_GAP)
+        produced.append(resized)
+        yield long_side, resized
+
+
+def profile_job(image, base_path, profile):
+    """プロファイル1つ分のSaveJob。保存先はbase_pathにsuffixと形式の拡張子を付けたパス。"""
+    format = profile["format"]
+    params = {}
+    if profile.get("quality") is not None and format in QUALITY_FORMATS:
+        params["quality"] = profile["quality"]
+    path = base_path + profile["suffix"] + EXPORT_EXTENSIONS[format]
+    return SaveJob(image, path, format=format, params=params, max_bytes=profile.get("max_bytes"))
+
+
+class ExportJob:
+    """
+    1枚の画像をプロファイルごとに書き出すジョブ。SaveJobと同じくrun()で実行し、保存先のパスのリストを返す。
+    画像は変更されないのでワーカースレッドに渡せる。imageにはImageSnapshotも渡せ、その場合は画像もrun()の中で作る。
+    """
+
+    def __init__(self, image, base_path, profiles, workers=None):
+        self.image = image
+        self.base_path = base_path
+        self.profiles = profiles
+        self.workers = workers
+
+    def run(self):
+        groups = {}
+        for profile in self.profiles:
+            groups.setdefault(profile.get("long_side"), []).append(profile)
+        executor = ThreadPoolExecutor(max_workers=self.workers or len(self.profiles), thread_name_prefix="export")
+        futures = []
+        try:
+            for long_side, sized in sized_images(materialize(self.image), groups):
+                for profile in groups[long_side]:
+                    futures.append(executor.submit(profile_job(sized, self.base_path, profile).run))
+            # 失敗した出力があっても、ほかの出力は書き終えてから例外を送出する
+            return [future.result() for future in futures]
+        finally:
+            executor.shutdown()
+
+
+def prepare_export(session, profiles, clipboard_dir=None):
+    """TrimSessionの現在の画像を書き出すExportJobを返す。保存先が決められない場合はNoneを返す。"""
+    if not session.has_image:
+        return None
+    base_path = session.output_base(clipboard_dir)
+    if base_path is None:
+        return None
+    # 原寸のデコードや回転はワーカースレッドで行う
+    return ExportJob(session.snapshot(), base_path, validate_profiles(profiles))
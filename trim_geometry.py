@@ -0,0 +1,369 @@
+"""
+トリミング範囲(選択矩形)の計算。wxに依存しない。
+座標は画像の表示領域の左上を原点とする表示座標で、点は(x, y)のタプルで受け取る。
+Rectのrightとbottomはwx.Rectと同じく右端・下端の画素の座標(x + width - 1)。
+wx.Rectへの変換は描画するときだけ行う。
+"""
+
+MIN_CROP_SIZE = 4   # トリミング範囲の最小の幅・高さ
+HANDLE_SIZE = 10    # ハンドルの一辺の大きさ
+# ハンドルの名前。当たり判定はこの順に行う
+HANDLE_NAMES = ("top_left", "top", "top_right", "right", "bottom_right", "bottom", "bottom_left", "left")
+
+
+class Rect:
+    """整数の矩形。wx.Rectと同じ意味で使える最小限の機能だけを持つ。"""
+
+    __slots__ = ("x", "y", "width", "height")
+
+    def __init__(self, x=0, y=0, width=0, height=0):
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+
+    @classmethod
+    def from_tuple(cls, rect_tuple):
+        """(x, y, w, h)のタプルから、各値を四捨五入した矩形を作る。"""
+        x, y, w, h = rect_tuple
+        return cls(int(round(x)), int(round(y)), int(round(w)), int(round(h)))
+
+    @property
+    def right(self):
+        return self.x + self.width - 1
+
+    @property
+    def bottom(self):
+        return self.y + self.height - 1
+
+    def as_tuple(self):
+        return (self.x, self.y, self.width, self.height)
+
+    def __eq__(self, other):
+        return isinstance(other, Rect) and self.as_tuple() == other.as_tuple()
+
+    def __repr__(self):
+        return "Rect(%d, %d, %d, %d)" % self.as_tuple()
+
+
+class SelectionGeometry:
+    """
+    表示領域の大きさを持ち、トリミング範囲の作成・移動・リサイズ・はみ出しの補正を行う。
+    ハンドルの当たり判定用の範囲は、トリミング範囲が変わったときだけ計算し直す。
+    """
+
+    def __init__(self, display_width=0, display_height=0, min_size=MIN_CROP_SIZE, handle_size=HANDLE_SIZE):
+        self.display_width = display_width
+        self.display_height = display_height
+        self.min_size = min_size
+        self.handle_size = handle_size
+        # ハンドルの範囲を計算したときのトリミング範囲と、(名前, left, top, right, bottom)のタプル
+        self._handle_key = None
+        self._handle_boxes = ()
+
+    def set_display_size(self, display_width, display_height):
+        self.display_width = display_width
+        self.display_height = display_height
+
+    def clamp_point(self, point):
+        px, py = point
+        return (max(0, min(px, self.display_width)), max(0, min(py, self.display_height)))
+
+    def point_in_display(self, point):
+        px, py = point
+        return 0 <= px <= self.display_width and 0 <= py <= self.display_height
+
+    @staticmethod
+    def crop_contains(rect_tuple, point):
+        """トリミング範囲(x, y, w, h)が点を含むか。こちらは右端・下端の外側の線(x + w)も含む。"""
+        x, y, w, h = rect_tuple
+        px, py = point
+        return x <= px <= x + w and y <= py <= y + h
+
+    def clip(self, x, y, w, h):
+        """実数の矩形を表示エリア内に収める。"""
+        if w < 0:
+            w = 0
+        if h < 0:
+            h = 0
+        if x < 0:
+            x = 0
+        if x + w > self.display_width:
+            x = self.display_width - w
+        if y < 0:
+            y = 0
+        if y + h > self.display_height:
+            y = self.display_height - h
+        return (x, y, w, h)
+
+    def ensure_within(self, rect):
+        """矩形を表示エリア内に収め、最小サイズ以上にした新しいRectを返す。"""
+        if rect is None or self.display_width <= 0 or self.display_height <= 0:
+            return Rect()
+        display_w = self.display_width
+        display_h = self.display_height
+        x, y, width, height = rect.x, rect.y, rect.width, rect.height
+        if width > display_w:
+            width = display_w
+        if height > display_h:
+            height = display_h
+        if x < 0:
+            x = 0
+        if y < 0:
+            y = 0
+        if x + width - 1 > display_w:
+            x = display_w - width
+        if y + height - 1 > display_h:
+            y = display_h - height
+        width = max(self.min_size, width)
+        height = max(self.min_size, height)
+        x = max(0, min(x, display_w - width))
+        y = max(0, min(y, display_h - height))
+        return Rect(x, y, width, height)
+
+    # ensure_withinの結果はもう一度通しても変わらず、幅・高さは常に最小サイズ以上になるので、そのまま使える
+    ensure_min_size = ensure_within
+
+    def rescale(self, rect_tuple, old_width, old_height):
+        """表示サイズがold_width x old_heightから変わったとき、中心を保ってトリミング範囲を拡大縮小する。"""
+        old_x, old_y, old_w, old_h = rect_tuple
+        cx_old = old_x + old_w/2
+        cy_old = old_y + old_h/2
+        scale_x = self.display_width / old_width
+        scale_y = self.display_height / old_height
+        new_w = old_w * scale_x
+        new_h = old_h * scale_y
+        new_x = cx_old * scale_x - new_w/2
+        new_y = cy_old * scale_y - new_h/2
+        new_x, new_y, new_w, new_h = self.clip(new_x, new_y, new_w, new_h)
+        return self.ensure_min_size(Rect(int(round(new_x)), int(round(new_y)), int(round(new_w)), int(round(new_h))))
+
+    def _create_rect_with_ratio(self, anchor, current, ratio):
+        dx = current[0] - anchor[0]
+        dy = current[1] - anchor[1]
+        abs_dx = abs(dx)
+        abs_dy = abs(dy)
+        if abs_dx == 0 and abs_dy == 0:
+            return Rect(anchor[0], anchor[1], 0, 0)
+        if abs_dy == 0:
+            abs_dy = int(round(abs_dx / ratio))
+        if abs_dx == 0:
+            abs_dx = int(round(abs_dy * ratio))
+        current_ratio = abs_dx / abs_dy if abs_dy else ratio
+        if current_ratio > ratio:
+            abs_dx = int(round(abs_dy * ratio))
+        else:
+            abs_dy = int(round(abs_dx / ratio))
+        x2 = anchor[0] + (abs_dx if dx >= 0 else -abs_dx)
+        y2 = anchor[1] + (abs_dy if dy >= 0 else -abs_dy)
+        return Rect(min(anchor[0], x2), min(anchor[1], y2), abs(x2 - anchor[0]), abs(y2 - anchor[1]))
+
+    def create(self, anchor, current, ratio=None):
+        """anchorからcurrentまでドラッグして作るトリミング範囲。ratioが指定されていればその縦横比にする。"""
+        anchor = self.clamp_point(anchor)
+        current = self.clamp_point(current)
+        if ratio:
+            rect = self._create_rect_with_ratio(anchor, current, ratio)
+        else:
+            rect = Rect(min(anchor[0], current[0]), min(anchor[1], current[1]),
+                        abs(current[0] - anchor[0]), abs(current[1] - anchor[1]))
+        return self.ensure_min_size(rect)
+
+    def move(self, origin, dx, dy):
+        """originを(dx, dy)だけ動かし、表示エリア内に収めたRectを返す。"""
+        return self.ensure_min_size(Rect(origin.x + dx, origin.y + dy, origin.width, origin.height))
+
+    def _rect_from_horizontal_anchor(self, anchor_x, width, origin, to_left, ratio):
+        min_size = self.min_size
+        width = max(min_size, min(width, self.display_width))
+        height = max(min_size, int(round(width / ratio)))
+        if height > self.display_height:
+            height = self.display_height
+            width = max(min_size, int(round(height * ratio)))
+        center_y = origin.y + origin.height / 2
+        top = int(round(center_y - height / 2))
+        top = max(0, min(top, self.display_height - height))
+        bottom = top + height
+        if to_left:
+            right = min(anchor_x, self.display_width)
+            left = max(0, right - width)
+        else:
+            left = max(0, anchor_x)
+            right = min(self.display_width, left + width)
+            left = right - width
+        return Rect(int(left), int(top), int(right - left), int(bottom - top))
+
+    def _rect_from_vertical_anchor(self, anchor_y, height, origin, to_top, ratio):
+        min_size = self.min_size
+        height = max(min_size, min(height, self.display_height))
+        width = max(min_size, int(round(height * ratio)))
+        if width > self.display_width:
+            width = self.display_width
+            height = max(min_size, int(round(width / ratio)))
+        center_x = origin.x + origin.width / 2
+        left = int(round(center_x - width / 2))
+        left = max(0, min(left, self.display_width - width))
+        right = left + width
+        if to_top:
+            bottom = min(anchor_y, self.display_height)
+            top = max(0, bottom - height)
+        else:
+            top = max(0, anchor_y)
+            bottom = min(self.display_height, top + height)
+            top = bottom - height
+        return Rect(int(left), int(top), int(right - left), int(bottom - top))
+
+    def _resize_corner_with_ratio(self, point, handle, origin, ratio):
+        if handle == "top_left":
+            anchor_x, anchor_y = origin.right, origin.bottom
+            horizontal = -1
+            vertical = -1
+        elif handle == "top_right":
+            anchor_x, anchor_y = origin.x, origin.bottom
+            horizontal = 1
+            vertical = -1
+        elif handle == "bottom_left":
+            anchor_x, anchor_y = origin.right, origin.y
+            horizontal = -1
+            vertical = 1
+        else:
+            anchor_x, anchor_y = origin.x, origin.y
+            horizontal = 1
+            vertical = 1
+        min_size = self.min_size
+        dx = (point[0] - anchor_x) * horizontal
+        dy = (point[1] - anchor_y) * vertical
+        dx = max(min_size, min(abs(dx), self.display_width))
+        dy = max(min_size, min(abs(dy), self.display_height))
+        if dy == 0:
+            dy = int(round(dx / ratio))
+        if dx == 0:
+            dx = int(round(dy * ratio))
+        width = dx
+        height = int(round(width / ratio))
+        if height > dy:
+            height = dy
+            width = int(round(height * ratio))
+        height = max(min_size, height)
+        width = max(min_size, width)
+        if horizontal < 0:
+            left = anchor_x - width
+            right = anchor_x
+        else:
+            left = anchor_x
+            right = anchor_x + width
+        if vertical < 0:
+            top = anchor_y - height
+            bottom = anchor_y
+        else:
+            top = anchor_y
+            bottom = anchor_y + height
+        return Rect(int(left), int(top), int(right - left), int(bottom - top))
+
+    def _resize_with_ratio(self, origin, point, handle, ratio):
+        min_size = self.min_size
+        if handle == "left":
+            anchor_x = origin.right
+            width = max(min_size, min(anchor_x - point[0], anchor_x))
+            return self._rect_from_horizontal_anchor(anchor_x, width, origin, to_left=True, ratio=ratio)
+        if handle == "right":
+            anchor_x = origin.x
+            width = max(min_size, min(point[0] - anchor_x, self.display_width - anchor_x))
+            return self._rect_from_horizontal_anchor(anchor_x, width, origin, to_left=False, ratio=ratio)
+        if handle == "top":
+            anchor_y = origin.bottom
+            height = max(min_size, min(anchor_y - point[1], anchor_y))
+            return self._rect_from_vertical_anchor(anchor_y, height, origin, to_top=True, ratio=ratio)
+        if handle == "bottom":
+            anchor_y = origin.y
+            height = max(min_size, min(point[1] - anchor_y, self.display_height - anchor_y))
+            return self._rect_from_vertical_anchor(anchor_y, height, origin, to_top=False, ratio=ratio)
+        return self._resize_corner_with_ratio(point, handle, origin, ratio)
+
+    def _resize_free(self, origin, point, handle):
+        min_size = self.min_size
+        left = origin.x
+        top = origin.y
+        right = origin.right
+        bottom = origin.bottom
+        if "left" in handle:
+            left = min(point[0], right - min_size)
+        if "right" in handle:
+            right = max(point[0], left + min_size)
+        if "top" in handle:
+            top = min(point[1], bottom - min_size)
+        if "bottom" in handle:
+            bottom = max(point[1], top + min_size)
+        left = max(0, min(left, self.display_width))
+        right = max(0, min(right, self.display_width))
+        top = max(0, min(top, self.display_height))
+        bottom = max(0, min(bottom, self.display_height))
+        width = max(min_size, right - left)
+        height = max(min_size, bottom - top)
+        return Rect(int(left), int(top), int(width), int(height))
+
+    def resize(self, origin, point, handle, ratio=None):
+        """ハンドルhandleをpointまでドラッグしたときのトリミング範囲。ratioが指定されていればその縦横比を保つ。"""
+        if ratio:
+            rect = self._resize_with_ratio(origin, point, handle, ratio)
+        else:
+            rect = self._resize_free(origin, point, handle)
+        return self.ensure_min_size(rect)
+
+    def apply_aspect(self, rect_tuple, ratio):
+        """トリミング範囲(x, y, w, h)を、中心を保ったまま縦横比ratioに合わせたRectを返す。"""
+        x, y, w, h = rect_tuple
+        center_x = x + w / 2
+        center_y = y + h / 2
+        width = w
+        height = h
+        desired_height = int(round(width / ratio))
+        if desired_height <= self.display_height:
+            height = desired_height
+        if height <= 0:
+            height = self.min_size
+        width = int(round(height * ratio))
+        if width > self.display_width:
+            width = self.display_width
+            height = int(round(width / ratio))
+        if height > self.display_height:
+            height = self.display_height
+            width = int(round(height * ratio))
+        width = max(self.min_size, width)
+        height = max(self.min_size, height)
+        left = int(round(center_x - width / 2))
+        top = int(round(center_y - height / 2))
+        return self.ensure_min_size(Rect(left, top, width, height))
+
+    def handle_boxes(self, rect_tuple):
+        """トリミング範囲(x, y, w, h)の各ハンドルの(名前, left, top, right, bottom)。right・bottomは端を含む。"""
+        if not rect_tuple:
+            return ()
+        if rect_tuple != self._handle_key:
+            half = self.handle_size // 2
+            size = self.handle_size
+            x, y, w, h = rect_tuple
+            right = x + w
+            bottom = y + h
+            center_x = x + w / 2
+            center_y = y + h / 2
+            points = (
+                (x, y), (center_x, y), (right, y), (right, center_y),
+                (right, bottom), (center_x, bottom), (x, bottom), (x, center_y),
+            )
+            boxes = []
+            for name, (px, py) in zip(HANDLE_NAMES, points):
+                left = int(round(px)) - half
+                top = int(round(py)) - half
+                boxes.append((name, left, top, left + size - 1, top + size - 1))
+            self._handle_boxes = tuple(boxes)
+            self._handle_key = tuple(rect_tuple)
+        return self._handle_boxes
+
+    def hit_test_handle(self, rect_tuple, point):
+        """pointにあるハンドルの名前。なければNone。"""
+        px, py = point
+        for name, left, top, right, bottom in self.handle_boxes(rect_tuple):
+            if left <= px <= right and top <= py <= bottom:
+                return name
+        return None
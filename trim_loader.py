@@ -0,0 +1,299 @@
+"""
+画像ファイルの読み込み。wxに依存しない。
+大きなJPEGはDCTスケーリング(Image.draft)で1/2・1/4・1/8に縮小したプレビューだけを先にデコードし、
+原寸のデコードはトリミングや保存で必要になるまで遅らせる。
+非圧縮のTIFF・BMP・PPMなどは、トリミング範囲にかかる行だけをファイルから読み出せる(RegionReader)。
+複数ファイルはImageQueueで順に開き、次のファイルをバックグラウンドで先読みする。
+"""
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+PREVIEW_SIZE = (1920, 1080)    # プレビューとしてデコードする大きさの目安
+REGION_MIN_PIXELS = 50000000   # これ以上の画素数なら範囲読み込みを使い、全体をデコードしない
+REGION_BAND_BYTES = 64 * 1024 * 1024   # プレビュー作成時に一度に読み込む帯の大きさの目安
+PREFETCH_COUNT = 2     # 現在の画像の次から先読みする枚数
+DECODE_CACHE_BYTES = 1024 * 1024 * 1024    # 先読み・表示済みの画像を残しておくメモリの上限(バイト)
+# 非圧縮データの1画素あたりのビット数(rawmode別)。ここにないrawmodeは範囲読み込みに対応しない
+RAW_MODE_BITS = {
+    "1": 1, "1;I": 1, "1;R": 1, "1;IR": 1,
+    "L": 8, "L;I": 8,
+    "LA": 16, "I;16": 16, "I;16B": 16, "I;16L": 16, "I;16N": 16,
+    "RGB": 24, "BGR": 24,
+    "RGBA": 32, "RGBX": 32, "BGRA": 32, "BGRX": 32, "CMYK": 32,
+    "I": 32, "I;32": 32, "F": 32, "F;32F": 32,
+}
+
+
+def image_nbytes(image):
+    """画像がメモリ上で占めるおおよそのバイト数。Pillowは多バンドの画像を1画素4バイトで保持する。"""
+    w, h = image.size
+    if image.mode in ("1", "L", "P"):
+        return w * h
+    if image.mode.startswith("I;16"):
+        return w * h * 2
+    return w * h * 4
+
+
+class RegionReader:
+    """
+    非圧縮(raw)で格納された画像から、指定範囲にかかる行だけをデコードする。
+    数ギガピクセルの画像でも、メモリに載せるのはトリミング範囲と同じ高さの帯だけで済む。
+    対応していない画像ではopen()がNoneを返す。
+    """
+
+    def __init__(self, path, mode, size, tiles):
+        self.path = path
+        self.mode = mode
+        self.size = size
+        self.tiles = tiles
+
+    @classmethod
+    def open(cls, path):
+        with Image.open(path) as img:
+            tiles = []
+            for tile in img.tile:
+                codec, extents, offset, args = tile
+                if codec != "raw":
+                    return None
+                if isinstance(args, str):
+                    args = (args, 0, 1)
+                rawmode, stride, ystep = (tuple(args) + (0, 1))[:3]
+                bits = RAW_MODE_BITS.get(rawmode)
+                if bits is None or ystep not in (1, -1):
+                    return None
+                x0, y0, x1, y1 = extents
+                if not stride:
+                    stride = ((x1 - x0) * bits + 7) // 8
+                tiles.append((extents, offset, rawmode, stride, ystep))
+            if not tiles or img.palette is not None:
+                # パレットは帯ごとに読み直す必要があるので対象外
+                return None
+            return cls(path, img.mode, img.size, tiles)
+
+    def _decode_band(self, tile, row_start, row_end):
+        """タイルの行row_start〜row_end(画像座標)だけをデコードした画像を返す。"""
+        (x0, y0, x1, y1), offset, rawmode, stride, ystep = tile
+        rows = row_end - row_start
+        if ystep == 1:
+            band_offset = offset + (row_start - y0) * stride
+        else:
+            # 下から上へ格納されている場合(BMPなど)
+            band_offset = offset + (y1 - row_end) * stride
+        with open(self.path, "rb") as fp:
+            fp.seek(band_offset)
+            data = fp.read(rows * stride)
+        # 最後の行の詰め物が省かれたファイルでも読めるようにする
+        data = data.ljust(rows * stride, b"\0")
+        # 下から上へ格納されている場合は、rawデコーダーが先頭の行を帯の一番下に置く
+        return Image.frombytes(self.mode, (x1 - x0, rows), data, "raw", rawmode, stride, ystep)
+
+    def read(self, box):
+        """画像座標のボックス(left, top, right, bottom)の範囲だけを読み込んだ画像を返す。"""
+        left, top, right, bottom = box
+        region = Image.new(self.mode, (right - left, bottom - top))
+        for tile in self.tiles:
+            (x0, y0, x1, y1) = tile[0]
+            if x1 <= left or x0 >= right or y1 <= top or y0 >= bottom:
+                continue
+            row_start = max(y0, top)
+            row_end = min(y1, bottom)
+            band = self._decode_band(tile, row_start, row_end)
+            band = band.crop((max(x0, left) - x0, 0, min(x1, right) - x0, row_end - row_start))
+            region.paste(band, (max(x0, left) - left, row_start - top))
+        return region
+
+    def preview(self, preview_size):
+        """帯ごとに読み込みながら縮小し、全体を一度にデコードせずにプレビューを作る。"""
+        width, height = self.size
+        factor = max(1, -(-width // preview_size[0]), -(-height // preview_size[1]))
+        preview = Image.new(self.mode, (-(-width // factor), -(-height // factor)))
+        bytes_per_row = max(1, width * RAW_MODE_BITS.get(self.mode, 32) // 8)
+        band_rows = max(factor, REGION_BAND_BYTES // bytes_per_row // factor * factor)
+        for top in range(0, height, band_rows):
+            band = self.read((0, top, width, min(height, top + band_rows)))
+            if factor > 1:
+                try:
+                    band = band.reduce(factor)
+                except ValueError:
+                    # "1"や"I;16"などreduceが使えないモードはresizeで縮小
+                    band = band.resize((-(-band.width // factor), -(-band.height // factor)), Image.BOX)
+            preview.paste(band, (0, top // factor))
+        return preview
+
+
+class ImageSource:
+    """
+    ファイルから開いた画像。sizeは常に原寸のサイズで、previewは表示用の縮小画像。
+    原寸の画像はload()を呼んだときに初めてデコードする。
+    """
+
+    def __init__(self, path, size, preview, image=None, region_reader=None):
+        self.path = path
+        self.size = size
+        self.preview = preview
+        self._image = image
+        # 範囲読み込みに対応した画像ならRegionReader
+        self.region_reader = region_reader
+        # UIスレッドと保存などのワーカースレッドが同時に原寸をデコードしないようにする
+        self._lock = threading.Lock()
+
+    @property
+    def is_loaded(self):
+        return self._image is not None
+
+    @property
+    def preview_scale(self):
+        """原寸に対するプレビューの縮小率(1.0なら原寸)。"""
+        return self.preview.size[0] / self.size[0] if self.size[0] else 1.0
+
+    def load(self):
+        """原寸の画像を返す。まだデコードしていなければここでデコードする。複数のスレッドから呼んでよい。"""
+        with self._lock:
+            if self._image is None:
+                with Image.open(self.path) as img:
+                    img.load()
+                self._image = img
+            return self._image
+
+    @property
+    def nbytes(self):
+        """プレビューとデコード済みの原寸画像が占めるおおよそのバイト数。"""
+        nbytes = image_nbytes(self.preview)
+        if self._image is not None and self._image is not self.preview:
+            nbytes += image_nbytes(self._image)
+        return nbytes
+
+    @property
+    def can_read_region(self):
+        return self._image is None and self.region_reader is not None
+
+    def read_region(self, box):
+        """原寸画像のうちboxの範囲だけを返す。可能なら全体をデコードせずに読み込む。"""
+        if self.can_read_region:
+            return self.region_reader.read(box)
+        return self.load().crop(box)
+
+
+def open_source(path, preview_size=PREVIEW_SIZE):
+    """
+    画像ファイルを開いてImageSourceを返す。
+    preview_sizeより大きなJPEGは縮小デコードしたプレビューだけを読み込む。
+    REGION_MIN_PIXELS以上の非圧縮画像は帯ごとに縮小したプレビューだけを作り、それ以外は原寸でデコードする。
+    """
+    with Image.open(path) as img:
+        size = img.size
+        if preview_size and img.format != "JPEG" and size[0] * size[1] >= REGION_MIN_PIXELS:
+            region_reader = RegionReader.open(path)
+            if region_reader is not None:
+                return ImageSource(path, size, region_reader.preview(preview_size), region_reader=region_reader)
+        if (preview_size and img.format == "JPEG" and
+                (size[0] > preview_size[0] or size[1] > preview_size[1])):
+            # draftは指定サイズ以上を保つ範囲で最も小さい1/2^nスケールを選ぶ
+            img.draft(img.mode, preview_size)
+            img.load()
+            if img.size != size:
+                return ImageSource(path, size, img)
+        img.load()
+    return ImageSource(path, size, img, image=img)
+
+
+class DecodeCache:
+    """
+    パスをキーにImageSourceを保持するLRUキャッシュ。合計がmax_bytesを超えたら古いものから捨てる。
+    原寸を後からデコードした分も含めて数えるため、大きさは追加のたびに数え直す。
+    """
+
+    def __init__(self, max_bytes=DECODE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        with self._lock:
+            source = self._items.get(path)
+            if source is not None:
+                self._items.move_to_end(path)
+            return source
+
+    def put(self, path, source):
+        with self._lock:
+            self._items[path] = source
+            self._items.move_to_end(path)
+            total = sum(item.nbytes for item in self._items.values())
+            # 最後に追加したものは上限を超えていても残す
+            while total > self.max_bytes and len(self._items) > 1:
+                _, dropped = self._items.popitem(last=False)
+                total -= dropped.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+class ImageQueue:
+    """
+    ドロップされた複数ファイルの一覧と現在位置を持ち、前後の画像へ移動する。
+    表示中の画像の次のprefetch_count枚は1本のワーカースレッドでプレビューを先読みしてキャッシュしておく。
+    """
+
+    def __init__(self, preview_size=PREVIEW_SIZE, prefetch_count=PREFETCH_COUNT, cache_bytes=DECODE_CACHE_BYTES):
+        self.preview_size = preview_size
+        self.prefetch_count = prefetch_count
+        self.cache = DecodeCache(cache_bytes)
+        self.paths = []
+        self.index = -1
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.paths)
+
+    def set_paths(self, paths):
+        self.paths = list(paths)
+        self.index = -1
+
+    @property
+    def has_next(self):
+        return self.index + 1 < len(self.paths)
+
+    @property
+    def has_previous(self):
+        return self.index > 0
+
+    def _open(self, path):
+        source = open_source(path, preview_size=self.preview_size)
+        self.cache.put(path, source)
+        return source
+
+    def load(self, index):
+        """index番目のファイルを開いて現在位置にし、ImageSourceを返す。読み込みに失敗したら例外を送出する。"""
+        path = self.paths[index]
+        source = self.cache.get(path)
+        if source is None:
+            with self._lock:
+                future = self._pending.get(path)
+            # 先読み中ならその完了を待ち、まだなら自分で開く
+            source = future.result() if future is not None else self._open(path)
+        # 失敗したときは表示中の画像の位置のままにする
+        self.index = index
+        self._prefetch()
+        return source
+
+    def _prefetch(self):
+        for path in self.paths[self.index + 1:self.index + 1 + self.prefetch_count]:
+            with self._lock:
+                if path in self._pending or self.cache.get(path) is not None:
+                    continue
+                future = self._executor.submit(self._open, path)
+                self._pending[path] = future
+            future.add_done_callback(lambda _, path=path: self._forget(path))
+
+    def _forget(self, path):
+        with self._lock:
+            self._pending.pop(path, None)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,216 @@
+"""
+JPEGの無劣化トリミング・90度単位の回転。wxに依存しない。
+元のJPEGファイルのDCT係数をデコード・再エンコードせずにコピーするjpegtran(libjpeg/libjpeg-turbo付属)を
+外部コマンドとして使う。jpegtranが見つからない場合や無劣化で処理できない操作の場合は、呼び出し側で再エンコードする。
+トリミング範囲の左端・上端はMCU(DCTブロックの組)の境界にしか置けないので、最も近い境界に合わせる。
+"""
+import functools
+import io
+import logging
+import os
+import shutil
+import struct
+import subprocess
+import threading
+from PIL import Image
+
+JPEGTRAN_PATH = r""     # jpegtranの場所。空のままならPATHから探す
+JPEGTRAN_COPY = "icc"   # 出力に残すマーカー。再エンコード時と同じくICCプロファイルだけを残す(EXIFの向きは付けない)
+JPEGTRAN_COPY_FALLBACK = "none"     # -copy iccに対応しないjpegtran(libjpeg-turbo 2.1より前など)で使う
+JPEGTRAN_TIMEOUT = 60   # 秒
+# 無劣化で処理できるSOFマーカー(ベースライン・拡張・プログレッシブ。算術符号はjpegtranのビルドによる)
+LOSSLESS_SOF_MARKERS = (0xC0, 0xC1, 0xC2, 0xC9, 0xCA)
+
+logger = logging.getLogger(__name__)
+
+
+def find_jpegtran():
+    """jpegtranのパス。見つからなければNone。"""
+    return JPEGTRAN_PATH or shutil.which("jpegtran")
+
+
+@functools.lru_cache(maxsize=None)
+def copy_option(jpegtran):
+    """
+    jpegtranに渡す-copyの値。JPEGTRAN_COPYに対応していなければJPEGTRAN_COPY_FALLBACKを返す。
+    jpegtranごとに1回だけ、小さなJPEGを変換させて確かめる。
+    """
+    buffer = io.BytesIO()
+    Image.new("L", (8, 8)).save(buffer, format="JPEG")
+    try:
+        result = subprocess.run([jpegtran, "-copy", JPEGTRAN_COPY], input=buffer.getvalue(), timeout=JPEGTRAN_TIMEOUT,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0))
+    except (OSError, subprocess.SubprocessError):
+        # 実行できなければ保存時にも失敗して再エンコードになるので、どちらでもよい
+        return JPEGTRAN_COPY
+    if result.returncode != 0:
+        logger.warning("%s does not support -copy %s; using -copy %s", jpegtran, JPEGTRAN_COPY,
+                       JPEGTRAN_COPY_FALLBACK)
+        return JPEGTRAN_COPY_FALLBACK
+    return JPEGTRAN_COPY
+
+
+def read_jpeg_layout(path):
+    """
+    JPEGファイルのSOFマーカーを読み、(幅, 高さ, MCUの幅, MCUの高さ)を返す。
+    無劣化で処理できない形式(ロスレスJPEG・階層型)やJPEGでないファイルではNoneを返す。
+    """
+    try:
+        with open(path, "rb") as fp:
+            if fp.read(2) != b"\xff\xd8":
+                return None
+            while True:
+                byte = fp.read(1)
+                if not byte:
+                    return None
+                if byte != b"\xff":
+                    continue
+                code = fp.read(1)
+                while code == b"\xff":  # マーカー前の埋め草
+                    code = fp.read(1)
+                if not code:
+                    return None
+                code = code[0]
+                if code == 0x01 or 0xD0 <= code <= 0xD8:
+                    # 長さを持たないマーカー
+                    continue
+                if code in (0xD9, 0xDA):
+                    # SOFより先に画像データか終端が来た
+                    return None
+                length = struct.unpack(">H", fp.read(2))[0]
+                if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+                    if code not in LOSSLESS_SOF_MARKERS:
+                        return None
+                    data = fp.read(length - 2)
+                    _, height, width, components = struct.unpack(">BHHB", data[:6])
+                    if components == 1:
+                        # 1成分の画像はサンプリング係数によらず8x8ブロック単位
+                        return (width, height, 8, 8)
+                    factors = [data[7 + 3 * i] for i in range(components)]
+                    return (width, height, 8 * max(f >> 4 for f in factors), 8 * max(f & 0x0F for f in factors))
+                fp.seek(length - 2, os.SEEK_CUR)
+    except (OSError, struct.error, IndexError):
+        return None
+
+
+def plan_transform(operations, size):
+    """
+    TrimSession.operations()の操作列を、元画像に対する1回の回転(反時計回りの90度単位)と
+    回転後の座標でのトリミング範囲(またはNone)にまとめて(角度, ボックス)で返す。
+    トリミングと90度単位の回転以外の操作や、画像の外にはみ出すトリミングが含まれていればNoneを返す。
+    """
+    angle = 0
+    box = None
+    w, h = size     # 元画像を回転した後の全体の大きさ
+    for op, params, _ in operations:
+        if op == "rotate":
+            steps = params / 90
+            if abs(steps - round(steps)) > 1e-6:
+                return None
+            for _ in range(int(round(steps)) % 4):
+                # 反時計回りの90度回転で(x, y)は(y, w - x)に移る
+                if box is not None:
+                    left, top, right, bottom = box
+                    box = (top, w - right, bottom, w - left)
+                w, h = h, w
+                angle = (angle + 90) % 360
+        elif op == "crop":
+            left, top, right, bottom = params
+            bounds = box or (0, 0, w, h)    # トリミング前の画像の範囲
+            left, top, right, bottom = (bounds[0] + left, bounds[1] + top, bounds[0] + right, bounds[1] + bottom)
+            if left < bounds[0] or top < bounds[1] or right > bounds[2] or bottom > bounds[3]:
+                # はみ出した部分は黒で埋められるが、無劣化ではその画像を作れない
+                return None
+            if right <= left or bottom <= top:
+                return None
+            box = (left, top, right, bottom)
+        else:
+            return None
+    return angle, box
+
+
+def snap_box(box, mcu_size):
+    """ボックスの左端・上端を最も近いMCUの境界に合わせる。右端・下端は任意の位置に置けるのでそのまま。"""
+    mcu_w, mcu_h = mcu_size
+    left, top, right, bottom = box
+    snapped_left = int(round(left / mcu_w)) * mcu_w
+    if snapped_left >= right:
+        snapped_left = left // mcu_w * mcu_w
+    snapped_top = int(round(top / mcu_h)) * mcu_h
+    if snapped_top >= bottom:
+        snapped_top = top // mcu_h * mcu_h
+    return (snapped_left, snapped_top, right, bottom)
+
+
+def jpegtran_args(angle, box, mcu_size):
+    """
+    jpegtranに渡す変換の引数。angleはPILと同じ反時計回り、boxは回転後の座標。
+    jpegtranは時計回りに回し、トリミング範囲は変換後の画像で指定する。
+    """
+    args = []
+    if angle:
+        # 端の半端なブロックが残ると回転できないので、その場合は失敗させて再エンコードに任せる
+        args += ["-rotate", str((360 - angle) % 360), "-perfect"]
+    if box is not None:
+        if angle in (90, 270):
+            mcu_size = (mcu_size[1], mcu_size[0])
+        left, top, right, bottom = snap_box(box, mcu_size)
+        args += ["-crop", "%dx%d+%d+%d" % (right - left, bottom - top, left, top)]
+    return args
+
+
+class LosslessJpegJob:
+    """
+    元のJPEGファイルをjpegtranで無劣化に変換して保存するジョブ。SaveJobと同じくrun()で保存先のパスを返す。
+    jpegtranが失敗した場合はfallback(再エンコードするSaveJob)を実行する。
+    fallbackにはImageSnapshotから保存するSaveJobを渡し、再エンコードする場合にだけ原寸の画像を作る。
+    """
+
+    def __init__(self, source_path, path, args, fallback, jpegtran=None):
+        self.source_path = source_path
+        self.path = path
+        self.args = args
+        self.fallback = fallback
+        self.jpegtran = jpegtran or find_jpegtran()
+
+    def run(self):
+        save_dir = os.path.dirname(self.path)
+        if save_dir:
+            os.makedirs(save_dir, exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        command = [self.jpegtran, "-copy", copy_option(self.jpegtran)] + self.args + ["-outfile", tmp_path, self.source_path]
+        try:
+            # Windowsでコンソールウィンドウを開かない
+            subprocess.run(command, check=True, timeout=JPEGTRAN_TIMEOUT, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.PIPE, creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0))
+            # trim_core.write_file_atomicと同じく、置き換える前にディスクへ書き出す(Windowsでは書き込み可能で開く必要がある)
+            with open(tmp_path, "rb+") as fp:
+                os.fsync(fp.fileno())
+            os.replace(tmp_path, self.path)
+        except (OSError, subprocess.SubprocessError):
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return self.fallback.run()
+        return self.path
+
+
+def prepare_lossless_job(source_path, operations, path, fallback):
+    """
+    source_pathのJPEGにoperationsを無劣化で適用するジョブを返す。
+    jpegtranがない、JPEGでない、トリミングと90度単位の回転以外の操作があるなどで無劣化にできなければNoneを返す。
+    """
+    jpegtran = find_jpegtran()
+    if jpegtran is None:
+        return None
+    layout = read_jpeg_layout(source_path)
+    if layout is None:
+        return None
+    width, height, mcu_w, mcu_h = layout
+    plan = plan_transform(operations, (width, height))
+    if plan is None:
+        return None
+    angle, box = plan
+    return LosslessJpegJob(source_path, path, jpegtran_args(angle, box, (mcu_w, mcu_h)), fallback, jpegtran)
@@ -0,0 +1,141 @@
+"""
+画像の色モードの扱い。wxに依存しない。
+編集中の画像は元のモードのまま扱い(16bitやパレットの情報を失わない)、
+表示用の縮小画像を作るときと保存するときにだけ、その用途で正しく表せる最も安い変換を1回行う。
+"""
+import io
+from PIL import Image
+
+try:
+    from PIL import ImageCms
+except ImportError:     # LittleCMSなしでビルドされたPillow
+    ImageCms = None
+
+MATTE_COLOR = (255, 255, 255)   # JPEGなど透明度を持てない形式で、透明部分を塗りつぶす色
+DISPLAY_MODES = ("RGB", "RGBA")
+HIGH_BIT_MODES = ("I;16", "I;16L", "I;16B", "I;16N", "I", "F")
+GRAY_MODES = ("1", "L", "LA", "La") + HIGH_BIT_MODES
+
+# 保存形式ごとに、変換せずにそのまま書き出すモード。ここにない形式はPillowの変換に任せる
+FORMAT_MODES = {
+    "JPEG": ("L", "RGB", "CMYK"),
+    "PNG": ("1", "L", "LA", "P", "RGB", "RGBA", "I;16", "I;16B"),
+    "WEBP": ("RGB", "RGBA"),
+    "BMP": ("1", "L", "P", "RGB", "RGBA"),
+    "TIFF": ("1", "L", "LA", "P", "PA", "RGB", "RGBA", "CMYK", "I;16", "I;16B", "I", "F"),
+}
+# 画像のICCプロファイルを自動では書き込まないので、保存時の引数で渡す形式
+ICC_PARAM_FORMATS = ("JPEG", "WEBP")
+
+
+def has_alpha(image):
+    return image.mode in ("RGBA", "LA", "PA", "RGBa", "La") or (image.mode == "P" and "transparency" in image.info)
+
+
+def display_mode(image):
+    """表示に使うモード。透明度があればRGBA、なければRGB。"""
+    return "RGBA" if has_alpha(image) else "RGB"
+
+
+def to_8bit(image):
+    """16bit・32bitのグレー画像を上位8bitのLにする。Iは16bitの値として扱う。それ以外はそのまま返す。"""
+    if image.mode not in HIGH_BIT_MODES:
+        return image
+    if image.mode == "F":
+        # 浮動小数点は0〜255の範囲とみなして切り詰める
+        return image.convert("L")
+    if image.mode != "I":
+        image = image.convert("I")
+    return image.point(lambda value: value / 256).convert("L")
+
+
+def convert_mode(image, mode):
+    """
+    imageをmodeに変換する。16bitは上位8bitにし、CMYKは埋め込みのICCプロファイルがあればそれでsRGBにする。
+    色空間が変わってもとのICCプロファイルが合わなくなる場合は取り除く。
+    """
+    if image.mode == mode:
+        return image
+    source_mode = image.mode
+    if source_mode in HIGH_BIT_MODES and mode not in HIGH_BIT_MODES:
+        image = to_8bit(image)
+        if image.mode == mode:
+            return image
+    icc = image.info.get("icc_profile")
+    if source_mode == "CMYK" and mode in ("RGB", "RGBA") and icc and ImageCms is not None:
+        try:
+            converted = ImageCms.profileToProfile(image, ImageCms.ImageCmsProfile(io.BytesIO(icc)),
+                                                 ImageCms.createProfile("sRGB"), outputMode="RGB")
+        except (ImageCms.PyCMSError, OSError):
+            converted = None
+        if converted is not None:
+            converted.info.pop("icc_profile", None)
+            return converted if mode == "RGB" else converted.convert(mode)
+    converted = image.convert(mode)
+    if (source_mode in GRAY_MODES) != (mode in GRAY_MODES) or "CMYK" in (source_mode, mode):
+        converted.info.pop("icc_profile", None)
+    return converted
+
+
+def for_resampling(image):
+    """
+    回転・縮小の前に、補間できるモードにする。"1"とパレットはPillowが最近傍法でしか補間しないので、
+    Lか、RGB・RGBAにする。それ以外(16bitやCMYKを含む)はそのまま返す。
+    """
+    if image.mode == "1":
+        return image.convert("L")
+    if image.mode in ("P", "PA"):
+        return convert_mode(image, display_mode(image))
+    return image
+
+
+def to_display_base(image):
+    """表示用のRGBかRGBAにする。すでにそのどちらかなら変換せずに返す。"""
+    if image.mode in DISPLAY_MODES:
+        return image
+    return convert_mode(image, display_mode(image))
+
+
+def flatten(image, color=MATTE_COLOR):
+    """透明度のある画像をcolorの上に重ね、グレーならL、それ以外はRGBの不透明な画像にする。"""
+    gray = image.mode in ("LA", "La")
+    rgba = image if image.mode == "RGBA" else convert_mode(image, "RGBA")
+    background = Image.new("RGBA", rgba.size, tuple(color) + (255,))
+    flat = Image.alpha_composite(background, rgba)
+    flat = flat.convert("L") if gray else flat.convert("RGB")
+    flat.info = {key: value for key, value in image.info.items() if key != "transparency"}
+    return flat
+
+
+def prepare_for_format(image, format):
+    """
+    formatで保存できるモードにする。そのまま書き出せるモードなら変換せずに返す。
+    透明度を持てない形式では背景色に重ね、グレーはグレーのまま、16bitは16bitを持てない形式でだけ8bitにする。
+    """
+    modes = FORMAT_MODES.get(format)
+    if modes is None or image.mode in modes:
+        return image
+    alpha = has_alpha(image)
+    gray = image.mode in GRAY_MODES
+    if alpha and "RGBA" not in modes:
+        return flatten(image)
+    if image.mode in HIGH_BIT_MODES:
+        # PNGにはIを16bitに切り詰めたI;16で書く。8bitにするのはほかに手がない場合だけ
+        if "I;16" in modes and image.mode == "I":
+            return image.convert("I;16")
+        image = to_8bit(image)
+        if image.mode in modes:
+            return image
+    if alpha:
+        target = "LA" if gray and "LA" in modes else "RGBA"
+    else:
+        target = "L" if gray and "L" in modes else "RGB"
+    return convert_mode(image, target)
+
+
+def color_params(image, format):
+    """formatで保存するときに、画像のICCプロファイルを引き継ぐための保存時の引数。"""
+    icc = image.info.get("icc_profile")
+    if icc and format in ICC_PARAM_FORMATS:
+        return {"icc_profile": icc}
+    return {}